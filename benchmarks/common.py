@@ -0,0 +1,83 @@
+import json
+import os
+import platform
+import sys
+import time
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_SOURCES_PATH = os.path.join(ROOT, 'data_generating_sources')
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def make_arg_parser():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--out', type=str, default=None)
+    arg_parser.add_argument('--baseline', type=str, default=None)
+    arg_parser.add_argument('--threshold', type=float, default=0.2)
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    return arg_parser
+
+
+class Results:
+    # Benchmark results keyed by name. Every benchmark keeps the fastest of its runs.
+    def __init__(self):
+        self.benchmarks = {}
+
+    def add(self, name, seconds, rows=None, **details):
+        result = {'seconds': round(seconds, 6)}
+        if rows is not None:
+            result['rows'] = rows
+            result['rows_per_second'] = round(rows / seconds, 1) if seconds else None
+        result.update(details)
+        self.benchmarks[name] = result
+        print(f'{name:<48} {seconds:>10.4f} s' + (f' {rows:>10} rows' if rows is not None else ''), flush=True)
+
+    def measure(self, name, run, repeat=1, rows=None):
+        # run() is called repeat times and may return the number of rows it made
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            n = run()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        self.add(name, best, rows if rows is not None else n)
+
+    def as_dict(self):
+        return {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'benchmarks': self.benchmarks,
+        }
+
+
+def compare(baseline, results, threshold):
+    # Returns the benchmarks that got slower than the baseline by more than threshold
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if base is None or not base['seconds']:
+            continue
+        ratio = result['seconds'] / base['seconds']
+        if ratio > 1 + threshold:
+            regressions.append((name, base['seconds'], result['seconds'], ratio))
+    return regressions
+
+
+def finish(results, args):
+    data = results.as_dict()
+    if args.out is not None:
+        with open(args.out, 'w') as out_file:
+            json.dump(data, out_file, indent=2)
+    if args.baseline is None:
+        return
+    with open(args.baseline, 'r') as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = compare(baseline, data, args.threshold)
+    for name, base_seconds, seconds, ratio in regressions:
+        print(f'Regression: {name} {base_seconds:.4f} s -> {seconds:.4f} s ({ratio:.2f}x)', file=sys.stderr)
+    if regressions:
+        sys.exit(1)
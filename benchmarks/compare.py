@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+# Compares a benchmark results file with a baseline and fails on regressions
+
+import json
+import sys
+from argparse import ArgumentParser
+from common import compare
+
+arg_parser = ArgumentParser()
+arg_parser.add_argument('baseline', type=str)
+arg_parser.add_argument('results', type=str)
+arg_parser.add_argument('--threshold', type=float, default=0.2)
+
+
+def main():
+    args = arg_parser.parse_args()
+    with open(args.baseline, 'r') as baseline_file:
+        baseline = json.load(baseline_file)
+    with open(args.results, 'r') as results_file:
+        results = json.load(results_file)
+    for name, result in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if base is not None and base['seconds']:
+            print(f'{name:<48} {base["seconds"]:>10.4f} s {result["seconds"]:>10.4f} s {result["seconds"] / base["seconds"]:>6.2f}x')
+    regressions = compare(baseline, results, args.threshold)
+    for name, base_seconds, seconds, ratio in regressions:
+        print(f'Regression: {name} {base_seconds:.4f} s -> {seconds:.4f} s ({ratio:.2f}x)', file=sys.stderr)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
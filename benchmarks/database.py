@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Measures the insert and select paths of Model against a throwaway PostgreSQL
+# instance created with initdb in a temporary directory (or against a throwaway
+# database on the server given by --dsn), loaded with my_device.sql.
+
+import os
+from common import DATA_SOURCES_PATH, Results, finish, make_arg_parser
+from postgres import DATABASE_NAME, existing_server, throwaway_database, throwaway_server
+import psycopg2
+import distributions
+from data_generating import CustomerGenerator, NameGenerator
+from model import IdAllocator, Model
+from models import Customer, init_models
+
+ROWS = 10000
+# The per-row insert path does a round-trip per row and is measured on fewer rows
+PER_ROW_ROWS = 1000
+
+arg_parser = make_arg_parser()
+arg_parser.add_argument('--scales', type=str, default='1,10')
+arg_parser.add_argument('--dsn', type=str, default=None)
+arg_parser.add_argument('--port', type=int, default=55432)
+
+
+def run_scale(results, dsn, connection, customer_generator, scale, repeat):
+    cursor = connection.cursor()
+    allocator_connection = psycopg2.connect(dsn, dbname=DATABASE_NAME)
+    allocator_connection.autocommit = True
+    prefix = f'database.x{scale}'
+    rows = ROWS * scale
+    columns = customer_generator.columns(rows)
+    columns = {column: values.tolist() for column, values in columns.items()}
+
+    def entities(count, id_allocator=None):
+        Model.id_allocator = id_allocator
+        return [Customer(**dict(zip(columns, row))) for row in zip(*(values[:count] for values in columns.values()))]
+
+    def truncate():
+        cursor.execute('TRUNCATE customer RESTART IDENTITY CASCADE')
+        connection.commit()
+
+    def measure_insert(name, insert, count):
+        def run():
+            truncate()
+            insert()
+            connection.commit()
+            return count
+        results.measure(f'{prefix}.{name}', run, repeat)
+
+    def insert_per_row():
+        for customer in entities(PER_ROW_ROWS):
+            customer.insert(cursor)
+    measure_insert('insert.per_row', insert_per_row, PER_ROW_ROWS)
+    measure_insert('insert.returning_ids', lambda: Customer.insert_many(cursor, entities(rows)), rows)
+    id_allocator = IdAllocator(allocator_connection.cursor())
+    measure_insert('insert.copy', lambda: Customer.insert_many(cursor, entities(rows, id_allocator)), rows)
+    Model.id_allocator = id_allocator
+    measure_insert('insert.columns', lambda: Customer.insert_columns(cursor, {
+        column: values for column, values in columns.items()
+    }), rows)
+    Model.id_allocator = None
+
+    results.measure(f'{prefix}.select.eager', lambda: sum(1 for _ in Customer.select(cursor)), repeat)
+    results.measure(f'{prefix}.select.server_side', lambda: sum(1 for _ in Customer.select(cursor, itersize=10000)), repeat)
+    results.measure(f'{prefix}.select.projection', lambda: sum(1 for _ in Customer.select(
+        cursor, {'registration_timestamp__ne': None}, columns=['id', 'registration_timestamp'], itersize=10000,
+    )), repeat)
+    connection.rollback()
+    allocator_connection.close()
+
+
+def main():
+    args = arg_parser.parse_args()
+    distributions.seed(args.seed)
+    name_generator = NameGenerator(
+        os.path.join(DATA_SOURCES_PATH, 'russian_male_first_names.csv'),
+        os.path.join(DATA_SOURCES_PATH, 'russian_female_first_names.csv'),
+        os.path.join(DATA_SOURCES_PATH, 'russian_last_names.csv'),
+    )
+    customer_generator = CustomerGenerator(name_generator)
+    results = Results()
+    with (throwaway_server(args.port) if args.dsn is None else existing_server(args.dsn)) as dsn:
+        with throwaway_database(dsn) as connection:
+            init_models(connection.cursor())
+            connection.commit()
+            for scale in map(int, args.scales.split(',')):
+                run_scale(results, dsn, connection, customer_generator, scale, args.repeat)
+    finish(results, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Runs the generators without a database at multiples of the default sizes of
+# manager.py. Inputs that the generators would read back from the database are
+# passed in memory, as in manager.py export.
+
+import os
+from common import DATA_SOURCES_PATH, ROOT, Results, finish, make_arg_parser
+import distributions
+from data_generating import *
+from model import LocalIdAllocator, Model
+from models import init_models_from_schema
+
+CUSTOMERS = 5000
+DEVICES = 1000
+RENTS = 10000
+
+arg_parser = make_arg_parser()
+arg_parser.add_argument('--scales', type=str, default='1,10,100')
+
+
+def source(filename):
+    return os.path.join(DATA_SOURCES_PATH, filename)
+
+
+def run_scale(results, scale, repeat, seed):
+    distributions.seed(seed)
+    Model.id_allocator = LocalIdAllocator()
+    prefix = f'generators.x{scale}'
+    outputs = {}
+
+    def run(name, generate, count=len):
+        def run_once():
+            outputs[name] = generate()
+            return count(outputs[name])
+        results.measure(f'{prefix}.{name}', run_once, repeat)
+        return outputs[name]
+
+    name_generator = run('names', lambda: NameGenerator(
+        source('russian_male_first_names.csv'),
+        source('russian_female_first_names.csv'),
+        source('russian_last_names.csv'),
+    ), count=lambda _: None)
+    manufacturers = run('manufacturers', lambda: list(ManufacturerGenerator(source('manufacturers.yaml'))()))
+    manufacturer_ids = {manufacturer.name: manufacturer.id for manufacturer in manufacturers}
+    device_models = run('device_models', lambda: [
+        device_model
+        for device_model, _, _ in DeviceModelGenerator(source('device_models.yaml'))(None, manufacturer_ids)
+    ])
+    device_model_ids = {device_model.name: device_model.id for device_model in device_models}
+    devices = run('devices', lambda: list(DeviceGenerator()(
+        None, DEVICES * scale, device_model_ids=list(device_model_ids.values()),
+    )))
+    customer_generator = CustomerGenerator(name_generator)
+    customer_columns = run('customers', lambda: customer_generator.columns(CUSTOMERS * scale), count=lambda x: len(x['phone']))
+    customers = CustomerIndex(
+        Model.id_allocator.reserve(Customer.TABLE_NAME, CUSTOMERS * scale),
+        customer_columns['registration_timestamp'],
+    )
+    timeline = run('timeline', lambda: list(TimelineGenerator()(
+        None, RENTS * scale, customers=customers, devices=devices,
+    )), count=lambda x: sum(len(device_rents) for device_rents, _, _, _ in x))
+    uninsured_repairs = [
+        (device_repair.id, device_repair.device_ownership.id, device_repair.price)
+        for device_rents, _, _, device_repairs in timeline if not device_rents[0].is_insured
+        for device_repair in device_repairs
+    ]
+    last_rents = [(device_rents[-1].id, device_rents[-1].end_timestamp) for device_rents, _, _, _ in timeline]
+    run('damage_fines', lambda: list(DamageFineGenerator()(None, device_repairs=uninsured_repairs)))
+    run('rent_price', lambda: list(DeviceModelRentPriceGenerator(source('device_models.yaml'))(
+        None, device_model_ids=device_model_ids,
+    )))
+    run('feedbacks', lambda: list(FeedbackGenerator(source('feedbacks.yaml'))(None, last_rents=last_rents)))
+
+
+def main():
+    args = arg_parser.parse_args()
+    init_models_from_schema(os.path.join(ROOT, 'my_device.sql'))
+    results = Results()
+    for scale in map(int, args.scales.split(',')):
+        run_scale(results, scale, args.repeat, args.seed)
+    finish(results, args)
+
+
+if __name__ == '__main__':
+    main()
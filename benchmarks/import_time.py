@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+# Guards the startup cost of manager.py: importing it must stay fast and must not
+# load the modules that are only needed by some of the targets.
+
+import json
+import os
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that may only be imported once a target that needs them runs
+LAZY_MODULES = ['scipy', 'scipy.stats']
+
+arg_parser = ArgumentParser()
+arg_parser.add_argument('--module', type=str, default='manager')
+arg_parser.add_argument('--repeat', type=int, default=5)
+arg_parser.add_argument('--max-seconds', type=float, default=1.0)
+
+
+def measure(module):
+    code = f'import sys, json, {module}; print(json.dumps([m for m in {LAZY_MODULES!r} if m in sys.modules]))'
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True, capture_output=True, text=True).stdout
+    return time.perf_counter() - started, json.loads(output)
+
+
+def main():
+    args = arg_parser.parse_args()
+    results = [measure(args.module) for _ in range(args.repeat)]
+    seconds = min(elapsed for elapsed, _ in results)
+    loaded = results[0][1]
+    print(json.dumps({'module': args.module, 'seconds': round(seconds, 3), 'eagerly_loaded': loaded}))
+    failed = False
+    if seconds > args.max_seconds:
+        print(f'Importing {args.module} took {seconds:.3f}s (limit {args.max_seconds}s)', file=sys.stderr)
+        failed = True
+    if loaded:
+        print(f'Importing {args.module} loaded {", ".join(loaded)}', file=sys.stderr)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# Throwaway PostgreSQL servers and databases for the benchmarks
+
+import glob
+import os
+import shutil
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from common import ROOT
+import psycopg2
+
+DATABASE_NAME = 'my_device_benchmark'
+
+
+def _find_bin(name):
+    path = shutil.which(name)
+    if path is not None:
+        return path
+    try:
+        bindir = subprocess.run(['pg_config', '--bindir'], check=True, capture_output=True, text=True).stdout.strip()
+        candidates = [os.path.join(bindir, name)]
+    except (OSError, subprocess.CalledProcessError):
+        candidates = sorted(glob.glob(f'/usr/lib/postgresql/*/bin/{name}'), reverse=True)
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+    raise RuntimeError(f'{name} is not found, pass --dsn of a server to use instead')
+
+
+@contextmanager
+def throwaway_server(port):
+    data_dir = tempfile.mkdtemp(prefix='my_device_benchmark_')
+    try:
+        subprocess.run([_find_bin('initdb'), '-D', data_dir, '-A', 'trust', '-U', 'postgres'], check=True, capture_output=True)
+        subprocess.run([
+            _find_bin('pg_ctl'), '-D', data_dir, '-w', '-l', os.path.join(data_dir, 'server.log'),
+            '-o', f"-k {data_dir} -p {port} -c listen_addresses='' -c fsync=off",
+            'start',
+        ], check=True, capture_output=True)
+        try:
+            yield f'host={data_dir} port={port} user=postgres dbname=postgres'
+        finally:
+            subprocess.run([_find_bin('pg_ctl'), '-D', data_dir, '-m', 'fast', 'stop'], capture_output=True)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+@contextmanager
+def existing_server(dsn):
+    yield dsn
+
+
+@contextmanager
+def throwaway_database(dsn):
+    admin_connection = psycopg2.connect(dsn)
+    admin_connection.autocommit = True
+    admin_cursor = admin_connection.cursor()
+    admin_cursor.execute(f'DROP DATABASE IF EXISTS {DATABASE_NAME}')
+    admin_cursor.execute(f'CREATE DATABASE {DATABASE_NAME}')
+    try:
+        connection = psycopg2.connect(dsn, dbname=DATABASE_NAME)
+        try:
+            with open(os.path.join(ROOT, 'my_device.sql'), 'r') as schema_file:
+                connection.cursor().execute(schema_file.read())
+            connection.commit()
+            yield connection
+        finally:
+            connection.close()
+    finally:
+        admin_cursor.execute(f'DROP DATABASE IF EXISTS {DATABASE_NAME}')
+        admin_connection.close()
+
+
+def libpq_environment(dsn, dbname=DATABASE_NAME):
+    # Environment that makes libpq clients such as manager.py connect to the server
+    # of dsn
+    params = psycopg2.extensions.parse_dsn(dsn)
+    env = dict(os.environ)
+    for param, variable in [('host', 'PGHOST'), ('port', 'PGPORT'), ('user', 'PGUSER'), ('password', 'PGPASSWORD')]:
+        if param in params:
+            env[variable] = params[param]
+    env['PGDATABASE'] = dbname
+    return env
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+# Loads a dataset into a throwaway database, runs every query of queries.sql and
+# probes of the schema's SQL functions with EXPLAIN (ANALYZE, BUFFERS) and records
+# their latency and plan shape. Sequential scans and nested loops over large
+# tables are flagged. Plans of statements run inside functions are collected
+# through auto_explain when the server has it.
+
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from common import ROOT, Results, finish, make_arg_parser
+from postgres import DATABASE_NAME, existing_server, libpq_environment, throwaway_database, throwaway_server
+
+# Calls of the schema's functions, with a query drawing sample arguments for them
+FUNCTION_PROBES = {
+    'succeeding_device_rents': (
+        'SELECT COUNT(*) FROM succeeding_device_rents(%s)',
+        'SELECT id FROM device_rent WHERE chain_position = 0 ORDER BY random() LIMIT %s',
+    ),
+    'device_rent_end_timestamp': (
+        'SELECT device_rent_end_timestamp(%s)',
+        'SELECT id FROM device_rent ORDER BY random() LIMIT %s',
+    ),
+    'is_within_device_ownership': (
+        'SELECT is_within_device_ownership(%s, %s)',
+        'SELECT device_id, begin_timestamp FROM device_ownership WHERE device_id IS NOT NULL ORDER BY random() LIMIT %s',
+    ),
+    # Its changes are rolled back with the rest of the harness transaction
+    'refresh_revenue_rollups': (
+        'SELECT refresh_revenue_rollups(%s)',
+        'SELECT begin_timestamp FROM device_rent ORDER BY random() LIMIT %s',
+    ),
+}
+
+arg_parser = make_arg_parser()
+arg_parser.add_argument('--scale', type=int, default=10)
+arg_parser.add_argument('--dataset', type=str, default=None)
+arg_parser.add_argument('--workers', type=int, default=4)
+arg_parser.add_argument('--dsn', type=str, default=None)
+arg_parser.add_argument('--port', type=int, default=55432)
+arg_parser.add_argument('--large-rows', type=int, default=100000)
+arg_parser.add_argument('--max-ms', type=float, default=1000)
+arg_parser.add_argument('--samples', type=int, default=20)
+arg_parser.add_argument('--strict', action='store_true')
+
+
+def read_queries(filename):
+    # Statements are separated by semicolons at line ends. The comment lines
+    # preceding a statement are its title.
+    queries = {}
+    with open(filename, 'r') as queries_file:
+        for chunk in re.split(r';\s*$', queries_file.read(), flags=re.MULTILINE):
+            lines = chunk.strip().splitlines()
+            titles = [line.lstrip('-').strip() for line in lines if line.startswith('--')]
+            statement = '\n'.join(line for line in lines if not line.startswith('--')).strip()
+            if statement:
+                queries[titles[0] if titles else statement.splitlines()[0]] = statement
+    return queries
+
+
+def make_dataset(dataset_dir, env, scale, workers):
+    manager = os.path.join(ROOT, 'manager.py')
+    if not os.path.exists(os.path.join(dataset_dir, 'manifest.json')):
+        subprocess.run([
+            sys.executable, manager, 'export', '--out', dataset_dir, '--log-level', 'WARNING', '--size', str(scale),
+        ], cwd=ROOT, check=True)
+    subprocess.run([
+        sys.executable, manager, 'load', '--in', dataset_dir, '--db', DATABASE_NAME,
+        '--workers', str(workers), '--log-level', 'WARNING',
+    ], cwd=ROOT, env=env, check=True)
+
+
+def _nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from _nodes(child)
+
+
+def plan_shape(plan):
+    name = plan['Node Type']
+    if 'Relation Name' in plan:
+        name += f' on {plan["Relation Name"]}'
+    if 'Index Name' in plan:
+        name += f' using {plan["Index Name"]}'
+    children = plan.get('Plans', [])
+    return name + (f' [{", ".join(map(plan_shape, children))}]' if children else '')
+
+
+def plan_flags(plan, table_rows, large_rows):
+    flags = []
+    for node in _nodes(plan):
+        relation = node.get('Relation Name')
+        if node['Node Type'] == 'Seq Scan' and table_rows.get(relation, 0) >= large_rows:
+            flags.append(f'Seq Scan on {relation} ({table_rows[relation]} rows)')
+        if node['Node Type'] == 'Nested Loop':
+            outer, inner = node['Plans'][:2]
+            outer_rows = outer.get('Actual Rows', outer.get('Plan Rows', 0)) * outer.get('Actual Loops', 1)
+            if outer_rows >= large_rows:
+                flags.append(f'Nested Loop over {outer_rows} rows into {plan_shape(inner)}')
+    return flags
+
+
+class PlanHarness:
+    def __init__(self, connection, large_rows):
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.large_rows = large_rows
+        self.cursor.execute('''
+            SELECT relname, reltuples::bigint FROM pg_class
+            WHERE relkind = 'r' AND relnamespace = 'public'::regnamespace
+        ''')
+        self.table_rows = dict(self.cursor.fetchall())
+        self.has_auto_explain = self._load_auto_explain()
+
+    def _load_auto_explain(self):
+        try:
+            self.cursor.execute('''LOAD 'auto_explain' ''')
+        except Exception as e:
+            print(f'auto_explain is not available, plans inside functions are not collected: {e}', file=sys.stderr)
+            self.connection.rollback()
+            return False
+        for setting, value in [
+            ('log_min_duration', '0'), ('log_analyze', 'on'), ('log_buffers', 'on'),
+            ('log_nested_statements', 'on'), ('log_format', 'json'), ('log_level', 'notice'),
+        ]:
+            self.cursor.execute(f'SET auto_explain.{setting} = {value}')
+        self.cursor.execute('SET client_min_messages = notice')
+        return True
+
+    def _nested_plans(self):
+        # auto_explain reports every statement as a notice, the outermost one last
+        plans = []
+        for notice in self.connection.notices:
+            _, _, plan = notice.partition('plan:')
+            if plan.strip():
+                plans.append(json.loads(plan)['Plan'])
+        del self.connection.notices[:]
+        return plans[:-1]
+
+    def explain(self, q, params=None):
+        del self.connection.notices[:]
+        self.cursor.execute(f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {q}', params)
+        explained, = self.cursor.fetchone()[0]
+        plan = explained['Plan']
+        nested_plans = self._nested_plans() if self.has_auto_explain else []
+        flags = plan_flags(plan, self.table_rows, self.large_rows)
+        for nested_plan in nested_plans:
+            flags.extend(f'in function: {flag}' for flag in plan_flags(nested_plan, self.table_rows, self.large_rows))
+        return {
+            'planning_ms': explained['Planning Time'],
+            'execution_ms': explained['Execution Time'],
+            'shape': plan_shape(plan),
+            'nested_shapes': sorted(set(map(plan_shape, nested_plans))),
+            'flags': sorted(set(flags)),
+            'shared_hit_blocks': plan.get('Shared Hit Blocks'),
+            'shared_read_blocks': plan.get('Shared Read Blocks'),
+        }
+
+    def time_calls(self, q, samples):
+        started = time.perf_counter()
+        for params in samples:
+            self.cursor.execute(q, params)
+            self.cursor.fetchall()
+        return (time.perf_counter() - started) / max(1, len(samples))
+
+
+def report(results, name, seconds, details, max_ms):
+    results.add(name, seconds, **details)
+    for flag in details['flags']:
+        print(f'    flagged: {flag}')
+    if seconds * 1000 > max_ms:
+        details['flags'].append(f'slower than {max_ms} ms')
+        print(f'    flagged: slower than {max_ms} ms')
+
+
+def main():
+    args = arg_parser.parse_args()
+    results = Results()
+    with (throwaway_server(args.port) if args.dsn is None else existing_server(args.dsn)) as dsn:
+        with throwaway_database(dsn) as connection, tempfile.TemporaryDirectory() as temp_dir:
+            make_dataset(args.dataset or temp_dir, libpq_environment(dsn), args.scale, args.workers)
+            connection.autocommit = True
+            connection.cursor().execute('VACUUM ANALYZE')
+            connection.autocommit = False
+            harness = PlanHarness(connection, args.large_rows)
+            for title, q in read_queries(os.path.join(ROOT, 'queries.sql')).items():
+                details = harness.explain(q)
+                report(results, f'query_plans.x{args.scale}.{title}', details['execution_ms'] / 1000, details, args.max_ms)
+            for name, (q, sample_q) in FUNCTION_PROBES.items():
+                harness.cursor.execute(sample_q, (args.samples, ))
+                samples = harness.cursor.fetchall()
+                if not samples:
+                    continue
+                details = harness.explain(q, samples[0])
+                seconds = harness.time_calls(q, samples)
+                report(results, f'query_plans.x{args.scale}.function.{name}', seconds, details, args.max_ms)
+            connection.rollback()
+    finish(results, args)
+    if args.strict and any(result['flags'] for result in results.benchmarks.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import logging
+import psycopg2
+
+
+# Per-row PL/pgSQL checks that are replaced by set-based validation during a bulk load
+CHECK_CONSTRAINTS = {
+    'device_ownership': [
+        'device_ownership_check_begin_timestamp',
+        'device_ownership_check_end_timestamp',
+    ],
+    'device_rent': [
+        'device_rent_check_previous_device_rent_end_timestamp',
+    ],
+}
+
+TRIGGERS = {
+    'device_rent': [
+        'device_rent_default_end_timestamp_trigger',
+    ],
+}
+
+VALIDATIONS = {
+    # An exclusion constraint would need btree_gist for device_id, and cannot be
+    # added to the partitioned device_ownership, as it does not cover the
+    # partition key. A running maximum of the end timestamps of each device finds
+    # the same overlaps in one sort, and reports all of them.
+    'overlapping device ownerships': '''
+        SELECT id, device_id, begin_timestamp, end_timestamp FROM (
+            SELECT id, device_id, begin_timestamp, end_timestamp,
+                MAX(COALESCE(end_timestamp, 'infinity')) OVER (
+                    PARTITION BY device_id ORDER BY begin_timestamp, id
+                    ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                ) AS previous_end_timestamp
+            FROM device_ownership
+            WHERE device_id IS NOT NULL
+        ) AS t
+        WHERE begin_timestamp <= previous_end_timestamp
+    ''',
+    'broken device rent chains': '''
+        SELECT device_rent.id, device_rent.previous_device_rent_id, device_rent.begin_timestamp, previous.end_timestamp
+        FROM device_rent
+        JOIN device_rent AS previous ON previous.id = device_rent.previous_device_rent_id
+        WHERE previous.end_timestamp IS DISTINCT FROM device_rent.begin_timestamp
+            OR previous.chain_id IS DISTINCT FROM device_rent.chain_id
+            OR previous.chain_position + 1 IS DISTINCT FROM device_rent.chain_position
+    ''',
+}
+
+
+class BulkLoad:
+    # Drops the function-based checks and foreign keys of the given tables and
+    # disables the default end timestamp trigger for the duration of a load. On
+    # restore the same rules are checked with set-based queries and the constraints
+    # are added back without re-running the per-row checks.
+    def __init__(self, cursor, table_names, unlogged=False, max_reported_rows=10):
+        self.cursor = cursor
+        self.table_names = list(table_names)
+        self.unlogged = unlogged
+        self.max_reported_rows = max_reported_rows
+        self.constraints = []
+
+    def _execute(self, q, params=None):
+        logging.debug(q)
+        self.cursor.execute(q, params)
+
+    def _save_constraints(self):
+        q = '''
+            SELECT conrelid::regclass::text, conname, contype, pg_get_constraintdef(oid)
+            FROM pg_constraint
+            WHERE conrelid = ANY(%s::regclass[]) AND (contype = 'f' OR conname = ANY(%s))
+        '''
+        check_constraint_names = [name for names in CHECK_CONSTRAINTS.values() for name in names]
+        self._execute(q, (self.table_names, check_constraint_names))
+        self.constraints = self.cursor.fetchall()
+
+    def _storage_tables(self):
+        # Plain tables, and the partitions of partitioned tables, which have no
+        # storage of their own
+        self._execute('''
+            SELECT relation::text FROM unnest(%s::regclass[]) AS t(relation)
+            JOIN pg_class ON pg_class.oid = relation
+            WHERE pg_class.relkind = 'r' AND NOT pg_class.relispartition
+            UNION
+            SELECT tree.relid::regclass::text FROM unnest(%s::regclass[]) AS t(relation), pg_partition_tree(relation) AS tree
+            WHERE tree.isleaf
+        ''', (self.table_names, self.table_names))
+        return [table_name for table_name, in self.cursor.fetchall()]
+
+    def disable(self):
+        self._save_constraints()
+        for table_name, constraint_name, _, _ in self.constraints:
+            self._execute(f'ALTER TABLE {table_name} DROP CONSTRAINT {constraint_name}')
+        for table_name, trigger_names in TRIGGERS.items():
+            for trigger_name in trigger_names:
+                self._execute(f'ALTER TABLE {table_name} DISABLE TRIGGER {trigger_name}')
+        if self.unlogged:
+            for table_name in self._storage_tables():
+                self._execute(f'ALTER TABLE {table_name} SET UNLOGGED')
+        logging.info(f'Bulk load: dropped {len(self.constraints)} constraints')
+
+    def validate(self):
+        violations = {}
+        for name, q in VALIDATIONS.items():
+            self._execute(q)
+            rows = self.cursor.fetchall()
+            if rows:
+                violations[name] = rows
+                logging.error(f'Bulk load: {len(rows)} {name}')
+                for row in rows[:self.max_reported_rows]:
+                    logging.error(f'    {row}')
+        return violations
+
+    def restore(self, cursor=None):
+        # A cursor of another connection may be given, e.g. when the one of the
+        # load is in a failed transaction
+        if cursor is not None:
+            self.cursor = cursor
+        self._execute('''
+            UPDATE device_rent SET end_timestamp = begin_timestamp + interval '1 month'
+            WHERE end_timestamp IS NULL
+        ''')
+        violations = self.validate()
+        if self.unlogged:
+            for table_name in self._storage_tables():
+                self._execute(f'ALTER TABLE {table_name} SET LOGGED')
+        for table_name, trigger_names in TRIGGERS.items():
+            for trigger_name in trigger_names:
+                self._execute(f'ALTER TABLE {table_name} ENABLE TRIGGER {trigger_name}')
+        # Checks are added back NOT VALID (already validated above), foreign keys
+        # are validated in one pass each. Partitioned tables do not support NOT
+        # VALID foreign keys, so theirs are validated as they are added.
+        self._execute('SELECT relname FROM pg_class WHERE oid = ANY(%s::regclass[]) AND relkind = %s', (self.table_names, 'p'))
+        partitioned_tables = {table_name for table_name, in self.cursor.fetchall()}
+        for table_name, constraint_name, constraint_type, definition in self.constraints:
+            is_partitioned = constraint_type == 'f' and table_name in partitioned_tables
+            if not is_partitioned:
+                self._execute(f'ALTER TABLE {table_name} ADD CONSTRAINT {constraint_name} {definition} NOT VALID')
+            if constraint_type != 'f':
+                continue
+            self._execute('SAVEPOINT bulk_load_validate')
+            try:
+                if is_partitioned:
+                    self._execute(f'ALTER TABLE {table_name} ADD CONSTRAINT {constraint_name} {definition}')
+                else:
+                    self._execute(f'ALTER TABLE {table_name} VALIDATE CONSTRAINT {constraint_name}')
+            except psycopg2.Error as e:
+                self._execute('ROLLBACK TO SAVEPOINT bulk_load_validate')
+                violations[constraint_name] = str(e)
+                logging.error(f'Bulk load: {constraint_name} is violated: {e}')
+            else:
+                self._execute('RELEASE SAVEPOINT bulk_load_validate')
+        return violations
@@ -1,21 +1,29 @@
 import logging
-import random
-from hashlib import md5
+import math
 from datetime import datetime, timedelta
-import csv
 import re
 import numpy as np
-from numpy.random.mtrand import rand
 from models import *
 from decimal import *
-import yaml
-import scipy.stats as stats
 from distributions import *
+from data_sources import data_sources
 from dateutil.relativedelta import relativedelta
 from itertools import product
+from collections import namedtuple
+import heapq
+from array import array
+from model import batches, select_server_side
 
 
-default_datetime_distr = DateTimeDistribution(datetime(2016, 3, 5))
+_default_datetime_distr = None
+
+
+def get_default_datetime_distr():
+    # Built on first use and shared by all generators afterwards
+    global _default_datetime_distr
+    if _default_datetime_distr is None:
+        _default_datetime_distr = DateTimeDistribution(datetime(2016, 3, 5), buffer_size=4096)
+    return _default_datetime_distr
 
 CITIES = [
     'Москва', 'Санкт-Петербург', 'Казань', 'Краснодар', 'Нижний Новгород',
@@ -37,96 +45,136 @@ class NameGenerator:
         return last_name
 
     def __init__(self, male_first_names_filename, female_first_names_filename, last_names_filename):
-        self.first_names = {'m': [], 'f': []}
-        self.first_name_weights = {'m': [], 'f': []}
-        self.last_names = []
-        self.last_name_weights = []
+        first_names = {}
+        first_name_weights = {}
         for first_names_filename, sex in [
             (male_first_names_filename, 'm'),
             (female_first_names_filename, 'f')
         ]:
-            with open(first_names_filename, 'r') as first_names_file:
-                first_name_reader = csv.DictReader(first_names_file, delimiter=';')
-                for first_name_data in first_name_reader:
-                    first_name = first_name_data['Name'].split(', ')[0]
-                    weight = int(first_name_data['Frequency'])
-                    self.first_names[sex].append(first_name)
-                    self.first_name_weights[sex].append(weight)
-        with open(last_names_filename, 'r') as last_names_file:
-            last_name_reader = csv.DictReader(last_names_file, delimiter=';')
-            for last_name_data in last_name_reader:
-                last_name = last_name_data['LastName']
-                weight = float(last_name_data['Weight'].replace(',', '.'))
-                self.last_names.append(last_name)
-                self.last_name_weights.append(weight)
+            first_names[sex], first_name_weights[sex] = data_sources.names(first_names_filename, 'Name', 'Frequency')
+        last_names, last_name_weights = data_sources.names(last_names_filename, 'LastName', 'Weight')
+        # Names are sampled by bisecting precomputed cumulative weights, and feminine
+        # last names are derived once per surname
+        self.first_names = first_names
+        self.first_name_cum_weights = {sex: np.cumsum(weights, dtype=float) for sex, weights in first_name_weights.items()}
+        self.last_names = {
+            'm': last_names,
+            'f': np.array([self._feminize_last_name(last_name) for last_name in last_names.tolist()]),
+        }
+        self.last_name_cum_weights = np.cumsum(last_name_weights, dtype=float)
+
+    @staticmethod
+    def _sample(names, cum_weights, count):
+        u = get_rng().random(count) * cum_weights[-1]
+        return names[np.searchsorted(cum_weights, u, side='right')]
+
+    def columns(self, sex, count):
+        first_names = self._sample(self.first_names[sex], self.first_name_cum_weights[sex], count)
+        last_names = self._sample(self.last_names[sex], self.last_name_cum_weights, count)
+        return first_names, last_names
 
     def __call__(self, sex, count=None):
         is_bulk = True
         if count is None:
             is_bulk = False
             count = 1
-        first_names = random.choices(
-            population=self.first_names[sex],
-            weights=self.first_name_weights[sex],
-            k=count
-        )
-        last_names = random.choices(
-            population=self.last_names,
-            weights=self.last_name_weights,
-            k=count
-        )
-        if sex == 'f':
-            last_names = map(self._feminize_last_name, last_names)
-        names = zip(first_names, last_names)
+        first_names, last_names = self.columns(sex, count)
+        names = zip(first_names.tolist(), last_names.tolist())
         return names if is_bulk else next(names)
 
 
 class PhoneGenerator:
+    _TEMPLATE = '+7 (000) 000-00-00'
+    _DIGIT_POSITIONS = [4, 5, 6, 9, 10, 11, 13, 14, 16, 17]
+    # The 10-digit numbers 100-000-00-00...999-999-99-99
+    _FIRST_NUMBER = 10 ** 9
+    _NUMBER_COUNT = 9 * 10 ** 9
+
+    def numbers(self, count):
+        # Unique phones are drawn without replacement
+        return get_rng().choice(self._NUMBER_COUNT, size=count, replace=False) + self._FIRST_NUMBER
+
+    def number_permutation(self):
+        # Returns a function mapping positions to numbers by a random affine
+        # permutation i -> (a * i + b) mod the number count, so unique numbers can
+        # be taken a range of positions at a time. a is below 2 ** 30, so a * i
+        # fits in 64 bits.
+        rng = get_rng()
+        a = 0
+        while math.gcd(a, self._NUMBER_COUNT) != 1:
+            a = int(rng.integers(1, 2 ** 30))
+        b = int(rng.integers(self._NUMBER_COUNT))
+
+        def numbers(positions):
+            positions = np.asarray(positions, dtype=np.uint64)
+            permuted = (np.uint64(a) * positions + np.uint64(b)) % np.uint64(self._NUMBER_COUNT)
+            return permuted.astype(np.int64) + self._FIRST_NUMBER
+        return numbers
+
+    def render(self, numbers):
+        # Renders phone numbers into the template in bulk
+        chars = np.tile(np.frombuffer(self._TEMPLATE.encode(), dtype=np.uint8), (len(numbers), 1))
+        for i, position in enumerate(self._DIGIT_POSITIONS):
+            chars[:, position] = ord('0') + numbers // 10 ** (9 - i) % 10
+        return chars.view(f'S{len(self._TEMPLATE)}').ravel().astype(str)
+
+    def columns(self, count):
+        return self.render(self.numbers(count))
+
     def __call__(self, count=None):
         is_bulk = True
         if count is None:
             is_bulk = False
             count = 1
-        pool = set()
-        while len(pool) < count:
-            a = random.randint(100, 999)
-            b = random.randint(0, 999)
-            c = random.randint(0, 99)
-            d = random.randint(0, 99)
-            pool.add(f'+7 ({a:03d}) {b:03d}-{c:02d}-{d:02d}')
-        return pool if is_bulk else next(iter(pool))
+        pool = self.columns(count).tolist()
+        return set(pool) if is_bulk else pool[0]
 
 
 default_phone_generator = PhoneGenerator()
 
 
 class CustomerGenerator:
-    def __call__(self, name_generator,
-            count=None,
+    def __init__(self, name_generator,
             phone_generator=default_phone_generator,
-            datetime_distr=default_datetime_distr
+            datetime_distr=None
         ):
+        self.name_generator = name_generator
+        self.phone_generator = phone_generator
+        self.datetime_distr = datetime_distr if datetime_distr is not None else get_default_datetime_distr()
+
+    def columns(self, count, phone_numbers=None):
+        rng = get_rng()
+        male_count = int(rng.binomial(count, 0.5))
+        male_first_names, male_last_names = self.name_generator.columns('m', male_count)
+        female_first_names, female_last_names = self.name_generator.columns('f', count - male_count)
+        order = rng.permutation(count)
+        # Passwords are random, so their MD5 hashes are uniformly random 128-bit values
+        password_md5s = np.frombuffer(rng.bytes(16 * count).hex().encode(), dtype='S32').astype(str)
+        return {
+            'first_name': np.concatenate([male_first_names, female_first_names])[order],
+            'last_name': np.concatenate([male_last_names, female_last_names])[order],
+            'password_md5': password_md5s,
+            'phone': self.phone_generator.columns(count) if phone_numbers is None \
+                else self.phone_generator.render(phone_numbers),
+            'registration_timestamp': self.datetime_distr.rvs(count),
+        }
+
+    def column_chunks(self, count, chunk_size):
+        # Yields the columns of count customers in chunks. Phone numbers are unique
+        # across all chunks, as every chunk takes the next positions of one
+        # permutation of the numbers.
+        phone_numbers = self.phone_generator.number_permutation()
+        for begin in range(0, count, chunk_size):
+            end = min(count, begin + chunk_size)
+            yield self.columns(end - begin, phone_numbers(np.arange(begin, end)))
+
+    def __call__(self, count=None):
         is_bulk = True
         if count is None:
             is_bulk = False
             count = 1
-        male_count = sum(np.random.binomial(1, 0.5, count))
-        female_count = count - male_count
-        male_names = list(name_generator('m', male_count))
-        female_names = list(name_generator('f', female_count))
-        names = male_names + female_names
-        random.shuffle(names)
-        phones = phone_generator(count)
-        pool = (
-            Customer(
-                first_name=name[0],
-                last_name=name[1],
-                password_md5=md5(random.randbytes(10)).hexdigest(),
-                phone=phone,
-                registration_timestamp=datetime_distr.rvs()
-            )
-            for name, phone in zip(names, phones)
-        )
+        columns = {field: column.tolist() for field, column in self.columns(count).items()}
+        pool = (Customer(**dict(zip(columns, values))) for values in zip(*columns.values()))
         return pool if is_bulk else next(pool)
 
 
@@ -135,174 +183,439 @@ class ManufacturerGenerator:
         self.data_filename = data_filename
     
     def __call__(self):
-        with open(self.data_filename, 'r') as data_file:
-            for name, kwargs in yaml.safe_load(data_file).items():
-                yield Manufacturer(name=name, **kwargs)
+        for name, kwargs in data_sources.yaml(self.data_filename).items():
+            yield Manufacturer(name=name, **kwargs)
 
 
 class DeviceModelGenerator:
     def __init__(self, data_filename):
         self.data_filename = data_filename
     
-    def __call__(self, cursor):
-        with open(self.data_filename, 'r') as data_file:
-            for kwargs in yaml.safe_load(data_file):
-                manufacturer = next(Manufacturer.select(cursor, {'name': kwargs['manufacturer_name']}))
-                device_model = DeviceModel(manufacturer_id=manufacturer.id, **kwargs)
-                device_model_image = DeviceModelImage(
+    def __call__(self, cursor, manufacturer_ids=None):
+        # Manufacturer ids are looked up by name unless a mapping of names to ids is
+        # given
+        for kwargs in data_sources.yaml(self.data_filename):
+            if manufacturer_ids is None:
+                manufacturer_id = Manufacturer.get(cursor, name=kwargs['manufacturer_name']).id
+            else:
+                manufacturer_id = manufacturer_ids[kwargs['manufacturer_name']]
+            device_model = DeviceModel(manufacturer_id=manufacturer_id, **kwargs)
+            device_model_image = DeviceModelImage(
+                device_model=device_model,
+                image_url=kwargs['image_url']
+            )
+            device_model_properties = []
+            for k, v in kwargs['properties'].items():
+                device_model_properties.append(DeviceModelProperty(
                     device_model=device_model,
-                    image_url=kwargs['image_url']
-                )
-                device_model_properties = []
-                for k, v in kwargs['properties'].items():
-                    device_model_properties.append(DeviceModelProperty(
-                        device_model=device_model,
-                        key=k,
-                        value=v
-                    ))
-                yield device_model, device_model_image, device_model_properties
+                    key=k,
+                    value=v
+                ))
+            yield device_model, device_model_image, device_model_properties
 
 
 class DeviceGenerator:
-    def __call__(self, cursor, count=None, datetime_distr=default_datetime_distr):
+    def __call__(self, cursor, count=None, datetime_distr=None, device_model_ids=None):
         if count is None:
-            return next(self(cursor, count))
-        device_models = list(DeviceModel.select(cursor))
-        k = len(device_models)
-        marks = [0] + sorted(np.random.randint(low=0, high=count, size=k-1)) + [count]
+            return next(self(cursor, count, datetime_distr, device_model_ids))
+        if datetime_distr is None:
+            datetime_distr = get_default_datetime_distr()
+        rng = get_rng()
+        python_rng = get_random()
+        if device_model_ids is None:
+            device_model_ids = [device_model.id for device_model in DeviceModel.select_all(cursor)]
+        k = len(device_model_ids)
+        marks = [0] + sorted(rng.integers(low=0, high=count, size=k-1).tolist()) + [count]
         model_counts = [b - a for a, b in zip(marks[:-1], marks[1:])]
         purchases = int(count / 10)
         initial_purchases = int(np.ceil(purchases / 2))
         additional_purchases = purchases - initial_purchases
         purchase_timestamps = [datetime_distr.a] * initial_purchases + \
-            [datetime_distr.rvs() for _ in range(additional_purchases)]
-        for device_model, count in zip(device_models, model_counts):
+            datetime_distr.rvs(additional_purchases).tolist()
+        for device_model_id, count in zip(device_model_ids, model_counts):
             for i in range(count):
-                purchase_timestamp = random.choice(purchase_timestamps)
-                duration = timedelta(days=np.random.normal(10, 3) * 365)
+                purchase_timestamp = python_rng.choice(purchase_timestamps)
+                duration = timedelta(days=rng.normal(10, 3) * 365)
                 retirement_timestamp = purchase_timestamp + duration
                 if retirement_timestamp > datetime.now():
                     retirement_timestamp = None
                 years = datetime.now().year - purchase_timestamp.year
-                condition = max(1, 10 - int(sum(random.uniform(0.2, 2) for _ in range(years))))
+                condition = max(1, 10 - int(sum(python_rng.uniform(0.2, 2) for _ in range(years))))
                 yield Device(
-                    model_id=device_model.id,
+                    model_id=device_model_id,
                     purchase_timestamp=purchase_timestamp,
                     retirement_timestamp=retirement_timestamp,
                     condition=condition,
                 )
 
 
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_NEVER = np.iinfo(np.int64).max
+
+DEVICE_COLUMNS = ['id', 'model_id', 'purchase_timestamp', 'retirement_timestamp']
+
+
+def _microseconds(dt):
+    return (dt - _EPOCH) // _MICROSECOND
+
+def _microseconds_column(values, missing=_NEVER):
+    # Converts datetimes to microseconds since the epoch, None to missing
+    values = np.asarray(values, dtype='datetime64[us]')
+    return np.where(np.isnat(values), missing, values.astype(np.int64))
+
+def _compact_ids(ids):
+    ids = np.asarray(ids, dtype=np.int64)
+    return ids.astype(np.int32) if ids.size and ids.max() <= np.iinfo(np.int32).max else ids
+
+
+class _Pool:
+    # Set of device indexes with O(1) insertion, removal and uniform sampling. Pools
+    # whose members are disjoint may share one array of positions of their members.
+    def __init__(self, positions):
+        self.items = array('q')
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        position = self.positions[item]
+        return position < len(self.items) and self.items[position] == item
+
+    def add(self, item):
+        self.positions[item] = len(self.items)
+        self.items.append(item)
+
+    def remove(self, item):
+        position = self.positions[item]
+        last = self.items.pop()
+        if last != item:
+            self.items[position] = last
+            self.positions[last] = position
+
+    def sample(self):
+        return get_random().choice(self.items)
+
+
+class DeviceIndex:
+    # Columns of the devices needed for the timeline, with timestamps in
+    # microseconds since the epoch and devices never retired retiring at _NEVER
+    def __init__(self, ids, model_ids, purchase_timestamps, retirement_timestamps):
+        self.ids = _compact_ids(ids)
+        self.model_ids = _compact_ids(model_ids)
+        self.purchase_timestamps = np.asarray(purchase_timestamps, dtype=np.int64)
+        self.retirement_timestamps = np.asarray(retirement_timestamps, dtype=np.int64)
+
+    @classmethod
+    def from_devices(cls, devices, chunk_size=100000):
+        # Reads Device entities in chunks, so they need not all be in memory at once
+        chunks = [
+            (
+                [device.id for device in chunk],
+                [device.model_id for device in chunk],
+                _microseconds_column([device.purchase_timestamp for device in chunk]),
+                _microseconds_column([device.retirement_timestamp for device in chunk]),
+            )
+            for chunk in batches(devices, chunk_size)
+        ]
+        if not chunks:
+            return cls([], [], [], [])
+        return cls(*map(np.concatenate, zip(*chunks)))
+
+    @classmethod
+    def select(cls, cursor):
+        return cls.from_devices(Device.select(cursor, columns=DEVICE_COLUMNS, itersize=10000))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def positions(self, ids):
+        # Positions of the devices with the given ids, -1 for the unknown ones
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(self) or not ids.size:
+            return np.full(ids.shape, -1, dtype=np.int64)
+        order = np.argsort(self.ids, kind='stable')
+        positions = order[np.minimum(np.searchsorted(self.ids, ids, sorter=order), len(order) - 1)]
+        return np.where(self.ids[positions] == ids, positions, -1)
+
+    def take(self, indexes):
+        return DeviceIndex(
+            self.ids[indexes], self.model_ids[indexes],
+            self.purchase_timestamps[indexes], self.retirement_timestamps[indexes],
+        )
+
+
+class DeviceAvailability:
+    # Devices, referred to by their position in a DeviceIndex, enter the pools of
+    # their models once purchased and leave them while owned or repaired. Pending
+    # purchases and returns are kept ordered by time, so advancing the clock only
+    # touches the devices whose state actually changes.
+    def __init__(self, devices, max_attempts=16):
+        self.max_attempts = max_attempts
+        self.ids = array('q', devices.ids.astype(np.int64).tobytes())
+        self.model_ids = array('q', devices.model_ids.astype(np.int64).tobytes())
+        self.purchase_timestamps = array('q', devices.purchase_timestamps.tobytes())
+        self.retirement_timestamps = array('q', devices.retirement_timestamps.tobytes())
+        self.purchases = array('q', np.argsort(devices.purchase_timestamps, kind='stable').tobytes())
+        self.next_purchase = 0
+        self.returns = []
+        self.clock = None
+        self.devices = _Pool(array('q', bytes(8 * len(devices))))
+        model_positions = array('q', bytes(8 * len(devices)))
+        self.model_devices = {model_id: _Pool(model_positions) for model_id in set(self.model_ids)}
+
+    def _add(self, device):
+        self.devices.add(device)
+        self.model_devices[self.model_ids[device]].add(device)
+
+    def remove(self, device):
+        self.devices.remove(device)
+        self.model_devices[self.model_ids[device]].remove(device)
+
+    def advance(self, clock):
+        self.clock = _microseconds(clock)
+        while self.next_purchase < len(self.purchases) and \
+                self.purchase_timestamps[self.purchases[self.next_purchase]] < self.clock:
+            self._add(self.purchases[self.next_purchase])
+            self.next_purchase += 1
+        while self.returns and self.returns[0][0] <= self.clock:
+            self._add(heapq.heappop(self.returns)[1])
+
+    def hold(self, device, return_datetime=None):
+        # Takes a device that is out at the current clock from the pools, until it
+        # returns if that is known
+        if device in self.devices:
+            self.remove(device)
+        if return_datetime is not None:
+            self.schedule_return(device, return_datetime)
+
+    def schedule_return(self, device, return_datetime):
+        heapq.heappush(self.returns, (_microseconds(return_datetime), device))
+
+    def _is_usable(self, device, begin, end):
+        return self.purchase_timestamps[device] < begin and end < self.retirement_timestamps[device]
+
+    def choose(self, begin_datetime, end_datetime, model_id=None):
+        begin, end = _microseconds(begin_datetime), _microseconds(end_datetime)
+        pool = self.devices if model_id is None else self.model_devices.get(model_id, ())
+        for _ in range(self.max_attempts):
+            if not pool:
+                return None
+            device = pool.sample()
+            if self._is_usable(device, begin, end):
+                return device
+            if self.retirement_timestamps[device] <= self.clock:
+                self.remove(device)
+        usable_devices = [d for d in pool.items if self._is_usable(d, begin, end)]
+        return get_random().choice(usable_devices) if usable_devices else None
+
+
+class CustomerIndex:
+    # Customer ids ordered by registration time, for sampling customers that were
+    # registered before a given moment
+    def __init__(self, ids, registration_timestamps):
+        registration_timestamps = np.asarray(registration_timestamps, dtype='datetime64[us]')
+        order = np.argsort(registration_timestamps, kind='stable')
+        self.ids = _compact_ids(ids)[order]
+        self.registration_timestamps = registration_timestamps[order]
+
+    @classmethod
+    def select(cls, cursor, chunk_size=100000):
+        # Customers are read in chunks, so they need not all be in memory at once
+        ids = []
+        registration_timestamps = []
+        customers = Customer.select(
+            cursor,
+            {'registration_timestamp__ne': None},
+            columns=['id', 'registration_timestamp'],
+            itersize=10000,
+        )
+        for chunk in batches(customers, chunk_size):
+            ids.append(_compact_ids([customer.id for customer in chunk]))
+            registration_timestamps.append(np.array(
+                [customer.registration_timestamp for customer in chunk], dtype='datetime64[us]',
+            ))
+        if not ids:
+            return cls([], [])
+        return cls(np.concatenate(ids), np.concatenate(registration_timestamps))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def sample_registered_before(self, ts):
+        count = int(np.searchsorted(self.registration_timestamps, np.datetime64(ts, 'us')))
+        return self.ids[get_random().randrange(count)].item() if count else None
+
+
+OpenChain = namedtuple('OpenChain', [
+    'device_ownership_id', 'device_id', 'return_status',
+    'device_rent_id', 'chain_id', 'chain_position', 'customer_id', 'device_model_id', 'is_insured', 'end_timestamp',
+])
+
+
+class TimelineState:
+    # Where the timeline in the database ends, read once for continuing it: the
+    # moment its generation stopped at, the rent chains whose device is still out
+    # (their last rent and their open ownership), the devices still in repair and
+    # the last ids of the rows written so far
+    def __init__(self, since, open_chains, repairs, device_rent_id, device_repair_id, rents_per_day):
+        self.since = since
+        self.open_chains = open_chains
+        self.repairs = repairs
+        self.device_rent_id = device_rent_id
+        self.device_repair_id = device_repair_id
+        self.rents_per_day = rents_per_day
+        self.closed_ownerships = []
+
+    @classmethod
+    def select(cls, cursor):
+        logging.info('Fetching the end of the timeline...')
+        # Nothing was generated past the latest begin of a rent or an ownership, and
+        # closed ownerships end before it
+        cursor.execute('''
+            SELECT GREATEST(
+                (SELECT MAX(begin_timestamp) FROM device_rent),
+                (SELECT MAX(end_timestamp) FROM device_ownership),
+                (SELECT MAX(begin_timestamp) FROM device_ownership WHERE end_timestamp IS NULL)
+            ),
+            (SELECT COALESCE(MAX(id), 0) FROM device_rent),
+            (SELECT COALESCE(MAX(id), 0) FROM device_repair)
+        ''')
+        since, device_rent_id, device_repair_id = cursor.fetchone()
+        if since is None:
+            raise ValueError('There is no timeline to continue')
+        # Rents of the last year, which were all generated, give the rate of rents
+        cursor.execute('''
+            SELECT COUNT(*), MIN(begin_timestamp) FROM device_rent WHERE begin_timestamp > %s - interval '1 year'
+        ''', (since, ))
+        count, first_begin_timestamp = cursor.fetchone()
+        rents_per_day = count / max(1, (since - first_begin_timestamp).days) if count else 0
+        cursor.execute('''
+            SELECT
+                device_ownership.id, device_ownership.device_id, device_ownership.return_status::text,
+                device_rent.id, device_rent.chain_id, device_rent.chain_position, device_rent.customer_id,
+                device_rent.device_model_id, device_rent.is_insured, device_rent.end_timestamp
+            FROM device_ownership
+            JOIN LATERAL (
+                SELECT device_rent.* FROM device_rent_ownership
+                JOIN device_rent ON device_rent.id = device_rent_ownership.device_rent_id
+                WHERE device_rent_ownership.device_ownership_id = device_ownership.id
+                ORDER BY device_rent.chain_position DESC
+                LIMIT 1
+            ) AS device_rent ON TRUE
+            WHERE device_ownership.end_timestamp IS NULL AND device_ownership.device_id IS NOT NULL
+            ORDER BY device_rent.end_timestamp
+        ''')
+        open_chains = [OpenChain(*row) for row in cursor.fetchall()]
+        cursor.execute('''
+            SELECT device_ownership.device_id, MAX(device_repair.end_timestamp) FROM device_repair
+            JOIN device_ownership ON device_ownership.id = device_repair.device_ownership_id
+            WHERE device_repair.end_timestamp > %s AND device_ownership.device_id IS NOT NULL
+            GROUP BY device_ownership.device_id
+        ''', (since, ))
+        repairs = cursor.fetchall()
+        logging.info(f'The timeline ends at {since} with {len(open_chains)} open rent chains')
+        return cls(since, open_chains, repairs, device_rent_id, device_repair_id, rents_per_day)
+
+
 class TimelineGenerator:
+    @staticmethod
+    def _months_counts(rent_count, months_count_distr, rng):
+        # Lengths of rent chains adding up to rent_count
+        months_counts = []
+        c = 0
+        while c < rent_count:
+            for months_count in months_count_distr.rvs(size=rent_count // 2 + 1, random_state=rng).tolist():
+                months_counts.append(months_count)
+                c += months_count
+                if c >= rent_count:
+                    break
+        if months_counts:
+            months_counts[-1] -= (c - rent_count)
+        return months_counts
+
+    def _rent_chains(self, rent_count, datetime_distr, months_count_distr, rng, window_size):
+        # Yields the begin and the length of every rent chain in time order
+        for window_distr, window_rent_count in datetime_distr.windows(rent_count, window_size):
+            months_counts = self._months_counts(window_rent_count, months_count_distr, rng)
+            yield from zip(np.sort(window_distr.rvs(len(months_counts))).tolist(), months_counts)
+
     def __call__(self, cursor,
             rent_count=None,
-            datetime_distr=default_datetime_distr,
-            months_count_distr=stats.geom(0.5),
+            datetime_distr=None,
+            months_count_distr=None,
             insurance_p=1/20,
             breakage_p=1/150,
-            delay_distr=TimeDeltaDistribution(timedelta(days=0.5), timedelta(days=0.5)),
-            repair_duration_distr=TimeDeltaDistribution(timedelta(days=10), timedelta(days=5)),
-            repair_price_distr=PriceDistribution(10000, 2000),
-            cities=CITIES
+            delay_distr=None,
+            repair_duration_distr=None,
+            repair_price_distr=None,
+            cities=CITIES,
+            customers=None,
+            devices=None,
+            window_size=100000,
+            until=None,
+            state=None,
         ):
+        # Rents are generated in time order, one window of about window_size rents at
+        # a time. Customers and devices are held in compact indexes. Nothing happens
+        # after until (now by default). Given a TimelineState, the timeline in the
+        # database is continued: its open rent chains first, then new chains
+        # beginning after it.
         if rent_count is None:
             return next(self(cursor, rent_count))
-        months_counts = []
-        c = 0
-        while c < rent_count:
-            months_count = months_count_distr.rvs()
-            months_counts.append(months_count)
-            c += months_count
-        months_counts[-1] -= (c - rent_count)
-        rent_begin_datetimes = sorted(datetime_distr.rvs() for _ in range(len(months_counts)))
-        customers = list(Customer.select(cursor))
-        available_devices = list(Device.select(cursor))
-        device_return_datetimes = {}
-        for rent_begin_datetime, months_count in zip(rent_begin_datetimes, months_counts):
-            # --- Make returned devices available again ---
-            for device in list(device_return_datetimes.keys()):
-                return_datetime = device_return_datetimes[device]
-                if return_datetime <= rent_begin_datetime:
-                    available_devices.append(device)
-                    del device_return_datetimes[device]
+        if until is None:
+            until = datetime.now()
+        if datetime_distr is None:
+            datetime_distr = get_default_datetime_distr() if state is None else DateTimeDistribution(state.since, until)
+        if months_count_distr is None:
+            import scipy.stats as stats
+            months_count_distr = stats.geom(0.5)
+        if delay_distr is None:
+            delay_distr = TimeDeltaDistribution(timedelta(days=0.5), timedelta(days=0.5), buffer_size=4096)
+        if repair_duration_distr is None:
+            repair_duration_distr = TimeDeltaDistribution(timedelta(days=10), timedelta(days=5), buffer_size=1024)
+        if repair_price_distr is None:
+            repair_price_distr = PriceDistribution(10000, 2000, buffer_size=1024)
+        rng = get_rng()
+        python_rng = get_random()
+        if customers is None:
+            customers = CustomerIndex.select(cursor)
+        if devices is None:
+            devices = DeviceIndex.select(cursor)
+        elif not isinstance(devices, DeviceIndex):
+            devices = DeviceIndex.from_devices(devices)
+        availability = DeviceAvailability(devices)
 
-            # --- Choose a customer and a device kind ---
-            is_insured = bool(stats.bernoulli.rvs(insurance_p))
-            actual_customers = [c for c in customers if c.registration_timestamp < rent_begin_datetime]
-            try:
-                customer = random.choice(actual_customers)
-            except:
-                logging.error('Failed to choose a valid customer')
-                continue
-            rents_end_datetime = rent_begin_datetime + relativedelta(months=months_count)
-            try:
-                actual_devices = [
-                    d for d in available_devices
-                    if d.purchase_timestamp < rent_begin_datetime and
-                        (d.retirement_timestamp is None or rents_end_datetime < d.retirement_timestamp)
-                ]
-                device_model_id = random.choice(actual_devices).model_id
-            except:
-                logging.error('No devices available')
-                continue
-
-            # --- Generate device rents ---
-            device_rents = []
-            device_rent = None
-            for i in range(months_count):
-                if rent_begin_datetime > datetime.now():
-                    break
-                rent_end_datetime = rent_begin_datetime + relativedelta(months=1)
-                device_rent = DeviceRent(
-                    customer_id=customer.id,
-                    device_model_id=device_model_id,
-                    begin_timestamp=rent_begin_datetime,
-                    end_timestamp=rent_end_datetime,
-                    previous_device_rent=device_rent,
-                    is_insured=is_insured,
-                )
-                device_rents.append(device_rent)
-                rent_begin_datetime = rent_end_datetime
-
-            # --- Generate device ownerships and repairs ---
+        def ownerships(device_model_id, ownership_begin_datetime, ownerships_end_datetime, breakage_datetimes):
+            # Ownerships of devices of the model one after another, ending at every
+            # breakage and, the last one, at ownerships_end_datetime
             device_ownerships = []
             device_repairs = []
-            ownership_begin_datetime = device_rents[0].begin_timestamp
-            ownerships_end_datetime = device_rents[-1].end_timestamp - delay_distr.rvs()
-            breakages = stats.poisson(breakage_p * months_count).rvs()
-            breakage_datetime_distr = DateTimeDistribution(ownership_begin_datetime, ownerships_end_datetime)
-            breakage_datetimes = sorted(breakage_datetime_distr.rvs() for _ in range(breakages))
             for ownership_end_datetime in breakage_datetimes + [ownerships_end_datetime]:
                 ownership_begin_datetime += delay_distr.rvs()
                 if ownership_begin_datetime > ownership_end_datetime:
                     ownership_begin_datetime, ownership_end_datetime = ownership_end_datetime, ownership_begin_datetime
-                try:
-                    actual_devices = [
-                        d for d in available_devices
-                        if d.purchase_timestamp < ownership_begin_datetime and
-                            (d.retirement_timestamp is None or ownership_end_datetime < d.retirement_timestamp) and
-                            d.model_id == device_model_id
-                    ]
-                    device = random.choice(actual_devices)
-                except:
+                device = availability.choose(ownership_begin_datetime, ownership_end_datetime, device_model_id)
+                if device is None:
                     logging.error('No device of a needed model')
                     break
-                available_devices.remove(device)
+                availability.remove(device)
                 if ownership_end_datetime == ownerships_end_datetime:
                     return_status = 'period_expired'
-                    device_return_datetimes[device] = ownership_end_datetime
+                    availability.schedule_return(device, ownership_end_datetime)
                 else:
                     return_status = 'breakage'
                     repair_begin_datetime = ownership_end_datetime + delay_distr.rvs()
                     repair_end_datetime = repair_begin_datetime + repair_duration_distr.rvs()
-                    device_return_datetimes[device] = repair_end_datetime
-                if ownership_end_datetime > datetime.now():
+                    availability.schedule_return(device, repair_end_datetime)
+                if ownership_end_datetime > until:
                     ownership_end_datetime = None
                 device_ownership = DeviceOwnership(
-                    device_id=device.id,
+                    device_id=availability.ids[device],
                     begin_timestamp=ownership_begin_datetime,
                     end_timestamp=ownership_end_datetime,
-                    city=random.choice(cities),
+                    city=python_rng.choice(cities),
                     return_status=return_status,
                 )
                 device_ownerships.append(device_ownership)
@@ -316,7 +629,65 @@ class TimelineGenerator:
                 if ownership_end_datetime is None:
                     break
                 ownership_begin_datetime = ownership_end_datetime
-            
+            return device_ownerships, device_repairs
+
+        if state is not None:
+            yield from self._continue_chains(
+                state, until, devices, availability, months_count_distr, delay_distr, rng, ownerships,
+                repair_duration_distr, repair_price_distr,
+            )
+
+        rent_chains = self._rent_chains(rent_count, datetime_distr, months_count_distr, rng, window_size)
+        for rent_begin_datetime, months_count in rent_chains:
+            # --- Make purchased and returned devices available ---
+            availability.advance(rent_begin_datetime)
+
+            # --- Choose a customer and a device kind ---
+            is_insured = bool(rng.random() < insurance_p)
+            customer_id = customers.sample_registered_before(rent_begin_datetime)
+            if customer_id is None:
+                logging.error('Failed to choose a valid customer')
+                continue
+            rents_end_datetime = rent_begin_datetime + relativedelta(months=months_count)
+            device = availability.choose(rent_begin_datetime, rents_end_datetime)
+            if device is None:
+                logging.error('No devices available')
+                continue
+            device_model_id = availability.model_ids[device]
+
+            # --- Generate device rents ---
+            device_rents = []
+            device_rent = None
+            for i in range(months_count):
+                if rent_begin_datetime > until:
+                    break
+                rent_end_datetime = rent_begin_datetime + relativedelta(months=1)
+                device_rent = DeviceRent(
+                    customer_id=customer_id,
+                    device_model_id=device_model_id,
+                    begin_timestamp=rent_begin_datetime,
+                    end_timestamp=rent_end_datetime,
+                    previous_device_rent=device_rent,
+                    is_insured=is_insured,
+                    chain_position=i,
+                )
+                device_rents.append(device_rent)
+                rent_begin_datetime = rent_end_datetime
+            for device_rent in device_rents:
+                device_rent.chain_id = device_rents[0].id
+
+            # --- Generate device ownerships and repairs ---
+            ownership_begin_datetime = device_rents[0].begin_timestamp
+            ownerships_end_datetime = device_rents[-1].end_timestamp - delay_distr.rvs()
+            breakages = rng.poisson(breakage_p * months_count)
+            breakage_datetimes = []
+            if breakages:
+                breakage_datetime_distr = DateTimeDistribution(ownership_begin_datetime, ownerships_end_datetime)
+                breakage_datetimes = np.sort(breakage_datetime_distr.rvs(breakages)).tolist()
+            device_ownerships, device_repairs = ownerships(
+                device_model_id, ownership_begin_datetime, ownerships_end_datetime, breakage_datetimes,
+            )
+
             # --- Generate rent-ownership relations ---
             device_rents_ownerships = []
             for device_rent, device_ownership in product(device_rents, device_ownerships):
@@ -327,24 +698,122 @@ class TimelineGenerator:
 
             yield device_rents, device_ownerships, device_rents_ownerships, device_repairs
 
-            
-class DamageFineGenerator:
-    def __call__(self, cursor, fine=3000, customer_blame_probability=0.5):
-        device_repairs = list(DeviceRepair.select(cursor))
-        for device_repair in device_repairs:
-            if random.random() > customer_blame_probability:
-                continue
-            device_rent_id = next(DeviceRentOwnership.select(
-                cursor, {'device_ownership_id': device_repair.device_ownership_id}, limit=1
-            )).device_rent_id
-            device_rent = next(DeviceRent.select(cursor, {'id': device_rent_id}, limit=1))
-            if not device_rent.is_insured:
-                print(device_repair.price)
-                yield DamageFine(
-                    device_ownership_id=device_repair.device_ownership_id,
-                    fine=device_repair.price+fine,
-                    device_repair_id=device_repair.id,
+    def _continue_chains(self, state, until, devices, availability, months_count_distr, delay_distr, rng, ownerships,
+            repair_duration_distr, repair_price_distr):
+        # Rent chains whose device is still out are extended by a number of months
+        # drawn anew, which the geometric distribution of chain lengths allows. The
+        # open ownership of a chain ends with it, or at a breakage in the meantime if
+        # it was already known to end with one. Ownerships closed this way are
+        # collected in state.closed_ownerships, to be updated rather than inserted.
+        availability.advance(state.since)
+        repaired_devices = devices.positions([device_id for device_id, _ in state.repairs])
+        for device, (_, repair_end_datetime) in zip(repaired_devices.tolist(), state.repairs):
+            if device >= 0:
+                availability.hold(device, repair_end_datetime)
+        open_chain_devices = devices.positions([open_chain.device_id for open_chain in state.open_chains])
+        for device in open_chain_devices.tolist():
+            if device >= 0:
+                availability.hold(device)
+        earliest_end_datetime = state.since + timedelta(seconds=1)
+        extra_months = months_count_distr.rvs(size=len(state.open_chains), random_state=rng) - 1
+        for open_chain, device, months_count in zip(state.open_chains, open_chain_devices.tolist(), extra_months.tolist()):
+            # --- Generate device rents ---
+            device_rents = []
+            device_rent = None
+            rent_begin_datetime = open_chain.end_timestamp
+            for i in range(months_count):
+                if rent_begin_datetime > until:
+                    break
+                rent_end_datetime = rent_begin_datetime + relativedelta(months=1)
+                device_rent = DeviceRent(
+                    customer_id=open_chain.customer_id,
+                    device_model_id=open_chain.device_model_id,
+                    begin_timestamp=rent_begin_datetime,
+                    end_timestamp=rent_end_datetime,
+                    previous_device_rent=device_rent,
+                    previous_device_rent_id=open_chain.device_rent_id if device_rent is None else None,
+                    is_insured=open_chain.is_insured,
+                    chain_id=open_chain.chain_id,
+                    chain_position=open_chain.chain_position + i + 1,
                 )
+                device_rents.append(device_rent)
+                rent_begin_datetime = rent_end_datetime
+
+            # --- Close the open ownership and generate the following ones ---
+            ownerships_end_datetime = max(
+                open_chain.end_timestamp + relativedelta(months=months_count) - delay_distr.rvs(),
+                earliest_end_datetime,
+            )
+            open_ownership = DeviceOwnership(id=open_chain.device_ownership_id, end_timestamp=ownerships_end_datetime)
+            return_datetime = ownerships_end_datetime
+            device_ownerships = []
+            device_repairs = []
+            if open_chain.return_status == 'breakage':
+                open_ownership.end_timestamp = DateTimeDistribution(earliest_end_datetime, ownerships_end_datetime).rvs()
+                repair_begin_datetime = open_ownership.end_timestamp + delay_distr.rvs()
+                return_datetime = repair_begin_datetime + repair_duration_distr.rvs()
+            if device >= 0:
+                availability.schedule_return(device, return_datetime)
+            if open_ownership.end_timestamp <= until:
+                state.closed_ownerships.append(open_ownership)
+                if open_chain.return_status == 'breakage':
+                    device_repairs.append(DeviceRepair(
+                        device_ownership=open_ownership,
+                        begin_timestamp=repair_begin_datetime,
+                        end_timestamp=return_datetime,
+                        price=repair_price_distr.rvs(),
+                    ))
+                    device_ownerships, following_repairs = ownerships(
+                        open_chain.device_model_id, open_ownership.end_timestamp, ownerships_end_datetime, [],
+                    )
+                    device_repairs.extend(following_repairs)
+
+            # --- Generate rent-ownership relations ---
+            # Rents already written are not linked to the ownerships following the
+            # open one
+            device_rents_ownerships = []
+            for device_rent, device_ownership in product(device_rents, [open_ownership] + device_ownerships):
+                device_rents_ownerships.append(DeviceRentOwnership(
+                    device_rent=device_rent,
+                    device_ownership=device_ownership,
+                ))
+
+            yield device_rents, device_ownerships, device_rents_ownerships, device_repairs
+
+
+class DamageFineGenerator:
+    def __init__(self, fine=3000):
+        self.fine = fine
+
+    def __call__(self, cursor, customer_blame_probability=0.5, device_repairs=None, after_device_repair_id=0, chunk_size=10000):
+        # device_repairs are (id, device_ownership_id, price) of repairs of devices
+        # in uninsured rents, streamed from the database unless given (those with
+        # ids above after_device_repair_id)
+        if device_repairs is None:
+            device_repairs = self._select_uninsured_repairs(cursor, after_device_repair_id, chunk_size)
+        for chunk in batches(device_repairs, chunk_size):
+            is_blamed = get_rng().random(len(chunk)) < customer_blame_probability
+            for (device_repair_id, device_ownership_id, price), is_blamed in zip(chunk, is_blamed.tolist()):
+                if is_blamed:
+                    yield DamageFine(
+                        device_ownership_id=device_ownership_id,
+                        fine=price+self.fine,
+                        device_repair_id=device_repair_id,
+                    )
+
+    @staticmethod
+    def _select_uninsured_repairs(cursor, after_device_repair_id=0, itersize=10000):
+        q = '''
+            SELECT device_repair.id, device_repair.device_ownership_id, device_repair.price::numeric
+            FROM device_repair
+            JOIN device_rent_ownership ON device_rent_ownership.device_ownership_id = device_repair.device_ownership_id
+            JOIN device_rent ON device_rent.id = device_rent_ownership.device_rent_id
+            WHERE device_repair.id > %s
+            GROUP BY device_repair.id
+            HAVING NOT bool_or(device_rent.is_insured);
+        '''
+        logging.info('Fetching uninsured device repairs...')
+        return select_server_side(cursor, q, (after_device_repair_id, ), itersize, 'device_repair')
 
 
 class DeviceModelRentPriceGenerator:
@@ -352,53 +821,94 @@ class DeviceModelRentPriceGenerator:
         self.data_filename = data_filename
     
     def __call__(self, cursor,
-            price_updates=stats.poisson(5, loc=5).rvs(),
+            price_updates=None,
             affected_devices=0.7,
-            delta_price_distr=PriceDistribution(100, 30),
-            datetime_distr=default_datetime_distr,
+            delta_price_distr=None,
+            datetime_distr=None,
+            device_model_ids=None,
         ):
-        price_change_timestamps = sorted(datetime_distr.rvs(price_updates))
-        with open(self.data_filename, 'r') as data_file:
-            for kwargs in yaml.safe_load(data_file):
-                if random.random() > affected_devices:
-                    continue
-                device_model = next(DeviceModel.select(cursor, {'name': kwargs['name']}, limit=1))
-                prices = [kwargs['rent_price']]
-                while len(prices) < price_updates:
-                    prices.insert(0, prices[0] - delta_price_distr.rvs())
-                for price_change_timestamp, price in zip(price_change_timestamps, prices):
-                    yield DeviceModelRentPrice(
-                        device_model_id=device_model.id,
-                        price=price,
-                        update_timestamp=price_change_timestamp,
-                    )
+        if price_updates is None:
+            price_updates = int(get_rng().poisson(5)) + 5
+        if delta_price_distr is None:
+            delta_price_distr = PriceDistribution(100, 30)
+        if datetime_distr is None:
+            datetime_distr = get_default_datetime_distr()
+        price_change_timestamps = np.sort(datetime_distr.rvs(price_updates)).tolist()
+        for kwargs in data_sources.yaml(self.data_filename):
+            if get_random().random() > affected_devices:
+                continue
+            if device_model_ids is None:
+                device_model_id = DeviceModel.get(cursor, name=kwargs['name']).id
+            else:
+                device_model_id = device_model_ids[kwargs['name']]
+            prices = [kwargs['rent_price']]
+            while len(prices) < price_updates:
+                prices.insert(0, prices[0] - delta_price_distr.rvs())
+            for price_change_timestamp, price in zip(price_change_timestamps, prices):
+                yield DeviceModelRentPrice(
+                    device_model_id=device_model_id,
+                    price=price,
+                    update_timestamp=price_change_timestamp,
+                )
+
+
+STARS = [1, 2, 3, 4, 5]
+STARS_P = [0.15, 0.05, 0.10, 0.20, 0.50]
 
 
 class FeedbackGenerator:
     def __init__(self, data_filename):
-        with open(data_filename, 'r') as data_file:
-            self.messages = dict(yaml.safe_load(data_file).items())
+        self.messages = data_sources.yaml(data_filename)
 
     def __call__(self, cursor,
             feedback_p=0.8,
             message_p=0.1,
-            stars_distr=stats.rv_discrete(name='stars', values=([1, 2, 3, 4, 5], [0.15, 0.05, 0.10, 0.20, 0.50]))
+            stars_distr=None,
+            last_rents=None,
+            after_device_rent_id=None,
+            chunk_size=10000,
         ):
-        q = '''
-            SELECT id, end_timestamp FROM (
-                SELECT id, end_timestamp, (SELECT COUNT (*) FROM succeeding_device_rents(id)) AS c FROM device_rent
-            ) AS t WHERE c = 0;
-        '''
-        logging.info('Fetching last rent periods...')
-        cursor.execute(q)
-        device_rents_data = cursor.fetchall()
-        device_rents_data = set(random.choices(device_rents_data, k=int(len(device_rents_data) * feedback_p)))
-        for device_rent_data in device_rents_data:
-            device_rent_id, device_rent_end_datetime = device_rent_data
-            stars = stars_distr.rvs()
+        # last_rents are (id, end_timestamp) of the last rent of every chain,
+        # streamed from the database unless given. With after_device_rent_id, only
+        # chains with rents above it and no feedback yet are fetched.
+        if last_rents is None and after_device_rent_id is None:
+            q = '''
+                SELECT DISTINCT ON (chain_id) id, end_timestamp FROM device_rent
+                ORDER BY chain_id, chain_position DESC;
+            '''
+            logging.info('Fetching last rent periods...')
+            last_rents = select_server_side(cursor, q, None, chunk_size, 'device_rent')
+        elif last_rents is None:
+            q = '''
+                SELECT DISTINCT ON (device_rent.chain_id) device_rent.id, device_rent.end_timestamp FROM device_rent
+                WHERE device_rent.chain_id IN (SELECT chain_id FROM device_rent WHERE id > %s)
+                    AND NOT EXISTS (
+                        SELECT FROM device_rent AS chain_rent
+                        JOIN feedback ON feedback.device_rent_id = chain_rent.id
+                        WHERE chain_rent.chain_id = device_rent.chain_id
+                    )
+                ORDER BY device_rent.chain_id, device_rent.chain_position DESC;
+            '''
+            logging.info('Fetching last rent periods of new rents...')
+            last_rents = select_server_side(cursor, q, (after_device_rent_id, ), chunk_size, 'device_rent')
+        # Rents are sampled chunk by chunk, so only one chunk is held at a time
+        for chunk in batches(last_rents, chunk_size):
+            yield from self._feedbacks(chunk, feedback_p, message_p, stars_distr)
+
+    def _feedbacks(self, last_rents, feedback_p, message_p, stars_distr):
+        # Duplicates are dropped in the order drawn, as the order of a set of
+        # datetimes changes with the hash seed
+        python_rng = get_random()
+        device_rents_data = list(dict.fromkeys(python_rng.choices(last_rents, k=int(len(last_rents) * feedback_p))))
+        # Stars of all the feedbacks are drawn at once from the seeded generator
+        if stars_distr is None:
+            stars_column = get_rng().choice(STARS, size=len(device_rents_data), p=STARS_P)
+        else:
+            stars_column = stars_distr.rvs(size=len(device_rents_data), random_state=get_rng())
+        for (device_rent_id, device_rent_end_datetime), stars in zip(device_rents_data, stars_column.tolist()):
             message = None
-            if random.random() < message_p:
-                message = random.choice(self.messages[stars])
+            if python_rng.random() < message_p:
+                message = python_rng.choice(self.messages[stars])
             yield Feedback(
                 device_rent_id=device_rent_id,
                 stars=stars,
@@ -0,0 +1,110 @@
+import csv
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import numpy as np
+import yaml
+
+
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_CACHE_VERSION = 1
+
+
+def _read_names(path):
+    with np.load(path) as data:
+        return data['names'], data['weights']
+
+def _write_names(file, data):
+    names, weights = data
+    np.savez(file, names=names, weights=weights)
+
+def _read_pickle(path):
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+def _write_pickle(file, data):
+    pickle.dump(data, file, pickle.HIGHEST_PROTOCOL)
+
+
+class DataSources:
+    # Compiles data source files into binary caches stored next to them and keyed on
+    # the path, size and mtime of the source, so a source is only parsed again after
+    # it changes. Everything loaded during a run is also kept in memory and shared
+    # between the generators, which must not modify it.
+    def __init__(self, cache_dir_name='.cache'):
+        self.cache_dir_name = cache_dir_name
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def _cache_path(self, path, suffix):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = hashlib.sha1(f'{_CACHE_VERSION}:{path}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()[:16]
+        return os.path.join(os.path.dirname(path), self.cache_dir_name, f'{os.path.basename(path)}.{key}{suffix}')
+
+    def _store(self, path, suffix, cache_path, data, write):
+        # Caches of older versions of the same source are removed
+        cache_dir, cache_name = os.path.split(cache_path)
+        prefix = os.path.basename(path) + '.'
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            temp_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(temp_path, 'wb') as file:
+                write(file, data)
+            os.replace(temp_path, cache_path)
+            for name in os.listdir(cache_dir):
+                if name != cache_name and name.startswith(prefix) and name.endswith(suffix):
+                    os.remove(os.path.join(cache_dir, name))
+        except OSError as e:
+            logging.warning(f'Could not cache {cache_path}: {e}')
+
+    def _load(self, path, suffix, compile, read, write):
+        cache_path = self._cache_path(path, suffix)
+        with self._lock:
+            if cache_path not in self._loaded:
+                try:
+                    data = read(cache_path)
+                except FileNotFoundError:
+                    data = None
+                except Exception as e:
+                    logging.warning(f'Ignoring unreadable cache {cache_path}: {e}')
+                    data = None
+                if data is None:
+                    logging.debug(f'Compiling {path}')
+                    data = compile(path)
+                    self._store(path, suffix, cache_path, data, write)
+                self._loaded[cache_path] = data
+            return self._loaded[cache_path]
+
+    @staticmethod
+    def _compile_names(path, name_column, weight_column):
+        names = []
+        weights = []
+        with open(path, 'r') as file:
+            for row in csv.DictReader(file, delimiter=';'):
+                names.append(row[name_column].split(', ')[0])
+                weights.append(float(row[weight_column].replace(',', '.')))
+        return np.array(names), np.array(weights)
+
+    def names(self, path, name_column, weight_column):
+        # Returns a (names, weights) pair of arrays read from a ';'-separated CSV file.
+        # Only the first of comma-separated name variants is kept, weights may use a
+        # decimal comma.
+        return self._load(
+            path, f'.{name_column}.{weight_column}.npz',
+            lambda path: self._compile_names(path, name_column, weight_column),
+            _read_names, _write_names,
+        )
+
+    @staticmethod
+    def _compile_yaml(path):
+        with open(path, 'r') as file:
+            return yaml.load(file, Loader=_YAML_LOADER)
+
+    def yaml(self, path):
+        return self._load(path, '.pickle', self._compile_yaml, _read_pickle, _write_pickle)
+
+
+data_sources = DataSources()
@@ -1,54 +1,132 @@
+import contextvars
 import random
-import scipy.stats as stats
+import weakref
+from abc import ABC, abstractmethod
+import numpy as np
 from datetime import *
 
 
-class DateTimeDistribution:
-    def __init__(self, a, b=datetime.now()):
-        self.a = a
-        self.b = b
+class _Streams:
+    # A NumPy generator, a random.Random for the draws made with the standard
+    # library and the pools of buffered distributions drawn from them
+    def __init__(self, seed_sequence):
+        self.rng = np.random.default_rng(seed_sequence)
+        self.random = random.Random(int(seed_sequence.generate_state(1)[0]))
+        self.buffers = weakref.WeakKeyDictionary()
+
+
+# Random streams of the current context. Threads working for a target, such as
+# pipeline producers, run in a copy of its context and draw from its streams. A
+# context that is not seeded gets streams seeded from the OS.
+_streams = contextvars.ContextVar('random_streams', default=None)
+
+
+def seed(value=None):
+    # value is an int or a SeedSequence
+    seed_sequence = value if isinstance(value, np.random.SeedSequence) else np.random.SeedSequence(value)
+    _streams.set(_Streams(seed_sequence))
+
+
+def _current_streams():
+    if _streams.get() is None:
+        seed()
+    return _streams.get()
+
+
+def get_rng():
+    return _current_streams().rng
+
+
+def get_random():
+    return _current_streams().random
+
+
+def spawn_seeds(keys):
+    # Independent seed sequences for keys, drawn from the current streams
+    seed_sequence = np.random.SeedSequence(int(get_rng().integers(2 ** 63)))
+    return dict(zip(keys, seed_sequence.spawn(len(keys))))
+
+
+class Distribution(ABC):
+    # Bulk draws return NumPy arrays. Scalar draws return plain Python values and,
+    # when buffer_size is set, are taken from a pool drawn ahead in one call. The
+    # pools belong to the current streams, so a distribution shared by targets
+    # draws from the streams of each.
+    def __init__(self, buffer_size=None, rng=None):
+        self.buffer_size = buffer_size
+        self.rng = rng
+
+    def _generator(self):
+        return self.rng if self.rng is not None else get_rng()
+
+    @abstractmethod
+    def _sample(self, size):
+        pass
 
     def rvs(self, size=None):
-        if size is None:
-            a = int(self.a.timestamp())
-            b = int(self.b.timestamp())
-            return datetime.fromtimestamp(random.randint(a, b))
-        return [self.rvs() for _ in range(size)]
+        if size is not None:
+            return self._sample(size)
+        if self.buffer_size is None:
+            return self._sample(1)[0].item()
+        buffers = _current_streams().buffers
+        value = next(buffers.get(self, iter(())), None)
+        if value is None:
+            buffers[self] = iter(self._sample(self.buffer_size).tolist())
+            value = next(buffers[self])
+        return value
+
+
+class DateTimeDistribution(Distribution):
+    def __init__(self, a, b=None, **kwargs):
+        super().__init__(**kwargs)
+        self.a = a
+        self.b = b if b is not None else datetime.now()
+
+    def _sample(self, size):
+        a = np.datetime64(self.a, 's')
+        span = (np.datetime64(self.b, 's') - a).astype(np.int64)
+        return a + self._generator().integers(0, span, size, endpoint=True).astype('timedelta64[s]')
+
+    def windows(self, size, window_size):
+        # Splits size draws into consecutive time windows of about window_size draws
+        # and yields a distribution over every window with its number of draws, so
+        # that sorted draws can be produced one window at a time
+        a = np.datetime64(self.a, 's').astype(np.int64)
+        b = np.datetime64(self.b, 's').astype(np.int64)
+        window_count = max(1, -(-size // window_size)) if b > a else 1
+        bounds = np.linspace(a, b, window_count + 1).astype(np.int64)
+        counts = self._generator().multinomial(size, np.diff(bounds) / max(1, b - a)) if b > a else [size]
+        for begin, end, count in zip(bounds[:-1].tolist(), bounds[1:].tolist(), counts):
+            window = DateTimeDistribution(
+                np.datetime64(begin, 's').item(), np.datetime64(end, 's').item(), rng=self.rng,
+            )
+            yield window, int(count)
 
 
-class TimeDeltaDistribution:
-    def __init__(self, m, std):
+class TimeDeltaDistribution(Distribution):
+    def __init__(self, m, std, **kwargs):
+        super().__init__(**kwargs)
         self.m = m
         self.std = std
         l = m.total_seconds() / std.total_seconds() ** 2
-        k = m.total_seconds() * l
-        self.distr = stats.gamma(k, scale=1/l)
-    
-    def rvs(self, size=None):
-        if size is None:
-            return timedelta(seconds=self.distr.rvs())
-        else:
-            return (timedelta(seconds=s) for s in self.distr.rvs(size))
+        self.k = m.total_seconds() * l
+        self.scale = 1 / l
+
+    def _sample(self, size):
+        seconds = self._generator().gamma(self.k, self.scale, size)
+        return (seconds * 1e6).astype(np.int64).astype('timedelta64[us]')
 
 
-class PriceDistribution:
-    def __init__(self, m, std):
+class PriceDistribution(Distribution):
+    def __init__(self, m, std, **kwargs):
+        super().__init__(**kwargs)
         self.m = m
         self.std = std
         l = m / std ** 2
-        k = m * l
-        self.distr = stats.gamma(k, scale=1/l)
+        self.k = m * l
+        self.scale = 1 / l
 
-    def rvs(self, size=None):
-        if size is None:
-            p = self.distr.rvs(size)
-            if p < 1000:
-                return int(p / 10) * 10
-            elif p < 5000:
-                return int(p / 100) * 100
-            elif p < 30000:
-                return int(p / 500) * 500
-            else:
-                return int(p / 1000) * 1000
-        else:
-            return [self.rvs() for _ in range(size)]
+    def _sample(self, size):
+        p = self._generator().gamma(self.k, self.scale, size)
+        step = np.select([p < 1000, p < 5000, p < 30000], [10, 100, 500], 1000)
+        return (p // step).astype(np.int64) * step
@@ -0,0 +1,175 @@
+import gzip
+import heapq
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST_FILENAME = 'manifest.json'
+
+_EXTENSIONS = {'text': 'copy', 'csv': 'csv'}
+
+
+def _open(path, mode, compress):
+    if compress:
+        return gzip.open(path, mode + 't', encoding='utf-8', compresslevel=6)
+    return open(path, mode, encoding='utf-8')
+
+
+class _TableWriter:
+    # Writes the rows of one table to numbered chunk files, one open chunk per set of
+    # columns. A chunk is closed after the batch that fills it up to chunk_rows.
+    def __init__(self, out_dir, table_name, chunk_rows, compress, format):
+        self.out_dir = out_dir
+        self.table_name = table_name
+        self.chunk_rows = chunk_rows
+        self.compress = compress
+        self.format = format
+        self.chunks = []
+        self.open_chunks = {}
+
+    def _open_chunk(self, columns):
+        filename = f'{self.table_name}.{len(self.chunks):05d}.{_EXTENSIONS[self.format]}'
+        if self.compress:
+            filename += '.gz'
+        chunk = {'file': filename, 'columns': list(columns), 'rows': 0}
+        self.chunks.append(chunk)
+        self.open_chunks[columns] = (_open(os.path.join(self.out_dir, filename), 'w', self.compress), chunk)
+        return self.open_chunks[columns]
+
+    def write(self, columns, lines):
+        file, chunk = self.open_chunks.get(columns) or self._open_chunk(columns)
+        for line in lines:
+            file.write(line)
+            file.write('\n')
+            chunk['rows'] += 1
+        if chunk['rows'] >= self.chunk_rows:
+            file.close()
+            del self.open_chunks[columns]
+
+    def close(self):
+        for file, _ in self.open_chunks.values():
+            file.close()
+        self.open_chunks = {}
+        return self.chunks
+
+
+class Exporter:
+    # Writes tables to chunked files that COPY reads as they are, with a manifest
+    # listing the files of every table in the order the tables were first written
+    def __init__(self, out_dir, chunk_rows=100000, compress=False, format='text'):
+        if format not in _EXTENSIONS:
+            raise ValueError(f'Unknown format {format}')
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.chunk_rows = chunk_rows
+        self.compress = compress
+        self.format = format
+        self.writers = {}
+
+    def _writer(self, model):
+        if model.TABLE_NAME not in self.writers:
+            self.writers[model.TABLE_NAME] = _TableWriter(
+                self.out_dir, model.TABLE_NAME, self.chunk_rows, self.compress, self.format,
+            )
+        return self.writers[model.TABLE_NAME]
+
+    def write_entities(self, model, entities):
+        writer = self._writer(model)
+        count = 0
+        for columns, group in model.group_by_columns(entities).items():
+            writer.write(columns, model.format_rows(columns, map(model.values, group), self.format))
+            count += len(group)
+        return count
+
+    def write_columns(self, model, columns):
+        self._writer(model).write(tuple(columns), model.format_columns(columns, self.format))
+        return len(next(iter(columns.values())))
+
+    def close(self):
+        manifest = {
+            'format': self.format,
+            'tables': {table_name: writer.close() for table_name, writer in self.writers.items()},
+        }
+        with open(os.path.join(self.out_dir, MANIFEST_FILENAME), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        return manifest
+
+
+class DatasetLoader:
+    # Loads an exported dataset with COPY over several connections at once. Chunks
+    # are spread over the connections by size and every connection loads its share in
+    # a single transaction. The transactions are only committed once all of them
+    # succeeded, so a failed load leaves the tables as they were.
+    def __init__(self, in_dir):
+        self.in_dir = in_dir
+        with open(os.path.join(in_dir, MANIFEST_FILENAME), 'r') as manifest_file:
+            self.manifest = json.load(manifest_file)
+
+    @property
+    def table_names(self):
+        return list(self.manifest['tables'])
+
+    def _shares(self, workers):
+        chunks = [
+            (os.path.getsize(os.path.join(self.in_dir, chunk['file'])), table_name, chunk)
+            for table_name, table_chunks in self.manifest['tables'].items()
+            for chunk in table_chunks
+        ]
+        shares = [(0, i, []) for i in range(max(1, min(workers, len(chunks))))]
+        for size, table_name, chunk in sorted(chunks, key=lambda x: x[0], reverse=True):
+            total, i, share = heapq.heappop(shares)
+            share.append((table_name, chunk))
+            heapq.heappush(shares, (total + size, i, share))
+        return [share for _, _, share in shares if share]
+
+    def _load_share(self, connection, share, failed):
+        cursor = connection.cursor()
+        options = ' WITH (FORMAT csv)' if self.manifest['format'] == 'csv' else ''
+        for table_name, chunk in share:
+            if failed.is_set():
+                return
+            path = os.path.join(self.in_dir, chunk['file'])
+            q = f'''COPY {table_name} ({', '.join(chunk['columns'])}) FROM STDIN{options}'''
+            logging.debug(f'{q} < {path}')
+            with _open(path, 'r', path.endswith('.gz')) as file:
+                cursor.copy_expert(q, file)
+            logging.info(f'Loaded {chunk["rows"]} rows into {table_name} from {chunk["file"]}')
+
+    def __call__(self, connection_pool, workers=1):
+        shares = self._shares(workers)
+        connections = [connection_pool.getconn() for _ in shares]
+        failed = threading.Event()
+        try:
+            def load_share(connection, share):
+                try:
+                    self._load_share(connection, share, failed)
+                except BaseException:
+                    failed.set()
+                    raise
+
+            with ThreadPoolExecutor(max_workers=len(shares) or 1) as executor:
+                futures = [executor.submit(load_share, *x) for x in zip(connections, shares)]
+            errors = [future.exception() for future in futures if future.exception() is not None]
+            if errors:
+                raise errors[0]
+            for connection in connections:
+                connection.commit()
+        except BaseException:
+            for connection in connections:
+                connection.rollback()
+            raise
+        finally:
+            for connection in connections:
+                connection_pool.putconn(connection)
+        return sum(chunk['rows'] for table_chunks in self.manifest['tables'].values() for chunk in table_chunks)
+
+    def reset_sequences(self, cursor):
+        # Moves the id sequences past the loaded ids
+        for table_name, table_chunks in self.manifest['tables'].items():
+            if any('id' in chunk['columns'] for chunk in table_chunks):
+                cursor.execute(f'''
+                    SELECT setval(pg_get_serial_sequence(%s, 'id'), COALESCE(MAX(id), 0) + 1, false)
+                    FROM {table_name}
+                ''', (table_name, ))
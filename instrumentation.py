@@ -0,0 +1,256 @@
+import cProfile
+import contextvars
+import json
+import logging
+import math
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+_current_target = contextvars.ContextVar('current_target', default=None)
+
+
+def _peak_rss_mb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+class TargetStats:
+    def __init__(self, name):
+        self.name = name
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.rows_generated = {}
+        self.rows_written = {}
+        self.statements = 0
+        self.round_trips = 0
+        self.peak_rss_mb = 0.0
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def count(self, statements=0, round_trips=0):
+        with self.lock:
+            self.statements += statements
+            self.round_trips += round_trips
+
+    def count_rows(self, rows, table_name, n):
+        with self.lock:
+            rows[table_name] = rows.get(table_name, 0) + n
+
+    def as_dict(self):
+        rows_written = sum(self.rows_written.values())
+        return {
+            'wall_time': round(self.wall_time, 3),
+            'cpu_time': round(self.cpu_time, 3),
+            'rows_generated': self.rows_generated,
+            'rows_written': self.rows_written,
+            'rows_per_second': round(rows_written / self.wall_time, 1) if self.wall_time else None,
+            'statements': self.statements,
+            'round_trips': self.round_trips,
+            'peak_rss_mb': round(self.peak_rss_mb, 1),
+        }
+
+
+def count_generated(table_name, n):
+    stats = _current_target.get()
+    if stats is not None:
+        stats.count_rows(stats.rows_generated, table_name, n)
+
+def count_written(table_name, n):
+    stats = _current_target.get()
+    if stats is not None:
+        stats.count_rows(stats.rows_written, table_name, n)
+
+
+@contextmanager
+def thread_scope():
+    # Accounts the CPU time of the calling thread (and its profile, if profiling) to
+    # the current target. Threads working for a target, such as pipeline producers,
+    # run in a copy of its context and enter a scope of their own.
+    stats = _current_target.get()
+    if stats is None:
+        yield
+        return
+    profile = None
+    if stats.profiles is not None:
+        profile = cProfile.Profile()
+        profile.enable()
+    started = time.thread_time()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.disable()
+            with stats.lock:
+                stats.profiles.append(profile)
+        elapsed = time.thread_time() - started
+        with stats.lock:
+            stats.cpu_time += elapsed
+
+
+class CountingCursor:
+    # Wraps a DB-API cursor and counts its statements and round-trips towards the
+    # current target. Cursors opened through its connection are wrapped as well.
+    def __init__(self, cursor):
+        object.__setattr__(self, '_cursor', cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        # Settings like itersize must reach the wrapped cursor
+        setattr(self._cursor, name, value)
+
+    @staticmethod
+    def _count(statements=0, round_trips=0):
+        stats = _current_target.get()
+        if stats is not None:
+            stats.count(statements, round_trips)
+
+    @property
+    def connection(self):
+        return CountingConnection(self._cursor.connection)
+
+    def execute(self, query, params=None):
+        self._count(1, 1)
+        return self._cursor.execute(query, params)
+
+    def executemany(self, query, params_seq):
+        params_seq = list(params_seq)
+        self._count(len(params_seq), len(params_seq))
+        return self._cursor.executemany(query, params_seq)
+
+    def copy_expert(self, sql, file, *args, **kwargs):
+        self._count(1, 1)
+        return self._cursor.copy_expert(sql, file, *args, **kwargs)
+
+    def _count_fetch(self):
+        # Only server-side cursors go to the server for more rows
+        if getattr(self._cursor, 'name', None):
+            self._count(0, 1)
+
+    def fetchone(self):
+        self._count_fetch()
+        return self._cursor.fetchone()
+
+    def fetchmany(self, *args, **kwargs):
+        self._count_fetch()
+        return self._cursor.fetchmany(*args, **kwargs)
+
+    def fetchall(self):
+        self._count_fetch()
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        rows = 0
+        try:
+            for row in self._cursor:
+                rows += 1
+                yield row
+        finally:
+            if getattr(self._cursor, 'name', None):
+                self._count(0, math.ceil((rows + 1) / self._cursor.itersize))
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._cursor.__exit__(*exc_info)
+
+
+class CountingConnection:
+    def __init__(self, connection):
+        object.__setattr__(self, '_connection', connection)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._connection, name, value)
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(self._connection.cursor(*args, **kwargs))
+
+
+class Progress:
+    # Rate-limited progress reporting in place of logging every row
+    def __init__(self, name, interval=5.0):
+        self.name = name
+        self.interval = interval
+        self.rows = 0
+        self.started = time.perf_counter()
+        self.reported = self.started
+
+    def update(self, n):
+        self.rows += n
+        now = time.perf_counter()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            logging.info(f'{self.name}: {self.rows} rows, {self.rows / (now - self.started):.0f} rows/s')
+
+
+class Instrumentation:
+    # Collects TargetStats of the targets run under target(). With profile_dir set,
+    # every target also gets a cProfile dump of all threads that worked for it and a
+    # tracemalloc report of the memory it allocated.
+    def __init__(self, profile_dir=None):
+        self.profile_dir = profile_dir
+        self.targets = {}
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+            tracemalloc.start()
+
+    @contextmanager
+    def target(self, name):
+        stats = self.targets[name] = TargetStats(name)
+        if self.profile_dir is None:
+            stats.profiles = None
+        token = _current_target.set(stats)
+        snapshot = tracemalloc.take_snapshot() if self.profile_dir is not None else None
+        started = time.perf_counter()
+        try:
+            with thread_scope():
+                yield stats
+        finally:
+            stats.wall_time = time.perf_counter() - started
+            stats.peak_rss_mb = _peak_rss_mb()
+            _current_target.reset(token)
+            if self.profile_dir is not None:
+                self._dump_profile(stats, snapshot)
+
+    def _dump_profile(self, stats, snapshot):
+        if stats.profiles:
+            profile_stats = pstats.Stats(*stats.profiles)
+            profile_stats.dump_stats(os.path.join(self.profile_dir, f'{stats.name}.prof'))
+        top_stats = tracemalloc.take_snapshot().compare_to(snapshot, 'lineno')
+        with open(os.path.join(self.profile_dir, f'{stats.name}.tracemalloc.txt'), 'w') as report_file:
+            for top_stat in top_stats[:30]:
+                report_file.write(f'{top_stat}\n')
+
+    def as_dict(self):
+        return {
+            'targets': {name: stats.as_dict() for name, stats in self.targets.items()},
+            'peak_rss_mb': round(_peak_rss_mb(), 1),
+        }
+
+    def log_summary(self):
+        header = f'{"target":<16} {"wall s":>8} {"cpu s":>8} {"rows":>10} {"rows/s":>10} {"stmts":>8} {"trips":>8} {"rss MB":>8}'
+        logging.info(header)
+        for name, stats in self.targets.items():
+            rows = sum(stats.rows_written.values())
+            rate = rows / stats.wall_time if stats.wall_time else 0
+            logging.info(
+                f'{name:<16} {stats.wall_time:>8.2f} {stats.cpu_time:>8.2f} {rows:>10} {rate:>10.0f} '
+                f'{stats.statements:>8} {stats.round_trips:>8} {stats.peak_rss_mb:>8.1f}'
+            )
+
+    def dump(self, filename):
+        with open(filename, 'w') as stats_file:
+            json.dump(self.as_dict(), stats_file, indent=2)
@@ -1,31 +1,77 @@
 #!/usr/bin/env python3
 
-from random import choices
 from data_generating import *
 import psycopg2
+import psycopg2.pool
 import sys
 import logging
 import os.path
 from argparse import ArgumentParser
+from itertools import chain
+from model import IdAllocator, LocalIdAllocator, Model, batches
+from bulk_load import BulkLoad
+from scheduler import TargetGraph
+from timeline_shards import ShardedTimelineGenerator
+from pipeline import Pipeline
+from export import DatasetLoader, Exporter
+from partitions import init_partitions
+from snapshots import DatabaseSnapshots
+from instrumentation import CountingCursor, Instrumentation, Progress, count_generated, count_written
 
 DATA_SOURCES_BASE_PATH = 'data_generating_sources'
-TARGETS = [
-    'all',
-    'manufacturers',
-    'device_models',
-    'devices',
-    'customers',
-    'timeline',
-    'damage_fines',
-    'rent_price',
-    'feedbacks',
-]
+
+TARGET_GRAPH = TargetGraph({
+    'manufacturers': [],
+    'device_models': ['manufacturers'],
+    'devices': ['device_models'],
+    'customers': [],
+    'timeline': ['devices', 'customers'],
+    'damage_fines': ['timeline'],
+    'rent_price': ['device_models'],
+    'feedbacks': ['timeline'],
+})
+
+# Models filled by each target, children after parents
+TARGET_MODELS = {
+    'manufacturers': [Manufacturer],
+    'device_models': [DeviceModel, DeviceModelImage, DeviceModelProperty],
+    'devices': [Device],
+    'customers': [Customer],
+    'timeline': [DeviceRent, DeviceOwnership, DeviceRentOwnership, DeviceRepair],
+    'damage_fines': [DamageFine],
+    'rent_price': [DeviceModelRentPrice],
+    'feedbacks': [Feedback],
+}
+
+TARGETS = ['all'] + list(TARGET_GRAPH.dependencies)
 
 arg_parser = ArgumentParser()
-arg_parser.add_argument('action', choices=['fill', 'clear', 'refill'])
+arg_parser.add_argument('action', choices=['fill', 'clear', 'refill', 'export', 'load', 'append', 'snapshot', 'restore'])
 arg_parser.add_argument('targets', nargs='*', choices=TARGETS, default='all')
-arg_parser.add_argument('--size', type=int)
+arg_parser.add_argument('--size', type=float, default=1.0)
 arg_parser.add_argument('--dry', action='store_true')
+arg_parser.add_argument('--workers', type=int, default=1)
+arg_parser.add_argument('--batch-size', type=int, default=1000)
+arg_parser.add_argument('--queue-size', type=int, default=4)
+arg_parser.add_argument('--id-block-size', type=int, default=1000)
+arg_parser.add_argument('--seed', type=int, default=None)
+arg_parser.add_argument('--bulk-load', action='store_true')
+arg_parser.add_argument('--unlogged', action='store_true')
+arg_parser.add_argument('--out', '--in', dest='data_dir', type=str, default='export')
+arg_parser.add_argument('--format', choices=['text', 'csv'], default='text')
+arg_parser.add_argument('--compress', action='store_true')
+arg_parser.add_argument('--chunk-rows', type=int, default=100000)
+arg_parser.add_argument('--no-refresh', action='store_true')
+arg_parser.add_argument('--year', type=int, default=None)
+arg_parser.add_argument('--days', type=float, default=None)
+arg_parser.add_argument('--truncate', action='store_true')
+arg_parser.add_argument('--snapshot', type=str, default=None)
+arg_parser.add_argument('--maintenance-db', type=str, default='postgres')
+arg_parser.add_argument('--force', action='store_true')
+arg_parser.add_argument('--schema', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'my_device.sql'))
+arg_parser.add_argument('--stats', type=str, default=None)
+arg_parser.add_argument('--profile', type=str, nargs='?', const='profile', default=None)
+arg_parser.add_argument('--progress-interval', type=float, default=5.0)
 arg_parser.add_argument('--log-level', type=str, default='INFO')
 arg_parser.add_argument('--db', type=str, default='my_device')
 arg_parser.add_argument('--user', type=str, default=None)
@@ -37,100 +83,552 @@ arg_parser.add_argument('--manufacturers', type=str, default=os.path.join(DATA_S
 arg_parser.add_argument('--device-models', type=str, default=os.path.join(DATA_SOURCES_BASE_PATH, 'device_models.yaml'))
 arg_parser.add_argument('--feedbacks', type=str, default=os.path.join(DATA_SOURCES_BASE_PATH, 'feedbacks.yaml'))
 arg_parser.add_argument('--fine', type=int, default=3000)
-arg_parser.add_argument('--customers', type=int, default=5000)
-arg_parser.add_argument('--devices', type=int, default=1000)
-arg_parser.add_argument('--rents', type=int, default=10000)
-
-args = arg_parser.parse_args()
-if not isinstance(args.targets, list):
-    args.targets = [args.targets]
-targets = frozenset(args.targets)
-
-logging.basicConfig(level=args.log_level.upper())
+arg_parser.add_argument('--customers', type=int, default=None)
+arg_parser.add_argument('--devices', type=int, default=None)
+arg_parser.add_argument('--rents', type=int, default=None)
 
-connection = psycopg2.connect(database=args.db, user=args.user, password=args.password)
-cursor = connection.cursor()
-init_models(cursor)
+# Row counts at --size 1, for the counts not given explicitly
+SIZE_ROW_COUNTS = {
+    'customers': 5000,
+    'devices': 1000,
+    'rents': 10000,
+}
 
 
-def clear_model(model):
+def clear_model(cursor, model):
     n = model.clear(cursor)
     logging.info(f'Deleted {n} rows from {model.TABLE_NAME}')
 
-def insert_entity(entity):
-    entity.insert(cursor)
-    logging.info(entity)
-
-
-if args.action in ['clear', 'refill']:
-    if targets & set(['manufacturers', 'all']):
-        clear_model(Manufacturer)
-    if targets & set(['device_models', 'all']):
-        clear_model(DeviceModelProperty)
-        clear_model(DeviceModelImage)
-        clear_model(DeviceModel)
-    if targets & set(['devices', 'all']):
-        clear_model(Device)
-    if targets & set(['customers', 'all']):
-        clear_model(Customer)
-    if targets & set(['timeline', 'all']):
-        clear_model(DeviceRepair)
-        clear_model(DeviceRentOwnership)
-        clear_model(DeviceOwnership)
-        clear_model(DeviceRent)
-    if targets & set(['damage_fines', 'all']):
-        clear_model(DamageFine)
-    if targets & set(['rent_price', 'all']):
-        clear_model(DeviceModelRentPrice)
-    if targets & set(['feedbacks', 'all']):
-        clear_model(Feedback)
-
-if args.action in ['fill', 'refill']:
-    if targets & set(['manufacturers', 'all']):
-        manufacturer_generator = ManufacturerGenerator(args.manufacturers)
-        for manufacturer in manufacturer_generator():
-            manufacturer.insert(cursor)
-            logging.info(manufacturer)
-    if targets & set(['device_models', 'all']):
+def write_batch(cursor, model, batch):
+    # Batches of partitioned tables are written to their partitions directly
+    if model.partitions is not None:
+        return sum(write_rows(cursor, *x) for x in model.partitions.split(cursor, batch))
+    return write_rows(cursor, model, batch)
+
+def write_rows(cursor, model, batch):
+    # Batches are either lists of entities or mappings of column names to values
+    if isinstance(batch, dict):
+        return model.insert_columns(cursor, batch, args.batch_size)
+    if batch:
+        logging.debug(f'{model.TABLE_NAME}: {batch[0]}')
+    return model.insert_many(cursor, batch, args.batch_size)
+
+def batch_size(batch):
+    return len(next(iter(batch.values()))) if isinstance(batch, dict) else len(batch)
+
+def reader(cursor):
+    # Generators run on the producer thread and must not share the writer's cursor.
+    # A cursor of the same connection still sees the rows written so far.
+    return cursor.connection.cursor()
+
+def write_batches(cursor, name, batches):
+    # Batches are produced on a separate thread while the previous ones are written
+    progress = Progress(name, args.progress_interval)
+    def generate():
+        for model, batch in batches:
+            count_generated(model.TABLE_NAME, batch_size(batch))
+            yield model, batch
+    def write(item):
+        model, batch = item
+        n = write_batch(cursor, model, batch)
+        count_written(model.TABLE_NAME, n)
+        progress.update(n)
+        return n
+    pipeline = Pipeline(write, args.queue_size)
+    n = pipeline(generate())
+    pipeline.log_stats(name)
+    logging.info(f'{name}: inserted {n} rows')
+
+def entity_batches(model, entities):
+    for batch in batches(entities, args.batch_size):
+        yield model, batch
+
+def insert_entities(cursor, model, entities):
+    write_batches(cursor, model.TABLE_NAME, entity_batches(model, entities))
+
+
+def fill_manufacturers(cursor):
+    manufacturer_generator = ManufacturerGenerator(args.manufacturers)
+    insert_entities(cursor, Manufacturer, manufacturer_generator())
+
+def fill_device_models(cursor):
+    def generate():
         device_model_generator = DeviceModelGenerator(args.device_models)
-        for device_model, device_model_image, device_model_properties in device_model_generator(cursor):
-            insert_entity(device_model)
-            insert_entity(device_model_image)
-            for device_model_property in device_model_properties:
-                insert_entity(device_model_property)
-    if targets & set(['devices', 'all']):
-        device_generator = DeviceGenerator()
-        for device in device_generator(cursor, args.devices):
-            insert_entity(device)
-    if targets & set(['customers', 'all']):
+        device_models = []
+        device_model_images = []
+        device_model_properties = []
+        for device_model, device_model_image, properties in device_model_generator(reader(cursor)):
+            device_models.append(device_model)
+            device_model_images.append(device_model_image)
+            device_model_properties.extend(properties)
+        yield from entity_batches(DeviceModel, device_models)
+        yield from entity_batches(DeviceModelImage, device_model_images)
+        yield from entity_batches(DeviceModelProperty, device_model_properties)
+    write_batches(cursor, 'device_models', generate())
+
+def fill_devices(cursor):
+    device_generator = DeviceGenerator()
+    insert_entities(cursor, Device, device_generator(reader(cursor), args.devices))
+
+def fill_customers(cursor):
+    def generate():
         name_generator = NameGenerator(args.male_first_names, args.female_first_names, args.last_names)
         customer_generator = CustomerGenerator(name_generator)
-        for customer in customer_generator(args.customers):
-            insert_entity(customer)
-    if targets & set(['timeline', 'all']):
+        for columns in customer_generator.column_chunks(args.customers, args.batch_size):
+            yield Customer, columns
+    write_batches(cursor, 'customers', generate())
+
+def fill_timeline(cursor):
+    def generate():
+        if args.workers > 1:
+            timeline_generator = ShardedTimelineGenerator(args.workers)
+            for chunk in timeline_generator(reader(cursor), args.rents):
+                yield from chunk.items()
+            return
+        timeline_generator = TimelineGenerator()
+        yield from timeline_batches(timeline_generator(reader(cursor), args.rents))
+    write_batches(cursor, 'timeline', generate())
+
+def timeline_batches(timeline):
+    for chunk in batches(timeline, args.batch_size):
+        for i, model in enumerate(TARGET_MODELS['timeline']):
+            yield model, list(chain.from_iterable(x[i] for x in chunk))
+
+def fill_damage_fines(cursor):
+    damage_fine_generator = DamageFineGenerator(args.fine)
+    insert_entities(cursor, DamageFine, damage_fine_generator(reader(cursor)))
+
+def fill_rent_price(cursor):
+    rent_price_generator = DeviceModelRentPriceGenerator(args.device_models)
+    insert_entities(cursor, DeviceModelRentPrice, rent_price_generator(reader(cursor)))
+
+def fill_feedbacks(cursor):
+    feedback_generator = FeedbackGenerator(args.feedbacks)
+    insert_entities(cursor, Feedback, feedback_generator(reader(cursor)))
+
+FILLERS = {
+    'manufacturers': fill_manufacturers,
+    'device_models': fill_device_models,
+    'devices': fill_devices,
+    'customers': fill_customers,
+    'timeline': fill_timeline,
+    'damage_fines': fill_damage_fines,
+    'rent_price': fill_rent_price,
+    'feedbacks': fill_feedbacks,
+}
+
+
+# Offline counterparts of the fillers. Instead of reading their inputs back from the
+# database, targets pass them on to their dependents through the state dict.
+
+def export_entities(exporter, model, entities):
+    n = 0
+    for batch in batches(entities, args.batch_size):
+        n += export_batch(exporter, model, batch)
+    logging.info(f'Exported {n} rows of {model.TABLE_NAME}')
+
+def export_batch(exporter, model, batch):
+    if isinstance(batch, dict):
+        n = exporter.write_columns(model, batch)
+    else:
+        n = exporter.write_entities(model, batch)
+    count_generated(model.TABLE_NAME, n)
+    count_written(model.TABLE_NAME, n)
+    return n
+
+def export_manufacturers(exporter, state):
+    manufacturer_generator = ManufacturerGenerator(args.manufacturers)
+    manufacturers = list(manufacturer_generator())
+    export_entities(exporter, Manufacturer, manufacturers)
+    state['manufacturer_ids'] = {manufacturer.name: manufacturer.id for manufacturer in manufacturers}
+
+def export_device_models(exporter, state):
+    device_model_generator = DeviceModelGenerator(args.device_models)
+    device_models = []
+    device_model_images = []
+    device_model_properties = []
+    for device_model, device_model_image, properties in device_model_generator(None, state['manufacturer_ids']):
+        device_models.append(device_model)
+        device_model_images.append(device_model_image)
+        device_model_properties.extend(properties)
+    export_entities(exporter, DeviceModel, device_models)
+    export_entities(exporter, DeviceModelImage, device_model_images)
+    export_entities(exporter, DeviceModelProperty, device_model_properties)
+    state['device_model_ids'] = {device_model.name: device_model.id for device_model in device_models}
+
+def export_devices(exporter, state):
+    device_generator = DeviceGenerator()
+    devices = list(device_generator(None, args.devices, device_model_ids=list(state['device_model_ids'].values())))
+    export_entities(exporter, Device, devices)
+    state['devices'] = devices
+
+def export_customers(exporter, state):
+    name_generator = NameGenerator(args.male_first_names, args.female_first_names, args.last_names)
+    customer_generator = CustomerGenerator(name_generator)
+    ids = []
+    registration_timestamps = []
+    for columns in customer_generator.column_chunks(args.customers, args.batch_size):
+        columns['id'] = Model.id_allocator.reserve(Customer.TABLE_NAME, len(columns['phone']))
+        export_batch(exporter, Customer, columns)
+        ids.append(np.asarray(columns['id']))
+        registration_timestamps.append(columns['registration_timestamp'])
+    logging.info(f'Exported {args.customers} rows of {Customer.TABLE_NAME}')
+    state['customers'] = CustomerIndex(np.concatenate(ids), np.concatenate(registration_timestamps))
+
+def export_timeline(exporter, state):
+    # Damage fines and feedbacks are generated and written per chunk of chains
+    # from the uninsured repairs and the last rents of the chunk, so nothing of
+    # the timeline outlives its chunk
+    damage_fine_generator = DamageFineGenerator(args.fine)
+    feedback_generator = FeedbackGenerator(args.feedbacks)
+    timeline_generator = TimelineGenerator()
+    timeline = timeline_generator(None, args.rents, customers=state.pop('customers'), devices=state.pop('devices'))
+    n = 0
+    for chunk in batches(timeline, args.batch_size):
+        for i, model in enumerate(TARGET_MODELS['timeline']):
+            export_batch(exporter, model, list(chain.from_iterable(x[i] for x in chunk)))
+        uninsured_repairs = [
+            (device_repair.id, device_repair.device_ownership_id, device_repair.price)
+            for device_rents, _, _, device_repairs in chunk if not device_rents[0].is_insured
+            for device_repair in device_repairs
+        ]
+        export_batch(exporter, DamageFine, list(damage_fine_generator(None, device_repairs=uninsured_repairs)))
+        last_rents = [(device_rents[-1].id, device_rents[-1].end_timestamp) for device_rents, _, _, _ in chunk]
+        export_batch(exporter, Feedback, list(feedback_generator(None, last_rents=last_rents)))
+        n += len(chunk)
+    logging.info(f'Exported timeline of {n} rent chains')
+
+def export_damage_fines(exporter, state):
+    logging.info(f'Exported {DamageFine.TABLE_NAME} with the timeline')
+
+def export_rent_price(exporter, state):
+    rent_price_generator = DeviceModelRentPriceGenerator(args.device_models)
+    export_entities(exporter, DeviceModelRentPrice, rent_price_generator(None, device_model_ids=state['device_model_ids']))
+
+def export_feedbacks(exporter, state):
+    logging.info(f'Exported {Feedback.TABLE_NAME} with the timeline')
+
+EXPORTERS = {
+    'manufacturers': export_manufacturers,
+    'device_models': export_device_models,
+    'devices': export_devices,
+    'customers': export_customers,
+    'timeline': export_timeline,
+    'damage_fines': export_damage_fines,
+    'rent_price': export_rent_price,
+    'feedbacks': export_feedbacks,
+}
+
+
+def clear(cursor, targets):
+    for target in TARGET_GRAPH.reverse_order(targets):
+        for model in reversed(TARGET_MODELS[target]):
+            clear_model(cursor, model)
+
+def truncate(cursor, targets):
+    # Truncates the tables of the targets and of all targets depending on them in one
+    # statement, which is much faster than deleting their rows one by one
+    closure = TARGET_GRAPH.dependents(targets)
+    if closure - set(targets):
+        logging.info(f'Also clearing dependent targets {", ".join(TARGET_GRAPH.order(closure - set(targets)))}')
+    models = [model for target in TARGET_GRAPH.reverse_order(closure) for model in reversed(TARGET_MODELS[target])]
+    Model.truncate(cursor, models)
+    logging.info(f'Truncated {", ".join(model.TABLE_NAME for model in models)}')
+
+def clear_year(cursor, targets, year):
+    # Truncates the partitions of the year of the targets' partitioned tables. The
+    # ids of the truncated rows are saved first, and the rows of other tables
+    # referencing them are deleted by those ids afterwards, as references to
+    # partitioned tables have no foreign keys. Rents of other years continuing
+    # chains of the year lose their previous_device_rent_id and chain_id.
+    partitioned_models = [
+        model for target in TARGET_GRAPH.reverse_order(targets) for model in reversed(TARGET_MODELS[target])
+        if model.partitions is not None
+    ]
+    if not partitioned_models:
+        logging.error(f'None of the tables of {", ".join(targets)} is partitioned')
+        return
+    ids_tables = {}
+    for model in partitioned_models:
+        ids_table = f'cleared_{model.TABLE_NAME}' if 'id' in model.FIELDS else None
+        if model.partitions.truncate(cursor, year, ids_table):
+            logging.info(f'Truncated {model.partitions.name(year)}')
+            if ids_table is not None:
+                ids_tables[model.TABLE_NAME] = ids_table
+    for table_name, ids_table in ids_tables.items():
+        for model in MODELS:
+            n = model.delete_referencing(cursor, table_name, ids_table)
+            if n:
+                logging.info(f'Deleted {n} rows from {model.TABLE_NAME}')
+            if model.TABLE_NAME == table_name:
+                n = model.unlink_referencing(cursor, ids_table)
+                if n:
+                    logging.info(f'Unlinked {n} rows of {model.TABLE_NAME}')
+
+def fill(cursor, targets):
+    # Ids are reserved up front, so foreign keys are only checked at commit. Every
+    # target draws from random streams of its own, as in a parallel fill.
+    cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+    target_seeds = spawn_seeds(TARGET_GRAPH.dependencies)
+    for target in TARGET_GRAPH.order(targets):
+        seed(target_seeds[target])
+        with instrumentation.target(target):
+            FILLERS[target](cursor)
+
+def fill_parallel(connection_pool, targets, bulk_load=None):
+    # Every target runs in a transaction of its own that is committed as soon as the
+    # target is done, so its dependents (started only after that) see its rows. If a
+    # target fails, the rows of the targets committed so far are deleted again and a
+    # bulk load is restored, in one transaction of a connection of its own. A failed
+    # refill thus leaves its targets cleared. Every target draws from random streams
+    # of its own, seeded in the thread running it, so a seeded run does not depend
+    # on how the targets interleave.
+    transaction_ids = {}
+    target_seeds = spawn_seeds(TARGET_GRAPH.dependencies)
+
+    def run_target(target):
+        seed(target_seeds[target])
+        connection = connection_pool.getconn()
+        try:
+            with instrumentation.target(target):
+                cursor = CountingCursor(connection.cursor())
+                cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+                FILLERS[target](cursor)
+                # The 32-bit id the rows of the transaction carry in xmin
+                cursor.execute('SELECT mod(txid_current(), 4294967296)')
+                transaction_id, = cursor.fetchone()
+                connection.commit()
+                transaction_ids[target] = transaction_id
+        except BaseException:
+            connection.rollback()
+            raise
+        finally:
+            connection_pool.putconn(connection)
+
+    try:
+        TARGET_GRAPH.run(targets, run_target, args.workers)
+    except BaseException:
+        connection = connection_pool.getconn()
+        try:
+            cursor = connection.cursor()
+            undo_targets(cursor, transaction_ids)
+            if bulk_load is not None:
+                bulk_load.restore(cursor)
+            connection.commit()
+        finally:
+            connection_pool.putconn(connection)
+        raise
+
+def undo_targets(cursor, transaction_ids):
+    # Deletes the rows written by the committed transactions of targets
+    for target in TARGET_GRAPH.reverse_order(transaction_ids):
+        for model in reversed(TARGET_MODELS[target]):
+            cursor.execute(f'''DELETE FROM {model.TABLE_NAME} WHERE xmin = %s::text::xid''', (transaction_ids[target], ))
+            logging.info(f'Deleted {cursor.rowcount} rows of failed fill from {model.TABLE_NAME}')
+
+def check_bulk_load(violations):
+    # The violating rows are logged by the bulk load, the run fails
+    if violations:
+        raise ValueError(f'Bulk load violates {", ".join(violations)}')
+
+def export():
+    # Always writes the whole dataset, as every target needs the rows of its
+    # dependencies. Ids are counted from 1, so the dataset is meant to be loaded
+    # into empty tables.
+    init_models_from_schema(args.schema)
+    Model.id_allocator = LocalIdAllocator()
+    exporter = Exporter(args.data_dir, args.chunk_rows, args.compress, args.format)
+    state = {}
+    target_seeds = spawn_seeds(TARGET_GRAPH.dependencies)
+    for target in TARGET_GRAPH.order(TARGET_GRAPH.dependencies):
+        seed(target_seeds[target])
+        with instrumentation.target(target):
+            EXPORTERS[target](exporter, state)
+    exporter.close()
+    logging.info(f'Exported dataset to {args.data_dir}')
+
+def load(connection_pool, connection):
+    # Foreign keys and cross-row checks are dropped for the load and validated in
+    # bulk afterwards. The DDL is committed first, so the loading connections are
+    # not blocked by its locks.
+    dataset_loader = DatasetLoader(args.data_dir)
+    cursor = connection.cursor()
+    bulk_load = BulkLoad(cursor, [model.TABLE_NAME for model in MODELS], unlogged=args.unlogged)
+    bulk_load.disable()
+    connection.commit()
+    try:
+        with instrumentation.target('load'):
+            n = dataset_loader(connection_pool, args.workers)
+            for table_name, chunks in dataset_loader.manifest['tables'].items():
+                count_written(table_name, sum(chunk['rows'] for chunk in chunks))
+            logging.info(f'Loaded {n} rows')
+            dataset_loader.reset_sequences(cursor)
+    finally:
+        violations = bulk_load.restore()
+        connection.commit()
+    check_bulk_load(violations)
+
+def append(cursor):
+    # Continues the timeline in the database by --days, or up to now, at the rate of
+    # rents of its last year. Damage fines and feedbacks are only generated for the
+    # new rows. Returns the moment the new rows begin at.
+    cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+    state = TimelineState.select(cursor)
+    until = state.since + timedelta(days=args.days) if args.days is not None else datetime.now()
+    if until <= state.since:
+        logging.info(f'The timeline already reaches {until}')
+        return None
+    rent_count = args.rents
+    if rent_count is None:
+        rent_count = round(state.rents_per_day * (until - state.since) / timedelta(days=1))
+    with instrumentation.target('timeline'):
         timeline_generator = TimelineGenerator()
-        for x in timeline_generator(cursor, args.rents):
-            device_rents, device_ownerships, device_rent_ownerships, device_repairs = x
-            for device_rent in device_rents:
-                insert_entity(device_rent)
-            for device_ownership in device_ownerships:
-                insert_entity(device_ownership)
-            for device_rent_ownership in device_rent_ownerships:
-                insert_entity(device_rent_ownership)
-            for device_repair in device_repairs:
-                insert_entity(device_repair)
-    if targets & set(['damage_fines', 'all']):
+        timeline = timeline_generator(reader(cursor), rent_count, until=until, state=state)
+        write_batches(cursor, 'timeline', timeline_batches(timeline))
+        n = DeviceOwnership.update_many(cursor, state.closed_ownerships, ['end_timestamp'], args.batch_size)
+        logging.info(f'Closed {n} device ownerships')
+    with instrumentation.target('damage_fines'):
         damage_fine_generator = DamageFineGenerator(args.fine)
-        for damage_fine in damage_fine_generator(cursor):
-            insert_entity(damage_fine)
-    if targets & set(['rent_price', 'all']):
-        rent_price_generator = DeviceModelRentPriceGenerator(args.device_models)
-        for rent_price in rent_price_generator(cursor):
-            insert_entity(rent_price)
-    if targets & set(['feedbacks', 'all']):
+        damage_fines = damage_fine_generator(reader(cursor), after_device_repair_id=state.device_repair_id)
+        insert_entities(cursor, DamageFine, damage_fines)
+    with instrumentation.target('feedbacks'):
         feedback_generator = FeedbackGenerator(args.feedbacks)
-        for feedback in feedback_generator(cursor):
-            insert_entity(feedback)
+        insert_entities(cursor, Feedback, feedback_generator(reader(cursor), after_device_rent_id=state.device_rent_id))
+    return state.since
 
-if not args.dry:
-    connection.commit()
+def refresh_rollups(cursor, since=None):
+    # Recomputes the revenue rollups of the months touched by new rows, or of every
+    # month from since on
+    with instrumentation.target('rollups'):
+        cursor.execute('SELECT refresh_revenue_rollups(%s)', (since, ))
+        from_month, = cursor.fetchone()
+    if from_month is None:
+        logging.info('Revenue rollups are up to date')
+    else:
+        logging.info(f'Refreshed revenue rollups from {from_month}')
+
+def snapshots(action):
+    # Databases are created and dropped from the maintenance database, as neither the
+    # database nor its snapshot may have other connections meanwhile
+    connection = psycopg2.connect(database=args.maintenance_db, user=args.user, password=args.password)
+    try:
+        database_snapshots = DatabaseSnapshots(connection)
+        with instrumentation.target(action):
+            if action == 'snapshot':
+                database_snapshots.snapshot(args.db, args.snapshot)
+            else:
+                database_snapshots.restore(args.snapshot, args.db, args.force)
+    finally:
+        connection.close()
+
+
+def report():
+    instrumentation.log_summary()
+    if args.stats is not None:
+        instrumentation.dump(args.stats)
+
+def main():
+    global args, instrumentation
+    args = arg_parser.parse_args()
+    if not isinstance(args.targets, list):
+        args.targets = [args.targets]
+    targets = TARGET_GRAPH.dependencies.keys() if 'all' in args.targets else frozenset(args.targets)
+    # append takes the number of rents from the rate of rents in the database
+    for name, count in SIZE_ROW_COUNTS.items():
+        if getattr(args, name) is None and args.action != 'append':
+            setattr(args, name, max(1, round(count * args.size)))
+    # Parallel targets only see each other's rows once committed
+    is_parallel = args.workers > 1 and not args.dry
+
+    logging.basicConfig(level=args.log_level.upper())
+    instrumentation = Instrumentation(args.profile)
+
+    if args.seed is not None:
+        seed(args.seed)
+
+    if args.year is not None and args.action != 'clear':
+        arg_parser.error('--year is only supported by clear')
+    if args.truncate and (args.year is not None or args.action not in ['clear', 'refill']):
+        arg_parser.error('--truncate is only supported by clear and refill without --year')
+    if args.days is not None and args.action != 'append':
+        arg_parser.error('--days is only supported by append')
+    if args.snapshot is None:
+        args.snapshot = f'{args.db}_snapshot'
+
+    if args.action == 'export':
+        export()
+        report()
+        return
+
+    if args.action in ['snapshot', 'restore']:
+        snapshots(args.action)
+        report()
+        return
+
+    connection_pool = psycopg2.pool.ThreadedConnectionPool(
+        1, args.workers + 2 if is_parallel or args.action == 'load' else 2,
+        database=args.db, user=args.user, password=args.password,
+    )
+    connection = connection_pool.getconn()
+    cursor = CountingCursor(connection.cursor())
+    init_models(cursor)
+    init_partitions(cursor, MODELS)
+
+    if args.action == 'load':
+        load(connection_pool, connection)
+        if not args.no_refresh:
+            refresh_rollups(cursor)
+
+    if args.action in ['clear', 'refill']:
+        if args.truncate:
+            truncate(cursor, targets)
+        elif args.year is None:
+            clear(cursor, targets)
+        else:
+            clear_year(cursor, targets, args.year)
+        if not args.no_refresh:
+            # Deleted rows are not detected by an incremental refresh. Rows deleted
+            # with a year's partitions only count in that year and later.
+            refresh_rollups(cursor, '-infinity' if args.year is None else datetime(args.year, 1, 1))
+
+    if args.action in ['fill', 'refill']:
+        allocator_connection = connection_pool.getconn()
+        allocator_connection.autocommit = True
+        Model.id_allocator = IdAllocator(CountingCursor(allocator_connection.cursor()), args.id_block_size)
+        if args.bulk_load:
+            bulk_load = BulkLoad(cursor, [model.TABLE_NAME for model in MODELS], unlogged=args.unlogged)
+            bulk_load.disable()
+        if is_parallel:
+            # The clear and the bulk load DDL are committed first, as the targets'
+            # connections would wait for their locks
+            connection.commit()
+            fill_parallel(connection_pool, targets, bulk_load if args.bulk_load else None)
+        else:
+            fill(cursor, targets)
+        if args.bulk_load:
+            violations = bulk_load.restore()
+            if is_parallel:
+                # The rows of the targets are committed already, the constraints
+                # are restored all the same
+                connection.commit()
+            check_bulk_load(violations)
+        if not args.no_refresh:
+            refresh_rollups(cursor)
+
+    if args.action == 'append':
+        allocator_connection = connection_pool.getconn()
+        allocator_connection.autocommit = True
+        Model.id_allocator = IdAllocator(CountingCursor(allocator_connection.cursor()), args.id_block_size)
+        since = append(cursor)
+        if since is not None and not args.no_refresh:
+            # Everything new happens after since, including the ownerships closed
+            refresh_rollups(cursor, since)
+
+    if not args.dry:
+        connection.commit()
+    connection_pool.closeall()
+    report()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,263 @@
+import io
 import logging
+import re
+import threading
+from collections import deque
+from itertools import count, islice
+from operator import attrgetter
+import numpy as np
+from psycopg2.extras import execute_values
+
+
+def batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value) \
+        .replace('\\', '\\\\') \
+        .replace('\t', '\\t') \
+        .replace('\n', '\\n') \
+        .replace('\r', '\\r')
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    value = str(value)
+    if not value or any(c in value for c in ',"\n\r'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+# Column separator and value formatter of each COPY format
+_COPY_FORMATS = {
+    'text': ('\t', _copy_value),
+    'csv': (',', _csv_value),
+}
+
+_FILTER_OPERATORS = {
+    'eq': '=',
+    'ne': '<>',
+    'lt': '<',
+    'le': '<=',
+    'gt': '>',
+    'ge': '>=',
+}
+
+_cursor_numbers = count()
+
+
+def select_server_side(cursor, q, params=None, itersize=10000, prefix='rows'):
+    # Rows of the query fetched itersize at a time through a named cursor of the
+    # connection of cursor, so the result set never has to fit in memory
+    cursor_name = f'{prefix}_select_{next(_cursor_numbers)}'
+    with cursor.connection.cursor(cursor_name) as server_side_cursor:
+        server_side_cursor.itersize = itersize
+        server_side_cursor.execute(q, params)
+        yield from server_side_cursor
+
+
+def _copy_column(values, format_value=_copy_value):
+    if isinstance(values, np.ndarray):
+        if values.dtype.kind == 'M':
+            # NaT stands for NULL
+            strings = np.datetime_as_string(values).astype(object)
+            strings[np.isnat(values)] = None
+            values = strings
+        values = values.tolist()
+    return map(format_value, values)
+
+
+_CREATE_TABLE_RE = re.compile(r'^CREATE TABLE (\w+) \((.*?)^\);', re.MULTILINE | re.DOTALL)
+_TABLE_CONSTRAINT_KEYWORDS = {'CHECK', 'CONSTRAINT', 'EXCLUDE', 'FOREIGN', 'PRIMARY', 'UNIQUE'}
+_SERIAL_TYPES = {'serial', 'smallserial', 'bigserial'}
+
+
+def parse_schema(sql):
+    # Maps the names of the tables created by a schema script to their columns and
+    # the columns having a default, as init_fields() would read them from a database.
+    # Every column definition is expected to start on a line of its own.
+    schema = {}
+    for table_name, body in _CREATE_TABLE_RE.findall(sql):
+        fields = []
+        defaulted_fields = []
+        depth = 0
+        for line in body.split('\n'):
+            line = line.split('--')[0].strip()
+            if depth == 0 and line and line.split()[0].upper() not in _TABLE_CONSTRAINT_KEYWORDS:
+                field, type_name = (line.split() + [''])[:2]
+                fields.append(field)
+                if type_name.lower() in _SERIAL_TYPES or ' DEFAULT ' in f' {line.upper()} ':
+                    defaulted_fields.append(field)
+            depth += line.count('(') - line.count(')')
+        schema[table_name] = (fields, defaulted_fields)
+    return schema
+
+
+class IdAllocator:
+    # Reserves blocks of ids from the tables' serial sequences, so that entities get
+    # their ids on construction and linked rows can be written in any order. It may
+    # be shared between threads and, as sequences are not transactional, it can use
+    # a connection of its own.
+    def __init__(self, cursor, block_size=1000):
+        self.cursor = cursor
+        self.block_size = block_size
+        self.blocks = {}
+        self.lock = threading.Lock()
+
+    def _reserve(self, table_name, count):
+        q = '''SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)'''
+        logging.debug(q)
+        self.cursor.execute(q, (table_name, count))
+        return [id for id, in self.cursor.fetchall()]
+
+    def reserve(self, table_name, count):
+        with self.lock:
+            return self._reserve(table_name, count)
+
+    def __call__(self, table_name):
+        with self.lock:
+            block = self.blocks.get(table_name)
+            if not block:
+                block = self.blocks[table_name] = deque(self._reserve(table_name, self.block_size))
+            return block.popleft()
+
+
+class LocalIdAllocator:
+    # Hands out consecutive ids per table without a database
+    def __init__(self, start=1):
+        self.start = start
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def reserve(self, table_name, count):
+        with self.lock:
+            begin = self.counters.get(table_name, self.start)
+            self.counters[table_name] = begin + count
+        return list(range(begin, begin + count))
+
+    def __call__(self, table_name):
+        return self.reserve(table_name, 1)[0]
+
+
+class IdentityMap:
+    # Keeps the entities of a table read or written during a run by id and by natural
+    # key, so that each row is read from the database at most once and all readers
+    # share the same instances, which they must not modify. It may be shared between
+    # threads.
+    def __init__(self, model):
+        self.model = model
+        self.entities = {}
+        self.keys = {key: {} for key in model.NATURAL_KEYS}
+        self.is_complete = False
+        self.lock = threading.Lock()
+
+    def _add(self, entity):
+        # An entity already known by id stays the one returned
+        if entity.id is not None:
+            entity = self.entities.setdefault(entity.id, entity)
+        for key, index in self.keys.items():
+            value = getattr(entity, key)
+            if value is not None:
+                index.setdefault(value, entity)
+        return entity
+
+    def add(self, entities):
+        with self.lock:
+            for entity in entities:
+                self._add(entity)
+
+    def get(self, cursor, key, value):
+        with self.lock:
+            entity = (self.entities if key == 'id' else self.keys[key]).get(value)
+            if entity is None and not self.is_complete:
+                entity = next(self.model.select(cursor, {key: value}, limit=1), None)
+                if entity is not None:
+                    entity = self._add(entity)
+            return entity
+
+    def all(self, cursor):
+        with self.lock:
+            if not self.is_complete:
+                for entity in self.model.select(cursor):
+                    self._add(entity)
+                self.is_complete = True
+            return sorted(self.entities.values(), key=attrgetter('id'))
+
+    def clear(self):
+        with self.lock:
+            self.entities = {}
+            self.keys = {key: {} for key in self.model.NATURAL_KEYS}
+            self.is_complete = False
 
 
 class Model:
+    # Entities are instances of a compact record class generated per table from the
+    # live schema, with one slot per column. Subclasses declare __slots__ for their
+    # relationship attributes.
+    __slots__ = ()
     TABLE_NAME = None
     FIELDS = []
+    FIELD_POSITIONS = {}
+    DEFAULTED_FIELDS = frozenset()
+    # Columns holding ids of rows of other (or the same) tables
+    REFERENCES = {}
+    # Columns uniquely identifying rows besides the id
+    NATURAL_KEYS = ()
+    id_allocator = None
+    # IdentityMap of the entities of the table, if they are cached
+    identity_map = None
+    # YearPartitions of the table, if it is partitioned
+    partitions = None
+    _record_class = None
+    _get_values = staticmethod(lambda entity: ())
+
+    def __new__(cls, **kwargs):
+        return object.__new__(cls.__dict__.get('_record_class') or cls)
 
     def __init__(self, **kwargs):
         for field in self.FIELDS:
             setattr(self, field, kwargs.get(field, None))
+        if self.id_allocator is not None and 'id' in self.FIELDS and 'id' not in kwargs:
+            self.id = self.id_allocator(self.TABLE_NAME)
+
+    @classmethod
+    def set_fields(cls, fields, defaulted_fields=()):
+        cls.FIELDS = list(fields)
+        cls.FIELD_POSITIONS = {field: i for i, field in enumerate(cls.FIELDS)}
+        cls.DEFAULTED_FIELDS = frozenset(defaulted_fields)
+        cls._get_values = attrgetter(*cls.FIELDS)
+        cls._record_class = type(cls.__name__, (cls, ), {
+            '__slots__': tuple(cls.FIELDS),
+            '__module__': cls.__module__,
+            '__qualname__': cls.__qualname__,
+        })
 
     @classmethod
     def init_fields(cls, cursor):
         cursor.execute(f'''SELECT * FROM {cls.TABLE_NAME} LIMIT 0''')
-        cls.FIELDS = [desc[0] for desc in cursor.description]
+        fields = [desc[0] for desc in cursor.description]
+        cursor.execute('''
+            SELECT column_name FROM information_schema.columns
+            WHERE table_name = %s AND column_default IS NOT NULL
+        ''', (cls.TABLE_NAME, ))
+        cls.set_fields(fields, (column_name for column_name, in cursor.fetchall()))
 
     def values(self):
-        return tuple(getattr(self, field) for field in self.FIELDS)
+        values = self._get_values(self)
+        return values if len(self.FIELDS) != 1 else (values, )
 
     def _prepare_for_insert(self, cursor):
         pass
@@ -32,24 +274,215 @@ class Model:
             q = '''SELECT currval(pg_get_serial_sequence(%s, 'id'))'''
             cursor.execute(q, (self.TABLE_NAME, ))
             self.id, = cursor.fetchone()
+        if self.identity_map is not None:
+            self.identity_map.add([self])
+
+    @classmethod
+    def insert_many(cls, cursor, entities, batch_size=1000):
+        # Rows are grouped by the set of defaulted columns they leave unset, so that
+        # such columns keep their server-side defaults just like in insert().
+        # Without an id allocator, entities referencing each other (e.g. a rent and its
+        # previous rent) must be passed in separate calls, parents first.
+        count = 0
+        for batch in batches(entities, batch_size):
+            for columns, group in cls.group_by_columns(batch, cursor).items():
+                if 'id' in cls.FIELDS and 'id' not in columns:
+                    cls._insert_returning_ids(cursor, columns, group)
+                else:
+                    cls._copy(cursor, columns, (entity.values() for entity in group))
+                if cls.identity_map is not None:
+                    cls.identity_map.add(group)
+                count += len(group)
+        return count
+
+    @classmethod
+    def update_many(cls, cursor, entities, fields, batch_size=1000):
+        # Writes the given fields of entities of existing rows, matched by id
+        q = f'''
+            UPDATE {cls.TABLE_NAME} SET {', '.join(f'{field} = v.{field}' for field in fields)}
+            FROM (VALUES %s) AS v (id, {', '.join(fields)})
+            WHERE {cls.TABLE_NAME}.id = v.id
+        '''
+        count = 0
+        for batch in batches(entities, batch_size):
+            rows = [[entity.id] + [getattr(entity, field) for field in fields] for entity in batch]
+            logging.debug(q)
+            execute_values(cursor, q, rows, page_size=len(rows))
+            count += len(rows)
+        return count
+
+    @classmethod
+    def group_by_columns(cls, entities, cursor=None):
+        # Prepares entities for writing and groups them by the columns to be written:
+        # all but the defaulted ones they leave unset
+        groups = {}
+        for entity in entities:
+            entity._prepare_for_insert(cursor)
+            values = entity.values()
+            columns = tuple(
+                field for field, value in zip(cls.FIELDS, values)
+                if value is not None or field not in cls.DEFAULTED_FIELDS
+            )
+            groups.setdefault(columns, []).append(entity)
+        return groups
+
+    @classmethod
+    def format_rows(cls, columns, rows, format='text'):
+        # Renders rows of values() as lines of a COPY file with the given columns
+        separator, format_value = _COPY_FORMATS[format]
+        positions = [cls.FIELD_POSITIONS[column] for column in columns]
+        return (separator.join(format_value(values[i]) for i in positions) for values in rows)
+
+    @classmethod
+    def format_columns(cls, columns, format='text'):
+        # Renders a mapping of column names to equally long arrays or lists as lines
+        # of a COPY file
+        separator, format_value = _COPY_FORMATS[format]
+        return map(separator.join, zip(*(_copy_column(values, format_value) for values in columns.values())))
+
+    @classmethod
+    def _insert_returning_ids(cls, cursor, columns, entities):
+        positions = [cls.FIELD_POSITIONS[column] for column in columns]
+        rows = [[values[i] for i in positions] for values in map(cls.values, entities)]
+        q = f'''INSERT INTO {cls.TABLE_NAME} ({', '.join(columns)}) VALUES %s RETURNING id'''
+        logging.debug(q)
+        ids = execute_values(cursor, q, rows, page_size=len(rows), fetch=True)
+        for entity, (id, ) in zip(entities, ids):
+            entity.id = id
+
+    @classmethod
+    def _copy(cls, cursor, columns, rows):
+        cls._copy_lines(cursor, columns, cls.format_rows(columns, rows))
+
+    @classmethod
+    def _copy_lines(cls, cursor, columns, lines):
+        buffer = io.StringIO()
+        for line in lines:
+            buffer.write(line)
+            buffer.write('\n')
+        buffer.seek(0)
+        q = f'''COPY {cls.TABLE_NAME} ({', '.join(columns)}) FROM STDIN'''
+        logging.debug(q)
+        cursor.copy_expert(q, buffer)
+
+    @classmethod
+    def insert_columns(cls, cursor, columns, batch_size=1000):
+        # Writes rows given as a mapping of column names to equally long arrays or
+        # lists, without building entities. Ids are reserved per batch if needed.
+        count = len(next(iter(columns.values())))
+        for begin in range(0, count, batch_size):
+            batch = {column: values[begin:begin + batch_size] for column, values in columns.items()}
+            if cls.id_allocator is not None and 'id' in cls.FIELDS and 'id' not in batch:
+                batch['id'] = cls.id_allocator.reserve(cls.TABLE_NAME, min(batch_size, count - begin))
+            cls._copy_lines(cursor, list(batch), cls.format_columns(batch))
+        return count
+
+    @classmethod
+    def _where(cls, filters):
+        # Filters map a field, optionally suffixed with an operator (e.g. 'id__in',
+        # 'begin_timestamp__ge'), to a value that is passed as a bound parameter
+        conditions = []
+        params = []
+        for key, value in filters.items():
+            field, _, operator = key.partition('__')
+            if operator == 'in':
+                conditions.append(f'{field} = ANY(%s)')
+                params.append(list(value))
+            elif value is None and operator in ('', 'eq', 'ne'):
+                conditions.append(f'{field} IS {"NOT " if operator == "ne" else ""}NULL')
+            else:
+                conditions.append(f'{field} {_FILTER_OPERATORS[operator or "eq"]} %s')
+                params.append(value)
+        return ' AND '.join(conditions), params
 
     @classmethod
-    def select(cls, cursor, filters={}, limit=None):
-        q = f'SELECT * FROM {cls.TABLE_NAME}'
-        if filters:
-            q_filter = ' AND '.join(f'{field} = {repr(value)}' for field, value in filters.items())
+    def _from_row(cls, columns, row):
+        kwargs = dict(zip(columns, row))
+        # Entities read without their id must not get one from the allocator
+        kwargs.setdefault('id', None)
+        return cls(**kwargs)
+
+    @classmethod
+    def select(cls, cursor, filters={}, limit=None, columns=None, order_by=None, itersize=None):
+        columns = list(columns or cls.FIELDS)
+        q = f'SELECT {", ".join(columns)} FROM {cls.TABLE_NAME}'
+        q_filter, params = cls._where(filters)
+        if q_filter:
             q += f' WHERE {q_filter}'
+        if order_by is not None:
+            q += f' ORDER BY {order_by}'
         if limit is not None:
-            q += f' LIMIT {limit}'
+            q += ' LIMIT %s'
+            params.append(limit)
         logging.debug(q)
-        cursor.execute(q)
-        return (cls(**dict(zip(cls.FIELDS, t))) for t in cursor.fetchall())
+        if itersize is None:
+            cursor.execute(q, params)
+            return (cls._from_row(columns, row) for row in cursor.fetchall())
+        return cls._select_server_side(cursor, q, params, columns, itersize)
+
+    @classmethod
+    def _select_server_side(cls, cursor, q, params, columns, itersize):
+        for row in select_server_side(cursor, q, params, itersize, cls.TABLE_NAME):
+            yield cls._from_row(columns, row)
+
+    @classmethod
+    def get(cls, cursor, **key):
+        # Returns the entity with the given id or natural key (e.g. name='...'), or
+        # None if there is none
+        (key, value), = key.items()
+        if cls.identity_map is not None:
+            return cls.identity_map.get(cursor, key, value)
+        return next(cls.select(cursor, {key: value}, limit=1), None)
+
+    @classmethod
+    def select_all(cls, cursor):
+        # Returns all entities of the table ordered by id
+        if cls.identity_map is not None:
+            return cls.identity_map.all(cursor)
+        return list(cls.select(cursor, order_by='id'))
 
     @classmethod
     def clear(cls, cursor):
         cursor.execute(f'''DELETE FROM {cls.TABLE_NAME}''')
+        if cls.identity_map is not None:
+            cls.identity_map.clear()
         return cursor.rowcount
 
+    @staticmethod
+    def truncate(cursor, models):
+        # Empties the tables of the models at once and restarts their sequences. The
+        # tables referencing them must be among them, as it does not cascade.
+        cursor.execute(f'''TRUNCATE {', '.join(model.TABLE_NAME for model in models)} RESTART IDENTITY''')
+        for model in models:
+            if model.identity_map is not None:
+                model.identity_map.clear()
+
+    @classmethod
+    def delete_referencing(cls, cursor, table_name, ids_table):
+        # Deletes the rows referencing the rows of table_name whose ids are in
+        # ids_table, for references that are not backed by foreign keys
+        n = 0
+        for field, referenced_table_name in cls.REFERENCES.items():
+            if referenced_table_name == table_name and table_name != cls.TABLE_NAME:
+                cursor.execute(f'''
+                    DELETE FROM {cls.TABLE_NAME} USING {ids_table} WHERE {cls.TABLE_NAME}.{field} = {ids_table}.id
+                ''')
+                n += cursor.rowcount
+        return n
+
+    @classmethod
+    def unlink_referencing(cls, cursor, ids_table):
+        # Sets to NULL the references of rows of the table to its own rows whose ids
+        # are in ids_table, as ON DELETE SET NULL would
+        n = 0
+        for field, referenced_table_name in cls.REFERENCES.items():
+            if referenced_table_name == cls.TABLE_NAME:
+                cursor.execute(f'''
+                    UPDATE {cls.TABLE_NAME} SET {field} = NULL FROM {ids_table} WHERE {cls.TABLE_NAME}.{field} = {ids_table}.id
+                ''')
+                n += cursor.rowcount
+        return n
+
     def __repr__(self):
         content = ', '.join(f'{field}={repr(value)}' for field, value in zip(self.FIELDS, self.values()) if value is not None)
         return f'{type(self).__name__}({content})'
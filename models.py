@@ -1,17 +1,22 @@
-from model import Model
+from model import IdentityMap, Model, parse_schema
 from decimal import *
 
 
 class Customer(Model):
+    __slots__ = ()
     TABLE_NAME = 'customer'
 
 
 class Manufacturer(Model):
+    __slots__ = ()
     TABLE_NAME = 'manufacturer'
+    NATURAL_KEYS = ('name', )
 
 
 class DeviceModelProperty(Model):
+    __slots__ = ('device_model', )
     TABLE_NAME = 'device_model_property'
+    REFERENCES = {'device_model_id': 'device_model'}
 
     def __init__(self, device_model=None, **kwargs):
         self.device_model = device_model
@@ -23,7 +28,9 @@ class DeviceModelProperty(Model):
 
 
 class DeviceModelImage(Model):
+    __slots__ = ('device_model', )
     TABLE_NAME = 'device_model_image'
+    REFERENCES = {'device_model_id': 'device_model'}
 
     def __init__(self, device_model=None, **kwargs):
         self.device_model = device_model
@@ -35,19 +42,33 @@ class DeviceModelImage(Model):
 
 
 class DeviceModel(Model):
+    __slots__ = ()
     TABLE_NAME = 'device_model'
+    REFERENCES = {'manufacturer_id': 'manufacturer'}
+    NATURAL_KEYS = ('name', )
 
 
 class Device(Model):
+    __slots__ = ()
     TABLE_NAME = 'device'
+    REFERENCES = {'model_id': 'device_model'}
 
 
 class DeviceOwnership(Model):
+    __slots__ = ()
     TABLE_NAME = 'device_ownership'
+    REFERENCES = {'device_id': 'device'}
 
 
 class DeviceRent(Model):
+    __slots__ = ('previous_device_rent', )
     TABLE_NAME = 'device_rent'
+    REFERENCES = {
+        'customer_id': 'customer',
+        'device_model_id': 'device_model',
+        'previous_device_rent_id': 'device_rent',
+        'chain_id': 'device_rent',
+    }
 
     def __init__(self, previous_device_rent=None, **kwargs):
         self.previous_device_rent = previous_device_rent
@@ -59,7 +80,12 @@ class DeviceRent(Model):
 
 
 class DeviceRentOwnership(Model):
+    __slots__ = ('device_rent', 'device_ownership')
     TABLE_NAME = 'device_rent_ownership'
+    REFERENCES = {
+        'device_rent_id': 'device_rent',
+        'device_ownership_id': 'device_ownership',
+    }
 
     def __init__(self, device_rent=None, device_ownership=None, **kwargs):
         self.device_rent = device_rent
@@ -77,7 +103,9 @@ def _parse_money(money):
     return Decimal(money[1:].replace(',', ''))
 
 class DeviceRepair(Model):
+    __slots__ = ('device_ownership', )
     TABLE_NAME = 'device_repair'
+    REFERENCES = {'device_ownership_id': 'device_ownership'}
 
     def __init__(self, device_ownership=None, **kwargs):
         self.device_ownership = device_ownership
@@ -88,11 +116,15 @@ class DeviceRepair(Model):
     def _prepare_for_insert(self, cursor):
         if self.device_ownership is not None:
             self.device_ownership_id = self.device_ownership.id
-            self.device_id = self.device_ownership.device_id
 
 
 class DamageFine(Model):
+    __slots__ = ()
     TABLE_NAME = 'damage_fine'
+    REFERENCES = {
+        'device_ownership_id': 'device_ownership',
+        'device_repair_id': 'device_repair',
+    }
 
     def __init__(self, **kwargs):
         if isinstance(kwargs.get('fine', None), str) and kwargs['fine'].startswith('$'):
@@ -101,11 +133,15 @@ class DamageFine(Model):
 
 
 class DeviceModelRentPrice(Model):
+    __slots__ = ()
     TABLE_NAME = 'device_model_rent_price'
+    REFERENCES = {'device_model_id': 'device_model'}
 
 
 class Feedback(Model):
+    __slots__ = ()
     TABLE_NAME = 'feedback'
+    REFERENCES = {'device_rent_id': 'device_rent'}
 
 
 MODELS = [
@@ -124,6 +160,20 @@ MODELS = [
     Feedback,
 ]
 
+def init_identity_maps():
+    # Reference tables, the ones having natural keys, are cached for the run
+    for model in MODELS:
+        model.identity_map = IdentityMap(model) if model.NATURAL_KEYS else None
+
 def init_models(cursor):
     for model in MODELS:
         model.init_fields(cursor)
+    init_identity_maps()
+
+def init_models_from_schema(filename):
+    # Takes the columns from the schema script, for working without a database
+    with open(filename, 'r') as schema_file:
+        schema = parse_schema(schema_file.read())
+    for model in MODELS:
+        model.set_fields(*schema[model.TABLE_NAME])
+    init_identity_maps()
@@ -46,7 +46,7 @@ COMMENT ON TYPE device_kind IS 'Тип устройства';
 
 CREATE TABLE device_model (
     id serial PRIMARY KEY,
-    manufacturer_id integer REFERENCES manufacturer (id) ON DELETE SET NULL,
+    manufacturer_id integer REFERENCES manufacturer (id) ON DELETE SET NULL DEFERRABLE,
     kind device_kind,
     name text
 );
@@ -60,7 +60,7 @@ COMMENT ON COLUMN device_model.name IS 'Название модели';
 --- Характеристика модели устройства ------------------------------------------
 
 CREATE TABLE device_model_property (
-    device_model_id integer NOT NULL REFERENCES device_model (id) ON DELETE CASCADE,
+    device_model_id integer NOT NULL REFERENCES device_model (id) ON DELETE CASCADE DEFERRABLE,
     key text NOT NULL,
     value text,
 
@@ -75,7 +75,7 @@ COMMENT ON COLUMN device_model_property.value IS 'Значение характ
 --- Ссылка на изображение модели устройства -----------------------------------
 
 CREATE TABLE device_model_image (
-    device_model_id integer NOT NULL REFERENCES device_model (id) ON DELETE CASCADE,
+    device_model_id integer NOT NULL REFERENCES device_model (id) ON DELETE CASCADE DEFERRABLE,
     image_url text NOT NULL,
 
     PRIMARY KEY (device_model_id, image_url)
@@ -88,7 +88,7 @@ COMMENT ON COLUMN device_model_image.image_url IS 'URL изображения';
 --- Цена аренды устройсва -----------------------------------------------------
 
 CREATE TABLE device_model_rent_price (
-    device_model_id integer NOT NULL REFERENCES device_model (id) ON DELETE CASCADE,
+    device_model_id integer NOT NULL REFERENCES device_model (id) ON DELETE CASCADE DEFERRABLE,
     price money NOT NULL,
     update_timestamp timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
 
@@ -104,7 +104,7 @@ COMMENT ON COLUMN device_model_rent_price.update_timestamp IS 'Дата и вр
 
 CREATE TABLE device (
     id serial PRIMARY KEY,
-    model_id integer REFERENCES device_model (id) ON DELETE SET NULL,
+    model_id integer REFERENCES device_model (id) ON DELETE SET NULL DEFERRABLE,
     purchase_timestamp timestamp DEFAULT CURRENT_TIMESTAMP,
     retirement_timestamp timestamp,
     condition smallint CHECK (condition BETWEEN 1 AND 10),
@@ -130,7 +130,7 @@ COMMENT ON TYPE device_return_status IS 'Статус возврата дева
 
 CREATE TABLE device_ownership (
     id serial PRIMARY KEY,
-    device_id integer REFERENCES device (id) ON DELETE SET NULL,
+    device_id integer REFERENCES device (id) ON DELETE SET NULL DEFERRABLE,
     begin_timestamp timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
     end_timestamp timestamp,
     city varchar (50) DEFAULT 'Москва',
@@ -145,6 +145,8 @@ COMMENT ON COLUMN device_ownership.end_timestamp IS 'Дата и время ок
 COMMENT ON COLUMN device_ownership.city IS 'Город, в котором находилось устройство';
 COMMENT ON COLUMN device_ownership.return_status IS 'Статус возврата устройства';
 
+CREATE INDEX device_ownership_device_id_idx ON device_ownership (device_id, begin_timestamp);
+
 -- Провека того, что временная метка принадлежит хотя бы одному периоду владения устройством
 CREATE OR REPLACE FUNCTION is_within_device_ownership(required_device_id integer, ts timestamp)
     RETURNS BOOLEAN
@@ -169,12 +171,14 @@ ALTER TABLE device_ownership ADD CONSTRAINT device_ownership_check_end_timestamp
 
 CREATE TABLE device_rent (
     id serial PRIMARY KEY,
-    customer_id integer REFERENCES customer (id) ON DELETE SET NULL,
-    device_model_id integer REFERENCES device_model (id) ON DELETE SET NULL,
+    customer_id integer REFERENCES customer (id) ON DELETE SET NULL DEFERRABLE,
+    device_model_id integer REFERENCES device_model (id) ON DELETE SET NULL DEFERRABLE,
     begin_timestamp timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
     end_timestamp timestamp,
     is_insured boolean DEFAULT FALSE,
-    previous_device_rent_id integer REFERENCES device_rent (id) ON DELETE SET NULL,
+    previous_device_rent_id integer REFERENCES device_rent (id) ON DELETE SET NULL DEFERRABLE,
+    chain_id integer,
+    chain_position integer,
     CHECK ((end_timestamp IS NULL) OR (begin_timestamp < end_timestamp)),
     CHECK (previous_device_rent_id <> id)
 );
@@ -186,6 +190,12 @@ COMMENT ON COLUMN device_rent.begin_timestamp IS 'Дата и время нач
 COMMENT ON COLUMN device_rent.end_timestamp IS 'Дата и время конца аренды устройства';
 COMMENT ON COLUMN device_rent.is_insured IS 'Наличие страховки устройства';
 COMMENT ON COLUMN device_rent.previous_device_rent_id IS 'Предыдущий период аренды в случае продления';
+COMMENT ON COLUMN device_rent.chain_id IS 'Уникальный идентификатор первого периода аренды в цепочке продлений';
+COMMENT ON COLUMN device_rent.chain_position IS 'Номер периода аренды в цепочке продлений (начиная с 0)';
+
+CREATE INDEX device_rent_previous_device_rent_id_idx ON device_rent (previous_device_rent_id);
+CREATE INDEX device_rent_chain_idx ON device_rent (chain_id, chain_position);
+CREATE INDEX device_rent_customer_id_idx ON device_rent (customer_id);
 
 CREATE OR REPLACE FUNCTION device_rent_end_timestamp(idx integer)
     RETURNS timestamp
@@ -202,20 +212,40 @@ ALTER TABLE device_rent ADD CONSTRAINT device_rent_check_previous_device_rent_en
 -- Получение последовательности всех последующих продленных аренд
 CREATE OR REPLACE FUNCTION succeeding_device_rents(device_rent_id integer)
     RETURNS SETOF device_rent
-    LANGUAGE PLpgSQL AS
+    LANGUAGE SQL STABLE AS
+$func$
+    WITH RECURSIVE succeeding AS (
+        SELECT * FROM device_rent WHERE previous_device_rent_id = $1
+        UNION ALL
+        SELECT device_rent.* FROM device_rent
+        JOIN succeeding ON device_rent.previous_device_rent_id = succeeding.id
+    )
+    SELECT * FROM succeeding;
+$func$;
+
+-- Автоматическое заполнение цепочки продлений
+CREATE OR REPLACE FUNCTION device_rent_default_chain()
+    RETURNS trigger
+    LANGUAGE plpgsql AS
 $func$
-DECLARE
-    x device_rent%rowtype;
 BEGIN
-    LOOP
-        SELECT * FROM device_rent WHERE previous_device_rent_id = device_rent_id INTO x;
-        EXIT WHEN x IS NULL;
-        RETURN NEXT x;
-        device_rent_id := x.id;
-    END LOOP;
+    IF NEW.previous_device_rent_id IS NULL THEN
+        NEW.chain_id := NEW.id;
+        NEW.chain_position := 0;
+    ELSE
+        SELECT chain_id, chain_position + 1 FROM device_rent WHERE id = NEW.previous_device_rent_id
+            INTO NEW.chain_id, NEW.chain_position;
+    END IF;
+    RETURN NEW;
 END
 $func$;
 
+CREATE TRIGGER device_rent_default_chain_trigger
+BEFORE INSERT ON device_rent
+FOR EACH ROW
+WHEN (NEW.chain_id IS NULL)
+EXECUTE PROCEDURE device_rent_default_chain();
+
 -- Автоматическая инициализация времени окончания аренды
 CREATE OR REPLACE FUNCTION device_rent_default_end_timestamp() 
     RETURNS trigger
@@ -236,15 +266,17 @@ EXECUTE PROCEDURE device_rent_default_end_timestamp();
 --- Связь периодов аренды устройств и вледения ими ---------------------------
 
 CREATE TABLE device_rent_ownership (
-    device_rent_id integer REFERENCES device_rent (id) ON DELETE CASCADE,
-    device_ownership_id integer REFERENCES device_ownership (id) ON DELETE CASCADE,
+    device_rent_id integer REFERENCES device_rent (id) ON DELETE CASCADE DEFERRABLE,
+    device_ownership_id integer REFERENCES device_ownership (id) ON DELETE CASCADE DEFERRABLE,
     PRIMARY KEY (device_rent_id, device_ownership_id)
 );
 
+CREATE INDEX device_rent_ownership_device_ownership_id_idx ON device_rent_ownership (device_ownership_id);
+
 --- Отзыв пользователя об аранде девайса --------------------------------------
 
 CREATE TABLE feedback (
-    device_rent_id serial PRIMARY KEY REFERENCES device_rent (id) ON DELETE CASCADE,
+    device_rent_id serial PRIMARY KEY REFERENCES device_rent (id) ON DELETE CASCADE DEFERRABLE,
     stars smallint NOT NULL CHECK (stars BETWEEN 1 AND 5),
     timestamp timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
     message text
@@ -259,7 +291,7 @@ COMMENT ON COLUMN feedback.message IS 'Текст отзыва пользова
 
 CREATE TABLE device_repair (
     id serial PRIMARY KEY,
-    device_ownership_id integer REFERENCES device_ownership (id) ON DELETE CASCADE,
+    device_ownership_id integer REFERENCES device_ownership (id) ON DELETE CASCADE DEFERRABLE,
     price money,
     begin_timestamp timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
     end_timestamp timestamp,
@@ -275,12 +307,139 @@ COMMENT ON COLUMN device_repair.end_timestamp IS 'Дата и время око
 --- Штраф за поломку устройства -----------------------------------------------
 
 CREATE TABLE damage_fine (
-    device_ownership_id integer PRIMARY KEY REFERENCES device_ownership (id) ON DELETE CASCADE,
+    device_ownership_id integer PRIMARY KEY REFERENCES device_ownership (id) ON DELETE CASCADE DEFERRABLE,
     fine money NOT NULL,
-    device_repair_id integer REFERENCES device_repair (id) ON DELETE SET NULL
+    device_repair_id integer REFERENCES device_repair (id) ON DELETE SET NULL DEFERRABLE
 );
 
 COMMENT ON TABLE damage_fine IS 'Штраф за поломку устройства';
 COMMENT ON COLUMN damage_fine.device_ownership_id IS 'Уникальный идентификатор периода владения устройством, во время которого случилась поломка';
 COMMENT ON COLUMN damage_fine.fine IS 'Размер  штрафа';
 COMMENT ON COLUMN damage_fine.device_repair_id IS 'Уникальный идентификатор починки устройства';
+
+--- Выручка -------------------------------------------------------------------
+
+CREATE INDEX device_rent_begin_timestamp_idx ON device_rent (begin_timestamp);
+CREATE INDEX device_repair_begin_timestamp_idx ON device_repair (begin_timestamp);
+
+-- Цена, действовавшая для модели устройства на момент начала аренды. Ищется по
+-- первичному ключу device_model_rent_price (device_model_id, update_timestamp)
+CREATE OR REPLACE VIEW device_rent_price AS
+SELECT device_rent.id AS device_rent_id, device_rent.begin_timestamp, device_rent.is_insured, price.price
+FROM device_rent
+LEFT JOIN LATERAL (
+    SELECT device_model_rent_price.price FROM device_model_rent_price
+    WHERE device_model_rent_price.device_model_id = device_rent.device_model_id
+        AND device_model_rent_price.update_timestamp <= device_rent.begin_timestamp
+    ORDER BY device_model_rent_price.update_timestamp DESC
+    LIMIT 1
+) AS price ON TRUE;
+
+CREATE TABLE revenue_monthly (
+    month date PRIMARY KEY,
+    rent_income money NOT NULL,
+    insurance_income money NOT NULL,
+    fine_income money NOT NULL,
+    repair_expenses money NOT NULL
+);
+
+COMMENT ON TABLE revenue_monthly IS 'Выручка по месяцам (обновляется функцией refresh_revenue_rollups)';
+COMMENT ON COLUMN revenue_monthly.month IS 'Первый день месяца';
+COMMENT ON COLUMN revenue_monthly.rent_income IS 'Доход от аренды';
+COMMENT ON COLUMN revenue_monthly.insurance_income IS 'Доход от страховок';
+COMMENT ON COLUMN revenue_monthly.fine_income IS 'Доход от штрафов';
+COMMENT ON COLUMN revenue_monthly.repair_expenses IS 'Расходы на ремонт';
+
+CREATE TABLE revenue_rollup_state (
+    id boolean PRIMARY KEY DEFAULT TRUE CHECK (id),
+    device_rent_id integer NOT NULL DEFAULT 0,
+    device_ownership_id integer NOT NULL DEFAULT 0,
+    device_repair_id integer NOT NULL DEFAULT 0,
+    damage_fine_count bigint NOT NULL DEFAULT 0,
+    rent_price_count bigint NOT NULL DEFAULT 0
+);
+
+COMMENT ON TABLE revenue_rollup_state IS 'Данные, уже учтенные в revenue_monthly';
+
+INSERT INTO revenue_rollup_state DEFAULT VALUES;
+
+-- Пересчет выручки за месяцы начиная с since. Без since пересчитываются месяцы,
+-- затронутые строками, добавленными после прошлого пересчета, а при изменении
+-- цен аренды или штрафах за старые периоды владения - все месяцы. Удаление строк так не обнаруживается, после него
+-- нужен пересчет с since = '-infinity'. Возвращает первый пересчитанный месяц.
+CREATE OR REPLACE FUNCTION refresh_revenue_rollups(since timestamp DEFAULT NULL)
+    RETURNS date
+    LANGUAGE plpgsql AS
+$func$
+DECLARE
+    state revenue_rollup_state;
+    from_month date;
+BEGIN
+    SELECT * FROM revenue_rollup_state INTO state FOR UPDATE;
+    IF since IS NULL THEN
+        IF (SELECT COUNT(*) FROM device_model_rent_price) <> state.rent_price_count
+            OR (SELECT COUNT(*) FROM damage_fine WHERE device_ownership_id <= state.device_ownership_id) <> state.damage_fine_count
+        THEN
+            since := '-infinity';
+        ELSE
+            since := LEAST(
+                (SELECT MIN(begin_timestamp) FROM device_rent WHERE id > state.device_rent_id),
+                (SELECT MIN(device_ownership.end_timestamp) FROM damage_fine
+                    JOIN device_ownership ON device_ownership.id = damage_fine.device_ownership_id
+                    WHERE damage_fine.device_ownership_id > state.device_ownership_id),
+                (SELECT MIN(begin_timestamp) FROM device_repair WHERE id > state.device_repair_id)
+            );
+        END IF;
+    END IF;
+    IF since IS NOT NULL THEN
+        from_month := CASE WHEN isfinite(since) THEN date_trunc('month', since)::date ELSE '-infinity'::date END;
+        DELETE FROM revenue_monthly WHERE month >= from_month;
+        INSERT INTO revenue_monthly (month, rent_income, insurance_income, fine_income, repair_expenses)
+        SELECT month, SUM(rent_income), SUM(insurance_income), SUM(fine_income), SUM(repair_expenses) FROM (
+            SELECT
+                date_trunc('month', begin_timestamp)::date AS month,
+                COALESCE(price, 0::money) AS rent_income,
+                (is_insured::integer * 500)::money AS insurance_income,
+                0::money AS fine_income,
+                0::money AS repair_expenses
+            FROM device_rent_price
+            WHERE begin_timestamp >= from_month
+            UNION ALL
+            SELECT date_trunc('month', device_ownership.end_timestamp)::date, 0::money, 0::money, damage_fine.fine, 0::money
+            FROM damage_fine
+            JOIN device_ownership ON device_ownership.id = damage_fine.device_ownership_id
+            WHERE device_ownership.end_timestamp >= from_month
+            UNION ALL
+            SELECT date_trunc('month', begin_timestamp)::date, 0::money, 0::money, 0::money, COALESCE(price, 0::money)
+            FROM device_repair
+            WHERE begin_timestamp >= from_month
+        ) AS t
+        GROUP BY month;
+    END IF;
+    UPDATE revenue_rollup_state SET
+        device_rent_id = COALESCE((SELECT MAX(id) FROM device_rent), 0),
+        device_ownership_id = COALESCE((SELECT MAX(id) FROM device_ownership), 0),
+        device_repair_id = COALESCE((SELECT MAX(id) FROM device_repair), 0),
+        damage_fine_count = (SELECT COUNT(*) FROM damage_fine),
+        rent_price_count = (SELECT COUNT(*) FROM device_model_rent_price);
+    RETURN from_month;
+END
+$func$;
+
+CREATE OR REPLACE VIEW revenue_yearly AS
+SELECT
+    EXTRACT(YEAR FROM month)::integer AS year,
+    SUM(rent_income) AS rent_income,
+    SUM(insurance_income) AS insurance_income,
+    SUM(fine_income) AS fine_income,
+    SUM(repair_expenses) AS repair_expenses,
+    SUM(rent_income + insurance_income + fine_income - repair_expenses) AS total_revenue
+FROM revenue_monthly
+GROUP BY EXTRACT(YEAR FROM month);
+
+--- Продолжение истории -------------------------------------------------------
+
+-- Поиск конца истории, незавершенных периодов владения и устройств в ремонте при
+-- дополнении данных (manager.py append)
+CREATE INDEX device_ownership_end_timestamp_idx ON device_ownership (end_timestamp);
+CREATE INDEX device_repair_end_timestamp_idx ON device_repair (end_timestamp);
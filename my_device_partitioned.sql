@@ -0,0 +1,119 @@
+--- База данных my_device с секционированной историей ---
+
+-- Схема my_device.sql, в которой таблицы истории секционированы по годам:
+-- device_rent по begin_timestamp, device_ownership по begin_timestamp и feedback
+-- по timestamp. Внешние ключи, ссылающиеся на эти таблицы, не создаются, так как
+-- первичный ключ секционированной таблицы обязан включать ключ секционирования.
+-- Требуется PostgreSQL 13 или новее.
+
+\ir my_device.sql
+
+--- Секционирование -------------------------------------------------------------
+
+-- Пересоздание таблицы секционированной по диапазонам значений столбца. Индексы,
+-- триггеры, внешние ключи на несекционированные таблицы, зависящие представления
+-- и комментарии переносятся, первичный ключ дополняется ключом секционирования.
+CREATE OR REPLACE FUNCTION partition_by_range(relation_name text, partition_column text)
+    RETURNS void
+    LANGUAGE plpgsql AS
+$func$
+DECLARE
+    relation regclass := relation_name::regclass;
+    old_relation_name text := relation_name || '_unpartitioned';
+    relation_comment text := obj_description(relation_name::regclass, 'pg_class');
+    primary_key text[];
+    definitions text[] := '{}';
+    definition text;
+    r record;
+BEGIN
+    SELECT array_agg(pg_attribute.attname ORDER BY k.i) FROM pg_constraint
+    CROSS JOIN LATERAL unnest(pg_constraint.conkey) WITH ORDINALITY AS k(attnum, i)
+    JOIN pg_attribute ON pg_attribute.attrelid = pg_constraint.conrelid AND pg_attribute.attnum = k.attnum
+    WHERE pg_constraint.conrelid = relation AND pg_constraint.contype = 'p'
+    INTO primary_key;
+    IF NOT partition_column = ANY(primary_key) THEN
+        primary_key := primary_key || partition_column;
+    END IF;
+    FOR r IN
+        SELECT attname, pg_get_serial_sequence(relation_name, attname) AS sequence_name FROM pg_attribute
+        WHERE attrelid = relation AND attnum > 0 AND NOT attisdropped
+    LOOP
+        IF r.sequence_name IS NOT NULL THEN
+            EXECUTE format('ALTER SEQUENCE %s OWNED BY NONE', r.sequence_name);
+            definitions := definitions || format('ALTER SEQUENCE %s OWNED BY %I.%I', r.sequence_name, relation_name, r.attname);
+        END IF;
+    END LOOP;
+    definitions := definitions || format('ALTER TABLE %I ADD PRIMARY KEY (%s)', relation_name, (
+        SELECT string_agg(quote_ident(column_name), ', ') FROM unnest(primary_key) AS column_name
+    ));
+    definitions := definitions || ARRAY(
+        SELECT pg_get_indexdef(indexrelid) FROM pg_index WHERE indrelid = relation AND NOT indisprimary
+    );
+    definitions := definitions || ARRAY(
+        SELECT pg_get_triggerdef(oid) FROM pg_trigger WHERE tgrelid = relation AND NOT tgisinternal
+    );
+    definitions := definitions || ARRAY(
+        SELECT format('ALTER TABLE %I ADD CONSTRAINT %I %s', relation_name, conname, pg_get_constraintdef(pg_constraint.oid))
+        FROM pg_constraint
+        JOIN pg_class ON pg_class.oid = pg_constraint.confrelid
+        WHERE conrelid = relation AND contype = 'f' AND confrelid <> relation AND pg_class.relkind <> 'p'
+    );
+    -- Функции, возвращающие или принимающие строки таблицы, удаляются вместе с ней
+    definitions := definitions || ARRAY(
+        SELECT pg_get_functiondef(pg_depend.objid)
+        FROM pg_depend
+        WHERE pg_depend.classid = 'pg_proc'::regclass
+            AND pg_depend.refobjid = (SELECT reltype FROM pg_class WHERE oid = relation)
+    );
+    definitions := definitions || ARRAY(
+        SELECT DISTINCT format('CREATE VIEW %s AS %s', dependent_view.oid::regclass, pg_get_viewdef(dependent_view.oid))
+        FROM pg_depend
+        JOIN pg_rewrite ON pg_rewrite.oid = pg_depend.objid
+        JOIN pg_class AS dependent_view ON dependent_view.oid = pg_rewrite.ev_class
+        WHERE pg_depend.classid = 'pg_rewrite'::regclass AND pg_depend.refobjid = relation AND dependent_view.oid <> relation
+    );
+    EXECUTE format('ALTER TABLE %I RENAME TO %I', relation_name, old_relation_name);
+    EXECUTE format(
+        'CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING COMMENTS) PARTITION BY RANGE (%I)',
+        relation_name, old_relation_name, partition_column
+    );
+    EXECUTE format('DROP TABLE %I CASCADE', old_relation_name);
+    FOREACH definition IN ARRAY definitions LOOP
+        EXECUTE definition;
+    END LOOP;
+    EXECUTE format('COMMENT ON TABLE %I IS %L', relation_name, relation_comment);
+END
+$func$;
+
+-- Создание недостающих годовых секций таблицы, покрывающих промежуток времени.
+-- Секция года Y называется <таблица>_yY. Возвращает число созданных секций.
+CREATE OR REPLACE FUNCTION ensure_partitions(relation_name text, from_timestamp timestamp, until_timestamp timestamp)
+    RETURNS integer
+    LANGUAGE plpgsql AS
+$func$
+DECLARE
+    partition_year integer;
+    created integer := 0;
+BEGIN
+    FOR partition_year IN EXTRACT(YEAR FROM from_timestamp)::integer .. EXTRACT(YEAR FROM until_timestamp)::integer LOOP
+        IF to_regclass(quote_ident(relation_name || '_y' || partition_year)) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                relation_name || '_y' || partition_year, relation_name,
+                make_timestamp(partition_year, 1, 1, 0, 0, 0), make_timestamp(partition_year + 1, 1, 1, 0, 0, 0)
+            );
+            created := created + 1;
+        END IF;
+    END LOOP;
+    RETURN created;
+END
+$func$;
+
+SELECT partition_by_range('device_rent', 'begin_timestamp');
+SELECT partition_by_range('device_ownership', 'begin_timestamp');
+SELECT partition_by_range('feedback', 'timestamp');
+
+-- Секции на промежуток, который покрывает генератор данных. Остальные создаются
+-- скриптом заполнения по мере надобности.
+SELECT ensure_partitions(relation_name, '2016-01-01', LOCALTIMESTAMP + interval '1 year')
+FROM unnest(ARRAY['device_rent', 'device_ownership', 'feedback']) AS relation_name;
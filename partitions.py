@@ -0,0 +1,112 @@
+import logging
+import threading
+from datetime import datetime
+import numpy as np
+
+
+class YearPartitions:
+    # Yearly RANGE partitions <table>_y<year> of a table of the partitioned schema
+    # (my_device_partitioned.sql). Batches are split by year and written to the
+    # partitions directly. Partitions missing for a batch are created on demand by
+    # ensure_partitions() in the writer's transaction.
+    def __init__(self, model, column):
+        self.model = model
+        self.column = column
+        self.years = set()
+        self.partition_models = {}
+        self.lock = threading.Lock()
+
+    def name(self, year):
+        return f'{self.model.TABLE_NAME}_y{year}'
+
+    def partition_model(self, year):
+        # The model writing to the partition of the year. Rows without a value of the
+        # partition key are written to the table itself.
+        if year is None:
+            return self.model
+        if year not in self.partition_models:
+            self.partition_models[year] = type(self.model.__name__, (self.model, ), {
+                '__slots__': (),
+                '__module__': self.model.__module__,
+                'TABLE_NAME': self.name(year),
+                'partitions': None,
+            })
+        return self.partition_models[year]
+
+    def ensure(self, cursor, years):
+        with self.lock:
+            missing = sorted(set(years) - self.years)
+            if not missing:
+                return
+            cursor.execute(
+                'SELECT ensure_partitions(%s, %s, %s)',
+                (self.model.TABLE_NAME, datetime(missing[0], 1, 1), datetime(missing[-1], 1, 1)),
+            )
+            created, = cursor.fetchone()
+            if created:
+                logging.info(f'Created {created} partitions of {self.model.TABLE_NAME}')
+            self.years.update(range(missing[0], missing[-1] + 1))
+
+    def _split_columns(self, batch):
+        model = self.model
+        count = len(next(iter(batch.values())))
+        if 'id' in model.FIELDS and 'id' not in batch and model.id_allocator is not None:
+            # Partitions have no sequences of their own
+            batch = dict(batch, id=model.id_allocator.reserve(model.TABLE_NAME, count))
+        keys = batch[self.column]
+        if isinstance(keys, np.ndarray):
+            keys = keys.astype('datetime64[us]').tolist()
+        groups = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(key.year if key is not None else None, []).append(i)
+        # NumPy columns stay arrays, so NaT is still written as NULL
+        return {
+            year: {
+                column: values[indexes] if isinstance(values, np.ndarray) else [values[i] for i in indexes]
+                for column, values in batch.items()
+            }
+            for year, indexes in groups.items()
+        }
+
+    def _split_entities(self, batch):
+        groups = {}
+        for entity in batch:
+            key = getattr(entity, self.column)
+            groups.setdefault(key.year if key is not None else None, []).append(entity)
+        return groups
+
+    def split(self, cursor, batch):
+        # Returns (model, batch) pairs of a batch of entities or of columns, one per
+        # partition the batch touches
+        groups = self._split_columns(batch) if isinstance(batch, dict) else self._split_entities(batch)
+        self.ensure(cursor, [year for year in groups if year is not None])
+        return [(self.partition_model(year), group) for year, group in groups.items()]
+
+    def truncate(self, cursor, year, ids_table=None):
+        # With ids_table, the ids of the truncated rows are saved first to a
+        # temporary table of that name, dropped on commit
+        cursor.execute('SELECT to_regclass(%s)', (self.name(year), ))
+        if cursor.fetchone()[0] is None:
+            return False
+        if ids_table is not None:
+            cursor.execute(f'CREATE TEMPORARY TABLE {ids_table} ON COMMIT DROP AS SELECT id FROM {self.name(year)}')
+            cursor.execute(f'ANALYZE {ids_table}')
+        cursor.execute(f'TRUNCATE {self.name(year)}')
+        return True
+
+
+def init_partitions(cursor, models):
+    # Sets up YearPartitions for the models whose tables are partitioned by range
+    cursor.execute('''
+        SELECT pg_class.relname, pg_attribute.attname
+        FROM pg_partitioned_table
+        JOIN pg_class ON pg_class.oid = pg_partitioned_table.partrelid
+        JOIN pg_attribute ON pg_attribute.attrelid = pg_partitioned_table.partrelid
+            AND pg_attribute.attnum = pg_partitioned_table.partattrs[0]
+        WHERE pg_class.relnamespace = 'public'::regnamespace AND pg_partitioned_table.partstrat = 'r'
+    ''')
+    columns = dict(cursor.fetchall())
+    for model in models:
+        column = columns.get(model.TABLE_NAME)
+        model.partitions = YearPartitions(model, column) if column is not None else None
+    return [model for model in models if model.partitions is not None]
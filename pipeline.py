@@ -0,0 +1,79 @@
+import contextvars
+import logging
+import queue
+import threading
+import time
+from instrumentation import thread_scope
+
+
+class Pipeline:
+    # Runs a generator of batches on a producer thread and passes every batch to
+    # write() on the calling thread, so generation overlaps with database I/O. The
+    # queue between them is bounded: the producer blocks while the writer is behind.
+    # The producer runs in a copy of the caller's context.
+    _DONE = object()
+
+    def __init__(self, write, queue_size=4, poll_interval=0.1):
+        self.write = write
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.producer_stall = 0.0
+        self.writer_stall = 0.0
+        self.batch_count = 0
+        self.max_depth = 0
+        self.total_depth = 0
+
+    def _put(self, q, item, stop):
+        started = time.perf_counter()
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=self.poll_interval)
+            except queue.Full:
+                continue
+            self.producer_stall += time.perf_counter() - started
+            return True
+        return False
+
+    def _produce(self, batches, q, stop):
+        with thread_scope():
+            try:
+                for batch in batches:
+                    if not self._put(q, (batch, None), stop):
+                        return
+            except BaseException as e:
+                self._put(q, (self._DONE, e), stop)
+            else:
+                self._put(q, (self._DONE, None), stop)
+
+    def __call__(self, batches):
+        q = queue.Queue(self.queue_size)
+        stop = threading.Event()
+        context = contextvars.copy_context()
+        producer = threading.Thread(target=context.run, args=(self._produce, batches, q, stop), daemon=True)
+        producer.start()
+        n = 0
+        try:
+            while True:
+                started = time.perf_counter()
+                batch, error = q.get()
+                self.writer_stall += time.perf_counter() - started
+                if batch is self._DONE:
+                    if error is not None:
+                        raise error
+                    break
+                depth = q.qsize()
+                self.max_depth = max(self.max_depth, depth)
+                self.total_depth += depth
+                self.batch_count += 1
+                n += self.write(batch)
+        finally:
+            stop.set()
+            producer.join()
+        return n
+
+    def log_stats(self, name):
+        mean_depth = self.total_depth / self.batch_count if self.batch_count else 0
+        logging.info(
+            f'{name}: {self.batch_count} batches, queue depth mean {mean_depth:.1f} max {self.max_depth}/{self.queue_size}, '
+            f'producer stalled {self.producer_stall:.2f}s, writer stalled {self.writer_stall:.2f}s'
+        )
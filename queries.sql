@@ -1,7 +1,7 @@
 -- Частоты встречаемости подписок по количеству продлений
 SELECT continuations, COUNT(*) FROM (
-    SELECT id, (SELECT COUNT(*) FROM succeeding_device_rents(id)) AS continuations FROM device_rent
-) AS t GROUP BY continuations;
+    SELECT MAX(chain_position) OVER (PARTITION BY chain_id) - chain_position AS continuations FROM device_rent
+) AS t GROUP BY continuations ORDER BY continuations;
 
 -- Топ-5 людей по количеству поставленных звезд
 SELECT customer.first_name, customer.last_name, SUM(feedback.stars) AS total_stars
@@ -23,38 +23,7 @@ ORDER BY damage DESC
 LIMIT 1;
 
 -- Подсчет выручки по годам
-SELECT
-    a.year AS year,
-    rent_income,
-    ensurance_income,
-    fine_income,
-    repair_expenses,
-    rent_income + ensurance_income + fine_income - repair_expenses AS total_revenue
-FROM (
-    SELECT
-        EXTRACT(YEAR FROM device_rent.begin_timestamp) AS year,
-        SUM(device_model_rent_price.price) AS rent_income,
-        SUM((device_rent.is_insured::integer) * 500)::money AS ensurance_income
-    FROM (
-        SELECT device_rent.id AS device_rent_id, MAX(device_model_rent_price.update_timestamp) AS latest_price_update
-        FROM device_rent
-        JOIN device_model_rent_price ON device_rent.begin_timestamp >= device_model_rent_price.update_timestamp
-        GROUP BY device_rent.id
-    ) AS device_rents_prices
-    JOIN device_model_rent_price ON device_model_rent_price.update_timestamp = latest_price_update
-    JOIN device_rent ON device_rent.id = device_rent_id
-    GROUP BY EXTRACT(YEAR FROM device_rent.begin_timestamp)
-) AS a
-JOIN (
-    SELECT EXTRACT(YEAR FROM device_ownership.end_timestamp) AS year, SUM(damage_fine.fine) as fine_income
-    FROM damage_fine 
-    JOIN device_ownership ON damage_fine.device_ownership_id = device_ownership.id
-    GROUP BY EXTRACT(YEAR FROM device_ownership.end_timestamp)
-) AS b ON a.year = b.year
-JOIN (
-    SELECT EXTRACT(YEAR FROM begin_timestamp) AS year, SUM(price) AS repair_expenses FROM device_repair
-    GROUP BY EXTRACT(YEAR FROM begin_timestamp)
-) AS c ON b.year = c.year
+SELECT * FROM revenue_yearly
 ORDER BY year DESC;
 
 -- Средняя длина комментариев пользователей разных типов устройств
@@ -0,0 +1,79 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class TargetGraph:
+    # Dependency DAG of targets. Dependencies that are not selected for a run are
+    # assumed to be satisfied already.
+    def __init__(self, dependencies):
+        self.dependencies = {target: list(target_dependencies) for target, target_dependencies in dependencies.items()}
+        for target, target_dependencies in self.dependencies.items():
+            for dependency in target_dependencies:
+                if dependency not in self.dependencies:
+                    raise ValueError(f'Unknown dependency {dependency} of {target}')
+        self.order(self.dependencies)
+
+    def order(self, targets):
+        targets = set(targets)
+        ordered = []
+        visited = set()
+        visiting = set()
+
+        def visit(target):
+            if target in visited:
+                return
+            if target in visiting:
+                raise ValueError(f'Dependency cycle through {target}')
+            visiting.add(target)
+            for dependency in self.dependencies[target]:
+                if dependency in targets:
+                    visit(dependency)
+            visiting.remove(target)
+            visited.add(target)
+            ordered.append(target)
+
+        for target in self.dependencies:
+            if target in targets:
+                visit(target)
+        return ordered
+
+    def reverse_order(self, targets):
+        return self.order(targets)[::-1]
+
+    def dependents(self, targets):
+        # The targets together with all targets depending on them, directly or not
+        closure = set(targets)
+        for target in self.order(self.dependencies):
+            if closure & set(self.dependencies[target]):
+                closure.add(target)
+        return closure
+
+    def run(self, targets, run_target, workers=1):
+        # Runs run_target(target) on a thread pool, starting every target as soon as
+        # all of its selected dependencies have finished. The first failure stops
+        # scheduling and is re-raised once the running targets are done.
+        targets = self.order(targets)
+        waiting = {target: set(self.dependencies[target]) & set(targets) for target in targets}
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while waiting or running:
+                if error is None:
+                    for target in [target for target, dependencies in waiting.items() if not dependencies]:
+                        del waiting[target]
+                        logging.info(f'Starting {target}')
+                        running[executor.submit(run_target, target)] = target
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    target = running.pop(future)
+                    if future.exception() is not None:
+                        logging.error(f'{target} failed: {future.exception()}')
+                        error = error or future.exception()
+                        continue
+                    logging.info(f'Finished {target}')
+                    for dependencies in waiting.values():
+                        dependencies.discard(target)
+        if error is not None:
+            raise error
@@ -0,0 +1,58 @@
+import logging
+from psycopg2 import sql
+
+
+class DatabaseSnapshots:
+    # Keeps copies of whole databases as template databases. Copying a database with
+    # CREATE DATABASE ... TEMPLATE is a file-level copy, much faster than refilling
+    # it. Neither the copied database nor the snapshot may have other connections
+    # while it runs, so the connection given must be to a maintenance database
+    # (e.g. postgres) and is switched to autocommit.
+    def __init__(self, connection):
+        self.connection = connection
+        self.connection.autocommit = True
+        self.cursor = connection.cursor()
+
+    def exists(self, database):
+        self.cursor.execute('SELECT 1 FROM pg_database WHERE datname = %s', (database, ))
+        return self.cursor.fetchone() is not None
+
+    def _drop(self, database, force=False):
+        # Template databases cannot be dropped until they are made ordinary again
+        self.cursor.execute(sql.SQL('ALTER DATABASE {} IS_TEMPLATE false').format(sql.Identifier(database)))
+        q = sql.SQL('DROP DATABASE {}' + (' WITH (FORCE)' if force else '')).format(sql.Identifier(database))
+        self.cursor.execute(q)
+
+    @staticmethod
+    def _temporary_name(database):
+        # Name of the copy made before database is replaced, within the 63 bytes of
+        # an identifier
+        suffix = '_copying'
+        return database.encode()[:63 - len(suffix)].decode(errors='ignore') + suffix
+
+    def _copy(self, template, database, force=False):
+        # Replaces database with a copy of template. The copy is made under a
+        # temporary name and renamed once complete, so a failed copy leaves the
+        # old database in place.
+        temporary_name = self._temporary_name(database)
+        if self.exists(temporary_name):
+            self._drop(temporary_name)
+        self.cursor.execute(sql.SQL('CREATE DATABASE {} TEMPLATE {}').format(sql.Identifier(temporary_name), sql.Identifier(template)))
+        if self.exists(database):
+            self._drop(database, force)
+        self.cursor.execute(sql.SQL('ALTER DATABASE {} RENAME TO {}').format(sql.Identifier(temporary_name), sql.Identifier(database)))
+
+    def snapshot(self, database, name):
+        # Replaces the snapshot name with a copy of database. The snapshot is a
+        # template that does not accept connections, so it stays as it was taken.
+        self._copy(database, name)
+        self.cursor.execute(sql.SQL('ALTER DATABASE {} WITH IS_TEMPLATE true ALLOW_CONNECTIONS false').format(sql.Identifier(name)))
+        logging.info(f'Saved {database} as snapshot {name}')
+
+    def restore(self, name, database, force=False):
+        # Replaces database with a copy of the snapshot name. With force, sessions
+        # connected to the database are terminated (PostgreSQL 13+).
+        if not self.exists(name):
+            raise ValueError(f'There is no snapshot {name}')
+        self._copy(name, database, force)
+        logging.info(f'Restored {database} from snapshot {name}')
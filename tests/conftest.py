@@ -0,0 +1,133 @@
+import os
+import re
+import subprocess
+import sys
+from contextlib import ExitStack
+import psycopg2
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_SOURCES_PATH = os.path.join(ROOT, 'data_generating_sources')
+
+for path in [ROOT, os.path.join(ROOT, 'benchmarks')]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import distributions
+from data_generating import CustomerGenerator, CustomerIndex, DeviceGenerator, DeviceIndex, DeviceModelGenerator, \
+    ManufacturerGenerator, NameGenerator
+from model import LocalIdAllocator, Model
+from models import Customer, init_models_from_schema
+from postgres import libpq_environment, throwaway_server
+
+# Tests needing a database use the server of MY_DEVICE_TEST_DSN, or a throwaway one
+# created with initdb, or are skipped
+TEST_DSN = os.environ.get('MY_DEVICE_TEST_DSN')
+TEST_PORT = 55433
+
+
+def source(filename):
+    return os.path.join(DATA_SOURCES_PATH, filename)
+
+
+@pytest.fixture(scope='session')
+def models():
+    # Model fields as declared in my_device.sql, without a database
+    init_models_from_schema(os.path.join(ROOT, 'my_device.sql'))
+
+
+@pytest.fixture
+def seeded():
+    distributions.seed(0)
+
+
+@pytest.fixture
+def local_ids(monkeypatch, models):
+    monkeypatch.setattr(Model, 'id_allocator', LocalIdAllocator())
+
+
+@pytest.fixture
+def name_generator():
+    return NameGenerator(
+        source('russian_male_first_names.csv'),
+        source('russian_female_first_names.csv'),
+        source('russian_last_names.csv'),
+    )
+
+
+@pytest.fixture
+def indexes(local_ids, seeded, name_generator):
+    # Customers and devices of a small dataset, as the timeline reads them from the
+    # database
+    manufacturer_ids = {manufacturer.name: manufacturer.id for manufacturer in ManufacturerGenerator(source('manufacturers.yaml'))()}
+    device_model_ids = [
+        device_model.id
+        for device_model, _, _ in DeviceModelGenerator(source('device_models.yaml'))(None, manufacturer_ids)
+    ]
+    devices = DeviceIndex.from_devices(DeviceGenerator()(None, 500, device_model_ids=device_model_ids))
+    columns = CustomerGenerator(name_generator).columns(2000)
+    customers = CustomerIndex(Model.id_allocator.reserve(Customer.TABLE_NAME, 2000), columns['registration_timestamp'])
+    return customers, devices
+
+
+@pytest.fixture(scope='session')
+def dsn():
+    if TEST_DSN is not None:
+        yield TEST_DSN
+        return
+    with ExitStack() as stack:
+        try:
+            yield stack.enter_context(throwaway_server(TEST_PORT))
+        except (RuntimeError, OSError, subprocess.CalledProcessError) as e:
+            pytest.skip(f'No PostgreSQL server: {e}')
+
+
+def read_schema(filename):
+    # Schema file with the psql \ir includes expanded
+    with open(filename, 'r') as schema_file:
+        schema = schema_file.read()
+    return re.sub(
+        r'^\\ir (\S+)$',
+        lambda match: read_schema(os.path.join(os.path.dirname(filename), match.group(1))),
+        schema, flags=re.MULTILINE,
+    )
+
+
+@pytest.fixture
+def create_database(dsn):
+    # Creates an empty database with a schema of the repository and returns a
+    # connection to it. The databases are dropped after the test.
+    admin_connection = psycopg2.connect(dsn)
+    admin_connection.autocommit = True
+    admin_cursor = admin_connection.cursor()
+    connections = []
+
+    def create(name='my_device_test', schema='my_device.sql'):
+        admin_cursor.execute(f'DROP DATABASE IF EXISTS {name} WITH (FORCE)')
+        admin_cursor.execute(f"CREATE DATABASE {name} TEMPLATE template0 ENCODING 'UTF8'")
+        connection = psycopg2.connect(dsn, dbname=name)
+        connections.append(connection)
+        connection.cursor().execute(read_schema(os.path.join(ROOT, schema)))
+        connection.commit()
+        return connection
+
+    yield create
+    for connection in connections:
+        name = connection.info.dbname
+        connection.close()
+        admin_cursor.execute(f'DROP DATABASE IF EXISTS {name} WITH (FORCE)')
+    admin_connection.close()
+
+
+@pytest.fixture
+def manager(dsn):
+    # Runs manager.py against a database of the test server
+    def run(database, *args, check=True):
+        result = subprocess.run(
+            [sys.executable, os.path.join(ROOT, 'manager.py'), *map(str, args), '--db', database],
+            cwd=ROOT, env=libpq_environment(dsn, database), capture_output=True, text=True,
+        )
+        if check:
+            assert result.returncode == 0, result.stderr[-4000:]
+        return result
+    return run
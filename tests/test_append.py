@@ -0,0 +1,79 @@
+from bulk_load import VALIDATIONS
+
+REVENUE_MONTHLY = '''
+    SELECT month, rent_income::numeric, insurance_income::numeric, fine_income::numeric, repair_expenses::numeric
+    FROM revenue_monthly ORDER BY month
+'''
+
+
+def fetch(cursor, q, params=None):
+    cursor.execute(q, params)
+    return cursor.fetchall()
+
+
+def test_append_continues_open_chains(create_database, manager):
+    connection = create_database()
+    cursor = connection.cursor()
+    database = connection.info.dbname
+    manager(database, 'fill', '--size', 0.2, '--seed', 1)
+    (last_rent_id, ), = fetch(cursor, 'SELECT MAX(id) FROM device_rent')
+    open_chains = dict(fetch(cursor, '''
+        SELECT device_ownership.id, device_rent.id FROM device_ownership
+        JOIN device_rent_ownership ON device_rent_ownership.device_ownership_id = device_ownership.id
+        JOIN device_rent ON device_rent.id = device_rent_ownership.device_rent_id
+        WHERE device_ownership.end_timestamp IS NULL
+            AND NOT EXISTS (SELECT FROM device_rent AS next WHERE next.previous_device_rent_id = device_rent.id)
+    '''))
+    assert open_chains
+    connection.commit()
+
+    manager(database, 'append', '--days', 60, '--seed', 2)
+    # Open chains are extended from their last rent or end, and their ownerships
+    # are closed unless the chain goes on past the end of the appended period
+    continued = fetch(cursor, '''
+        SELECT previous.id FROM device_rent
+        JOIN device_rent AS previous ON previous.id = device_rent.previous_device_rent_id
+        WHERE device_rent.id > %s AND previous.id <= %s
+            AND device_rent.chain_id = previous.chain_id
+            AND device_rent.chain_position = previous.chain_position + 1
+            AND device_rent.begin_timestamp = previous.end_timestamp
+    ''', (last_rent_id, last_rent_id))
+    assert continued
+    assert {device_rent_id for device_rent_id, in continued} <= set(open_chains.values())
+    closed = fetch(cursor, '''
+        SELECT id FROM device_ownership WHERE id = ANY(%s) AND end_timestamp IS NOT NULL
+    ''', (list(open_chains), ))
+    assert closed
+    (new_rents, ), = fetch(cursor, 'SELECT COUNT(*) FROM device_rent WHERE id > %s', (last_rent_id, ))
+    assert new_rents > len(continued)
+    for name, q in VALIDATIONS.items():
+        assert fetch(cursor, q) == [], name
+    assert fetch(cursor, '''
+        SELECT chain_id FROM feedback JOIN device_rent ON device_rent.id = feedback.device_rent_id
+        GROUP BY chain_id HAVING COUNT(*) > 1
+    ''') == []
+
+    # The incremental refresh after the append matches a full one
+    revenue_monthly = fetch(cursor, REVENUE_MONTHLY)
+    cursor.execute("SELECT refresh_revenue_rollups('-infinity')")
+    assert fetch(cursor, REVENUE_MONTHLY) == revenue_monthly
+    connection.rollback()
+
+
+def test_refresh_detects_new_rows_only(create_database, manager):
+    connection = create_database()
+    cursor = connection.cursor()
+    database = connection.info.dbname
+    manager(database, 'fill', '--size', 0.2, '--seed', 1)
+    assert fetch(cursor, 'SELECT refresh_revenue_rollups()') == [(None, )]
+    (month, ), = fetch(cursor, "SELECT date_trunc('month', MAX(begin_timestamp))::date FROM device_rent")
+    revenue_monthly = fetch(cursor, REVENUE_MONTHLY)
+    cursor.execute('''
+        INSERT INTO device_rent (customer_id, device_model_id, begin_timestamp, is_insured)
+        SELECT customer_id, device_model_id, %s, TRUE FROM device_rent LIMIT 1
+    ''', (month, ))
+    assert fetch(cursor, 'SELECT refresh_revenue_rollups()') == [(month, )]
+    new_revenue_monthly = fetch(cursor, REVENUE_MONTHLY)
+    assert new_revenue_monthly[:-1] == revenue_monthly[:-1]
+    assert new_revenue_monthly[-1][2] > revenue_monthly[-1][2]
+    connection.rollback()
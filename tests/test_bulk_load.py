@@ -0,0 +1,62 @@
+import logging
+import pytest
+from bulk_load import BulkLoad
+from models import MODELS
+
+TABLE_NAMES = [model.TABLE_NAME for model in MODELS]
+
+
+def persistence(cursor):
+    cursor.execute('''
+        SELECT relname, relpersistence FROM pg_class
+        WHERE relnamespace = 'public'::regnamespace AND relkind = 'r'
+    ''')
+    return dict(cursor.fetchall())
+
+
+@pytest.mark.parametrize('schema', ['my_device.sql', 'my_device_partitioned.sql'])
+def test_unlogged_load_covers_plain_tables_and_partitions(create_database, caplog, schema):
+    connection = create_database(schema=schema)
+    cursor = connection.cursor()
+    bulk_load = BulkLoad(cursor, TABLE_NAMES, unlogged=True)
+    with caplog.at_level(logging.DEBUG):
+        bulk_load.disable()
+    unlogged = {
+        message.split()[2] for message in caplog.messages
+        if message.startswith('ALTER TABLE') and message.endswith('SET UNLOGGED')
+    }
+    assert {'customer', 'device', 'device_repair', 'damage_fine'} <= unlogged
+    if schema == 'my_device_partitioned.sql':
+        assert 'device_rent' not in unlogged
+        assert {'device_rent_y2016', 'device_ownership_y2016', 'feedback_y2016'} <= unlogged
+    else:
+        assert {'device_rent', 'device_ownership', 'feedback'} <= unlogged
+    tables = persistence(cursor)
+    assert all(tables[table_name] == 'u' for table_name in unlogged)
+
+    assert bulk_load.restore() == {}
+    assert all(persistence(cursor)[table_name] == 'p' for table_name in unlogged)
+    connection.commit()
+
+
+def test_load_fails_on_violations(create_database, manager, tmp_path):
+    connection = create_database()
+    cursor = connection.cursor()
+    database = connection.info.dbname
+    data_dir = str(tmp_path / 'dataset')
+    manager(database, 'export', '--size', 0.05, '--seed', 1, '--out', data_dir)
+    # A second ownership of the first one's device, starting within it
+    with open(tmp_path / 'dataset' / 'device_ownership.00000.copy', 'r+') as chunk:
+        rows = [row.split('\t') for row in chunk.read().splitlines()]
+        overlapping = [str(len(rows) + 1), *rows[0][1:]]
+        chunk.write('\t'.join(overlapping) + '\n')
+
+    result = manager(database, 'load', '--in', data_dir, check=False)
+    assert result.returncode != 0
+    assert 'overlapping device ownerships' in result.stderr
+    # The checks are restored, the loaded rows are kept for inspection
+    cursor.execute("SELECT conname FROM pg_constraint WHERE conrelid = 'device_ownership'::regclass AND contype = 'c'")
+    assert {'device_ownership_check_begin_timestamp', 'device_ownership_check_end_timestamp'} <= {name for name, in cursor.fetchall()}
+    cursor.execute('SELECT COUNT(*) FROM device_ownership')
+    assert cursor.fetchone()[0] == len(rows) + 1
+    connection.commit()
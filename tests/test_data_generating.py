@@ -0,0 +1,20 @@
+import numpy as np
+from data_generating import CustomerGenerator, PhoneGenerator
+
+
+def test_phones_are_unique_across_chunks(seeded, name_generator):
+    chunks = list(CustomerGenerator(name_generator).column_chunks(2500, 300))
+    assert [len(columns['phone']) for columns in chunks] == [300] * 8 + [100]
+    phones = np.concatenate([columns['phone'] for columns in chunks])
+    assert len(set(phones.tolist())) == 2500
+    assert all(len(phone) == len('+7 (000) 000-00-00') for phone in phones.tolist())
+
+
+def test_phone_number_permutation_stays_in_range(seeded):
+    phone_generator = PhoneGenerator()
+    numbers = phone_generator.number_permutation()
+    # The last positions multiply into the top of the 64-bit range
+    positions = np.concatenate([np.arange(10 ** 5), np.arange(9 * 10 ** 9 - 10 ** 5, 9 * 10 ** 9)])
+    drawn = numbers(positions)
+    assert len(np.unique(drawn)) == len(positions)
+    assert drawn.min() >= 10 ** 9 and drawn.max() < 10 ** 10
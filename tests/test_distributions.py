@@ -0,0 +1,75 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from distributions import Distribution, PriceDistribution, get_random, get_rng, seed, spawn_seeds
+from pipeline import Pipeline
+
+DRAWS = 20
+
+
+def draws(target_seed, shared, step=lambda: None):
+    seed(target_seed)
+    values = []
+    for _ in range(DRAWS):
+        values.append((shared.rvs(), get_rng().integers(1000), get_random().random()))
+        step()
+    return values
+
+
+def test_targets_draw_from_streams_of_their_own():
+    seed(1)
+    target_seeds = spawn_seeds(['customers', 'devices'])
+    shared = PriceDistribution(100, 30, buffer_size=8)
+    alone = {target: draws(target_seed, shared) for target, target_seed in target_seeds.items()}
+    assert alone['customers'] != alone['devices']
+
+    # The targets take turns after every draw
+    barrier = threading.Barrier(len(target_seeds))
+    with ThreadPoolExecutor(len(target_seeds)) as executor:
+        futures = {
+            target: executor.submit(draws, target_seed, shared, barrier.wait)
+            for target, target_seed in target_seeds.items()
+        }
+    assert {target: future.result() for target, future in futures.items()} == alone
+
+
+def test_pipeline_producer_draws_from_the_streams_of_its_target():
+    shared = PriceDistribution(100, 30, buffer_size=8)
+
+    def batches():
+        for _ in range(DRAWS):
+            yield [shared.rvs(), get_rng().integers(1000), get_random().random()]
+
+    seed(2)
+    alone = list(batches())
+    seed(2)
+    produced = []
+    Pipeline(lambda batch: produced.append(batch) or 1)(batches())
+    assert produced == alone
+
+
+# Columns drawn before anything that depends on the moment of the run, as the
+# default datetime distribution ends now
+SEEDED_COLUMNS = {
+    'device': 'id, model_id',
+    'customer': 'id, first_name, last_name',
+}
+
+
+def test_parallel_fill_is_seeded(create_database, manager):
+    rows = []
+    for name in ['my_device_test', 'my_device_test_again']:
+        connection = create_database(name)
+        manager(name, 'fill', 'manufacturers', 'device_models', 'devices', 'customers', '--size', 0.2, '--seed', 1, '--workers', 3)
+        cursor = connection.cursor()
+        tables = {}
+        for table_name, columns in SEEDED_COLUMNS.items():
+            cursor.execute(f'SELECT {columns} FROM {table_name} ORDER BY {columns}')
+            tables[table_name] = cursor.fetchall()
+        rows.append(tables)
+    assert rows[0] == rows[1]
+
+
+def test_distribution_is_abstract():
+    with pytest.raises(TypeError):
+        Distribution()
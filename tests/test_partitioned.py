@@ -0,0 +1,57 @@
+import pytest
+from query_plans import FUNCTION_PROBES
+
+
+def functions(cursor):
+    cursor.execute("SELECT proname FROM pg_proc WHERE pronamespace = 'public'::regnamespace")
+    return {name for name, in cursor.fetchall()}
+
+
+def test_partitioned_schema_keeps_the_functions(create_database):
+    plain_functions = functions(create_database('my_device_plain').cursor())
+    cursor = create_database(schema='my_device_partitioned.sql').cursor()
+    assert plain_functions <= functions(cursor)
+    assert set(FUNCTION_PROBES) <= functions(cursor)
+    cursor.execute("SELECT relkind FROM pg_class WHERE relname IN ('device_rent', 'device_ownership', 'feedback')")
+    assert [relkind for relkind, in cursor.fetchall()] == ['p'] * 3
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_clear_year(create_database, manager, workers):
+    connection = create_database(schema='my_device_partitioned.sql')
+    cursor = connection.cursor()
+    database = connection.info.dbname
+    manager(database, 'fill', '--size', 0.2, '--seed', 1, '--workers', workers)
+    cursor.execute('SELECT COUNT(*) FROM device_rent WHERE chain_position = 0')
+    chains, = cursor.fetchone()
+    cursor.execute('''
+        SELECT COUNT(*) FROM succeeding_device_rents((SELECT MIN(previous_device_rent_id) FROM device_rent))
+    ''')
+    assert cursor.fetchone()[0] > 0
+    connection.commit()
+
+    manager(database, 'clear', 'timeline', 'feedbacks', '--year', 2017)
+    cursor.execute("SELECT COUNT(*) FROM device_rent WHERE begin_timestamp >= '2017-01-01' AND begin_timestamp < '2018-01-01'")
+    assert cursor.fetchone()[0] == 0
+    cursor.execute('SELECT COUNT(*) FROM device_rent WHERE chain_position = 0')
+    assert 0 < cursor.fetchone()[0] < chains
+    for table_name, column, referenced_table_name in [
+        ('device_rent_ownership', 'device_rent_id', 'device_rent'),
+        ('device_rent_ownership', 'device_ownership_id', 'device_ownership'),
+        ('device_repair', 'device_ownership_id', 'device_ownership'),
+        ('damage_fine', 'device_ownership_id', 'device_ownership'),
+        ('feedback', 'device_rent_id', 'device_rent'),
+        ('device_rent', 'previous_device_rent_id', 'device_rent'),
+        ('device_rent', 'chain_id', 'device_rent'),
+    ]:
+        cursor.execute(f'''
+            SELECT COUNT(*) FROM {table_name} AS t
+            WHERE t.{column} IS NOT NULL AND NOT EXISTS (SELECT FROM {referenced_table_name} WHERE id = t.{column})
+        ''')
+        assert cursor.fetchone()[0] == 0, (table_name, column)
+    # Rent income of the year is gone, that of the other years is recomputed
+    cursor.execute("SELECT COUNT(*) FROM revenue_monthly WHERE month >= '2017-01-01' AND month < '2018-01-01' AND rent_income > 0::money")
+    assert cursor.fetchone()[0] == 0
+    cursor.execute("SELECT COUNT(*) FROM revenue_monthly WHERE month >= '2018-01-01' AND rent_income > 0::money")
+    assert cursor.fetchone()[0] > 0
+    connection.commit()
@@ -0,0 +1,69 @@
+import psycopg2
+import pytest
+from models import MODELS
+from snapshots import DatabaseSnapshots
+
+SNAPSHOT = 'my_device_test_snapshot'
+
+
+@pytest.fixture
+def snapshots(dsn):
+    connection = psycopg2.connect(dsn)
+    snapshots = DatabaseSnapshots(connection)
+    yield snapshots
+    for database in [SNAPSHOT, snapshots._temporary_name(SNAPSHOT)]:
+        if snapshots.exists(database):
+            snapshots._drop(database)
+    connection.close()
+
+
+def counts(dsn, database):
+    connection = psycopg2.connect(dsn, dbname=database)
+    try:
+        cursor = connection.cursor()
+        result = {}
+        for model in MODELS:
+            cursor.execute(f'SELECT COUNT(*) FROM {model.TABLE_NAME}')
+            result[model.TABLE_NAME], = cursor.fetchone()
+        return result
+    finally:
+        connection.close()
+
+
+def test_snapshot_round_trip(dsn, create_database, manager, snapshots):
+    connection = create_database()
+    database = connection.info.dbname
+    connection.close()
+    manager(database, 'fill', '--size', 0.1, '--seed', 1)
+    filled = counts(dsn, database)
+    manager(database, 'snapshot', '--snapshot', SNAPSHOT)
+    snapshots.cursor.execute('SELECT datistemplate, datallowconn FROM pg_database WHERE datname = %s', (SNAPSHOT, ))
+    assert snapshots.cursor.fetchone() == (True, False)
+
+    manager(database, 'clear', 'timeline')
+    assert counts(dsn, database)['device_rent'] == 0
+    manager(database, 'restore', '--snapshot', SNAPSHOT)
+    assert counts(dsn, database) == filled
+    assert not snapshots.exists(snapshots._temporary_name(database))
+
+
+def test_failed_copy_keeps_the_old_database(dsn, create_database, manager, snapshots):
+    connection = create_database()
+    database = connection.info.dbname
+    manager(database, 'fill', 'manufacturers', '--seed', 1)
+    connection.close()
+    manager(database, 'snapshot', '--snapshot', SNAPSHOT)
+    before = counts(dsn, database)
+
+    # A database cannot be copied while others are connected to it
+    connection = psycopg2.connect(dsn, dbname=database)
+    try:
+        connection.cursor().execute('DELETE FROM manufacturer')
+        connection.commit()
+        assert manager(database, 'snapshot', '--snapshot', SNAPSHOT, check=False).returncode != 0
+        assert snapshots.exists(SNAPSHOT)
+        # With --force the connections to the restored database are terminated
+        manager(database, 'restore', '--snapshot', SNAPSHOT, '--force')
+    finally:
+        connection.close()
+    assert counts(dsn, database) == before
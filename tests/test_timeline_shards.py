@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+import distributions
+import timeline_shards
+from model import LocalIdAllocator, Model
+from models import DeviceOwnership, DeviceRent, DeviceRentOwnership
+from timeline_shards import ShardedTimelineGenerator
+
+
+@pytest.fixture
+def sharded(monkeypatch, indexes):
+    customers, devices = indexes
+    monkeypatch.setattr(timeline_shards.CustomerIndex, 'select', classmethod(lambda cls, cursor: customers))
+    monkeypatch.setattr(timeline_shards.DeviceIndex, 'select', classmethod(lambda cls, cursor: devices))
+
+    def generate(workers=3, rent_count=1500, chunk_size=20, seed=1):
+        distributions.seed(seed)
+        Model.id_allocator = LocalIdAllocator()
+        timeline_generator = ShardedTimelineGenerator(workers, chunk_size=chunk_size)
+        return timeline_generator, list(timeline_generator(None, rent_count))
+    return devices, generate
+
+
+def test_shards_are_consumed_in_turn(sharded):
+    devices, generate = sharded
+    timeline_generator, chunks = generate()
+    shard_model_ids = [set(shard.model_ids.tolist()) for shard in timeline_generator._shards(devices)]
+    assert len(shard_model_ids) == 3
+    chunk_shards = []
+    for chunk in chunks:
+        model_id = chunk[DeviceRent]['device_model_id'][0]
+        chunk_shards.append(next(i for i, model_ids in enumerate(shard_model_ids) if model_id in model_ids))
+    # Every shard has delivered a chunk before the first one is done
+    assert sorted(chunk_shards[:3]) == [0, 1, 2]
+    assert chunk_shards.count(0) > 2
+    assert chunk_shards.index(2) < len(chunk_shards) - chunk_shards[::-1].index(0) - 1
+
+
+def test_chunks_refer_to_their_own_rows(sharded):
+    _, generate = sharded
+    _, chunks = generate()
+    rent_ids = np.concatenate([chunk[DeviceRent]['id'] for chunk in chunks])
+    ownership_ids = np.concatenate([chunk[DeviceOwnership]['id'] for chunk in chunks])
+    assert len(np.unique(rent_ids)) == len(rent_ids)
+    previous_ids = [i for chunk in chunks for i in chunk[DeviceRent]['previous_device_rent_id'] if i is not None]
+    assert set(previous_ids) <= set(rent_ids.tolist())
+    assert set(np.concatenate([chunk[DeviceRent]['chain_id'] for chunk in chunks]).tolist()) <= set(rent_ids.tolist())
+    for chunk in chunks:
+        assert set(chunk[DeviceRentOwnership]['device_rent_id'].tolist()) <= set(rent_ids.tolist())
+        assert set(chunk[DeviceRentOwnership]['device_ownership_id'].tolist()) <= set(ownership_ids.tolist())
+
+
+def test_seeded_runs_are_identical(sharded):
+    _, generate = sharded
+    _, chunks = generate(seed=2)
+    _, other_chunks = generate(seed=2)
+    assert len(chunks) == len(other_chunks)
+    for chunk, other_chunk in zip(chunks, other_chunks):
+        for model, columns in chunk.items():
+            for field, values in columns.items():
+                assert values.astype(str).tolist() == other_chunk[model][field].astype(str).tolist(), (model, field)
+
+
+def test_closing_early_does_not_hang(sharded):
+    timeline = ShardedTimelineGenerator(3, chunk_size=10)(None, 1500)
+    next(timeline)
+    timeline.close()
+
+
+@pytest.mark.parametrize('values', [
+    ['a', None, 'b', 'a'],
+    [None, None],
+    [1, None, 3],
+    [True, False],
+    [],
+])
+def test_columns_keep_missing_values(values):
+    assert timeline_shards._unpack_column(timeline_shards._pack_column(values)).tolist() == values
@@ -0,0 +1,161 @@
+import heapq
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import numpy as np
+import distributions
+from model import LocalIdAllocator, Model, batches
+from models import *
+from data_generating import CustomerIndex, DeviceIndex, TimelineGenerator
+
+
+TIMELINE_MODELS = [DeviceRent, DeviceOwnership, DeviceRentOwnership, DeviceRepair]
+
+
+def _init_worker(fields):
+    for model in MODELS:
+        model.set_fields(*fields[model.TABLE_NAME])
+
+
+def _pack_column(values):
+    # Compact form of a column for passing between processes: timestamps and numbers
+    # as NumPy arrays and strings as codes into their distinct values, with a mask
+    # of the missing numbers and strings
+    sample = next((value for value in values if value is not None), None)
+    if isinstance(sample, datetime):
+        return np.array(values, dtype='datetime64[us]'), None, None
+    if isinstance(sample, bool):
+        return np.array(values, dtype=bool), None, None
+    missing = np.fromiter((value is None for value in values), dtype=bool, count=len(values))
+    missing = missing if missing.any() else None
+    if isinstance(sample, str):
+        strings = np.array(['' if value is None else value for value in values], dtype=str)
+        categories, codes = np.unique(strings, return_inverse=True)
+        return codes.astype(np.int32), missing, categories
+    numbers = np.fromiter((0 if value is None else value for value in values), dtype=np.int64, count=len(values))
+    return numbers, missing, None
+
+
+def _unpack_column(column, ids=None):
+    # Column values to write, with local ids replaced by the given ids
+    values, missing, categories = column
+    if categories is not None:
+        values = categories.astype(object)[values]
+    elif ids is not None:
+        values = ids[values]
+    if missing is not None:
+        values = values.astype(object)
+        values[missing] = None
+    return values
+
+
+def _pack_chunk(chunk):
+    rows = {model: [] for model in TIMELINE_MODELS}
+    for x in chunk:
+        for model, entities in zip(TIMELINE_MODELS, x):
+            for entity in entities:
+                entity._prepare_for_insert(None)
+                rows[model].append(entity.values())
+    return {
+        model.TABLE_NAME: {
+            field: _pack_column(values)
+            for field, values in zip(model.FIELDS, list(map(list, zip(*model_rows))) or [[] for _ in model.FIELDS])
+        }
+        for model, model_rows in rows.items()
+    }
+
+
+def _generate_shard(rent_count, customers, devices, seed_sequence, chunks, chunk_size):
+    # Runs in a worker process and puts the rows of every chunk_size rent chains on
+    # the chunks queue, then None. A chain only refers to rows of its own, so rows
+    # get local ids counted from 0 in every chunk, which the parent maps onto ids
+    # reserved from the database.
+    try:
+        distributions.seed(seed_sequence)
+        Model.id_allocator = LocalIdAllocator(start=0)
+        timeline_generator = TimelineGenerator()
+        for chunk in batches(timeline_generator(None, rent_count, customers=customers, devices=devices), chunk_size):
+            chunks.put(_pack_chunk(chunk))
+            Model.id_allocator = LocalIdAllocator(start=0)
+    finally:
+        chunks.put(None)
+
+
+class ShardedTimelineGenerator:
+    # Splits the timeline by device model across worker processes. Every shard gets
+    # a disjoint set of devices, a share of the rents proportional to its devices,
+    # all customers and an independent random stream. Shards are passed on in
+    # chunks of chunk_size rent chains, at most max_queued_chunks of them waiting
+    # per shard.
+    def __init__(self, workers, chunk_size=10000, max_queued_chunks=2):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.max_queued_chunks = max_queued_chunks
+
+    def _shards(self, devices):
+        model_ids, inverse = np.unique(devices.model_ids, return_inverse=True)
+        model_devices = [np.flatnonzero(inverse == i) for i in range(len(model_ids))]
+        shards = [(0, i, []) for i in range(min(self.workers, len(model_devices)))]
+        for indexes in sorted(model_devices, key=len, reverse=True):
+            count, i, shard = heapq.heappop(shards)
+            shard.append(indexes)
+            heapq.heappush(shards, (count + len(indexes), i, shard))
+        return [devices.take(np.sort(np.concatenate(shard))) for _, _, shard in sorted(shards, key=lambda x: x[1])]
+
+    @staticmethod
+    def _rent_counts(rent_count, shards):
+        device_count = sum(map(len, shards))
+        rent_counts = [rent_count * len(shard) // device_count for shard in shards]
+        rent_counts[0] += rent_count - sum(rent_counts)
+        return rent_counts
+
+    @staticmethod
+    def _assign_ids(chunk):
+        ids = {}
+        for model in TIMELINE_MODELS:
+            if 'id' in model.FIELD_POSITIONS:
+                count = len(chunk[model.TABLE_NAME]['id'][0])
+                ids[model.TABLE_NAME] = np.asarray(Model.id_allocator.reserve(model.TABLE_NAME, count), dtype=np.int64)
+        columns = {}
+        for model in TIMELINE_MODELS:
+            references = dict(model.REFERENCES, id=model.TABLE_NAME)
+            columns[model] = {
+                field: _unpack_column(column, ids.get(references.get(field)))
+                for field, column in chunk[model.TABLE_NAME].items()
+            }
+        return columns
+
+    def __call__(self, cursor, rent_count):
+        customers = CustomerIndex.select(cursor)
+        devices = DeviceIndex.select(cursor)
+        shards = self._shards(devices)
+        if not shards:
+            logging.error('No devices available')
+            return
+        rent_counts = self._rent_counts(rent_count, shards)
+        seed_sequences = list(distributions.spawn_seeds(range(len(shards))).values())
+        fields = {model.TABLE_NAME: (model.FIELDS, model.DEFAULTED_FIELDS) for model in MODELS}
+        # The manager is shut down first, so workers blocked on a full queue fail
+        # instead of hanging when the chunks are not consumed to the end
+        with ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(fields, )) as executor, \
+                multiprocessing.Manager() as manager:
+            queues = [manager.Queue(self.max_queued_chunks) for _ in shards]
+            futures = [
+                executor.submit(_generate_shard, shard_rent_count, customers, shard, seed_sequence, chunks, self.chunk_size)
+                for shard_rent_count, shard, seed_sequence, chunks in zip(rent_counts, shards, seed_sequences, queues)
+            ]
+            # Chunks are taken from the shards in turn, so every shard keeps
+            # generating while the others are consumed. The order is fixed, not that
+            # of completion, so that a seeded run gets the same ids every time.
+            shard_queues = deque(zip(futures, queues))
+            while shard_queues:
+                future, chunks = shard_queues.popleft()
+                chunk = chunks.get()
+                if chunk is None:
+                    future.result()
+                    logging.info('Timeline shard is generated')
+                    continue
+                yield self._assign_ids(chunk)
+                shard_queues.append((future, chunks))